@@ -1,14 +1,11 @@
 from dataclasses import dataclass
 from typing import List, Dict
 import numpy as np
-from scipy import stats
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 
-from statsmodels.stats import inter_rater as irr
-
-from data_processing import ProcessedConversation
+from action_matrix import ActionMatrices, action_counts, conditional_counts
+from action_stats import compare
+from agreement import agreement_metrics, ratings_from_matrices
+from data_processing import STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES, ProcessedConversation
 
 @dataclass
 class ActionAnalysis:
@@ -17,83 +14,50 @@ class ActionAnalysis:
         
     def compute_action_distributions(self, responses: List[ProcessedConversation]) -> Dict:
         """Compute distribution of tutor actions across all responses"""
-        action_counts = {action: 0 for action in self.action_types}
-        total = 0
-        
-        for turn in responses:
-            for tr in turn.tutor_responses:
-                for i, action in enumerate(self.action_types):
-                    if tr.actions[i]:
-                        action_counts[action] += 1
-                        total += 1
+        tutor_idx = [TUTOR_ACTION_TYPES.index(action) for action in self.action_types]
+        counts = action_counts(ActionMatrices.from_conversations(responses))[tutor_idx]
+        total = int(counts.sum())
         
-        return {k: v/total for k, v in action_counts.items()}
+        return {action: count / total for action, count in zip(self.action_types, counts.tolist())}
 
     def compute_conditional_distributions(self, responses: List[ProcessedConversation]) -> Dict:
         """Compute tutor action distributions conditioned on student action"""
         student_actions = ['guess', 'question', 'affirmation']
-        conditional_dist = {}
-        
-        for student_action in student_actions:
-            action_counts = {action: 0 for action in self.action_types}
-            total = 0
-            
-            for turn in responses:
-                # Check if student made this action
-                if turn.student_actions[student_actions.index(student_action)]:
-                    for tr in turn.tutor_responses:
-                        for i, action in enumerate(self.action_types):
-                            if tr.actions[i]:
-                                action_counts[action] += 1
-                                total += 1
-                                
-            if total > 0:
-                conditional_dist[student_action] = {k: v/total for k, v in action_counts.items()}
-            
-        return conditional_dist
+        student_idx = [STUDENT_ACTION_TYPES.index(action) for action in student_actions]
+        tutor_idx = [TUTOR_ACTION_TYPES.index(action) for action in self.action_types]
+
+        # All student x tutor counts from one matrix product instead of a rescan per student action
+        counts = conditional_counts(ActionMatrices.from_conversations(responses))[np.ix_(student_idx, tutor_idx)]
+        totals = counts.sum(axis=1).tolist()
+
+        return {
+            student_action: {action: count / totals[i] for action, count in zip(self.action_types, counts[i].tolist())}
+            for i, student_action in enumerate(student_actions)
+            if totals[i] > 0
+        }
 
     def compute_agreement_metrics(self, responses: List[ProcessedConversation]) -> Dict:
         """Compute comprehensive agreement metrics between tutors"""
-        # Overall agreement rate
-        agreement_count = 0
-        total = 0
-        
-        # Per-action agreement tracking
-        action_agreements = {action: {'agree': 0, 'total': 0} for action in self.action_types}
-        
-        # Data for Fleiss' kappa
-        kappa_data = []
-        
-        for turn in responses:
-            # Track agreements for each action type
-            for action_idx, action in enumerate(self.action_types):
-                action_votes = [tr.actions[action_idx] for tr in turn.tutor_responses]
-                
-                # Pairwise agreements
-                for i in range(len(action_votes)):
-                    for j in range(i+1, len(action_votes)):
-                        if action_votes[i] == action_votes[j]:
-                            action_agreements[action]['agree'] += 1
-                        action_agreements[action]['total'] += 1
-            
-            # Overall exact match agreement
-            for i in range(len(turn.tutor_responses)):
-                for j in range(i+1, len(turn.tutor_responses)):
-                    if turn.tutor_responses[i].actions == turn.tutor_responses[j].actions:
-                        agreement_count += 1
-                    total += 1
-            
-        
+        # Each response slot is a rater and each conversation an item
+        ratings, mask = ratings_from_matrices([ActionMatrices.from_conversations(responses)])
+        metrics = agreement_metrics(ratings, mask)
+
+        # Per-action metrics are reported for the analysed action types only
         return {
-            'overall_agreement': agreement_count / total if total > 0 else 0,
-            'per_action_agreement': {
-                action: stats['agree'] / stats['total'] if stats['total'] > 0 else 0 
-                for action, stats in action_agreements.items()
-            },
+            'overall_agreement': metrics['overall_agreement'],
+            **{
+                name: {action: metrics[name][action] for action in self.action_types}
+                for name in ['per_action_agreement', 'fleiss_kappa', 'krippendorff_alpha']
+            }
         }
 
     def plot_distributions(self, human_dist: Dict, llm_dist: Dict, title: str):
         """Plot comparison of human vs LLM action distributions"""
+        # Plotting libraries are only imported when plotting, the statistics don't need them
+        import matplotlib.pyplot as plt
+        import pandas as pd
+        import seaborn as sns
+
         df = pd.DataFrame({
             'Human': human_dist,
             'LLM': llm_dist
@@ -110,19 +74,31 @@ class ActionAnalysis:
         plt.show()
 
     def statistical_comparison(self, human_responses: List[ProcessedConversation], 
-                             llm_responses: List[ProcessedConversation]) -> Dict:
-        """Run statistical tests comparing human and LLM distributions"""
+                             llm_responses: List[ProcessedConversation], n_resamples: int = 2000,
+                             seed: int = 0) -> Dict:
+        """
+        Run statistical tests comparing human and LLM distributions
+
+        Both lists must hold the same conversations in the same order. The test is a paired
+        permutation test on the real response-level action flags, so responses with several
+        actions are handled properly, with bootstrap CIs for the differences (see action_stats.compare).
+        """
+        if len(human_responses) != len(llm_responses):
+            raise ValueError("Human and LLM responses must cover the same conversations")
+
         human_dist = self.compute_action_distributions(human_responses)
         llm_dist = self.compute_action_distributions(llm_responses)
-        
-        # Chi-square test
-        human_counts = np.array([v * len(human_responses) for v in human_dist.values()])
-        llm_counts = np.array([v * len(llm_responses) for v in llm_dist.values()])
-        chi2, p_value = stats.chisquare(llm_counts, human_counts)
-        
+
+        marginal = compare(
+            ActionMatrices.from_conversations(human_responses), ActionMatrices.from_conversations(llm_responses),
+            n_resamples=n_resamples, n_permutations=n_resamples, seed=seed, tutor_actions=self.action_types
+        )['marginal']
+
         return {
-            'chi2_statistic': chi2,
-            'p_value': p_value,
+            'total_variation': marginal['statistic'],
+            'p_value': marginal['p_value'],
+            'action_p_values': marginal['action_p_values'],
+            'difference_ci': marginal['difference_ci'],
             'human_distribution': human_dist,
             'llm_distribution': llm_dist
         }
\ No newline at end of file
@@ -0,0 +1,168 @@
+from dataclasses import dataclass
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from data_processing import STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES, ProcessedConversation
+from dataset_cache import ConversationColumns, unpack_masks
+
+def as_flags(actions: Sequence, action_types: List[str]) -> List[bool]:
+    """
+    Turn one turn's actions into positional flags over `action_types`.
+
+    Accepts the list of action names that process_*_actions return, as well as raw
+    positional flags (booleans, or the 'True'/'False' strings used for student actions).
+    """
+    if all(isinstance(a, (bool, np.bool_)) for a in actions) and actions:
+        flags = [bool(a) for a in actions]
+    elif actions and all(isinstance(a, str) and a.lower() in ('true', 'false') for a in actions):
+        flags = [a.lower() == 'true' for a in actions]
+    else:
+        names = {a.lower() for a in actions}
+        return [action in names for action in action_types]
+    return (flags + [False] * len(action_types))[:len(action_types)]
+
+@dataclass
+class ActionMatrices:
+    """
+    Dense boolean action matrices for a corpus.
+
+    Any number of leading axes may be stacked in front (e.g. one per model or
+    ensemble sample, see stack()); every function below reduces over the last axes only.
+    """
+    student: np.ndarray  # (..., conversations, 4) student actions
+    tutor: np.ndarray  # (..., conversations, responses, 5) tutor actions, padded with False
+    mask: np.ndarray  # (..., conversations, responses) which response slots are real
+
+    @classmethod
+    def from_conversations(cls, conversations: List[ProcessedConversation]) -> 'ActionMatrices':
+        """Unpack the conversations' action bitmasks straight into the matrices"""
+        lengths = np.fromiter((len(conv.tutor_responses) for conv in conversations), dtype=np.int64, count=len(conversations))
+        student_masks = np.fromiter((conv.student_mask for conv in conversations), dtype=np.uint8, count=len(conversations))
+        tutor_masks = np.frombuffer(b''.join(conv.tutor_action_masks for conv in conversations), dtype=np.uint8)
+        return cls.from_rows(
+            unpack_masks(student_masks, len(STUDENT_ACTION_TYPES)),
+            unpack_masks(tutor_masks, len(TUTOR_ACTION_TYPES)),
+            lengths
+        )
+
+    @classmethod
+    def from_columns(cls, columns: ConversationColumns) -> 'ActionMatrices':
+        return cls.from_rows(columns.student_actions, columns.tutor_actions, np.diff(columns.response_offsets))
+
+    @classmethod
+    def from_rows(cls, student: np.ndarray, tutor_rows: np.ndarray, lengths: np.ndarray) -> 'ActionMatrices':
+        """
+        Scatter flat per-response rows into the padded layout.
+
+        Args:
+            student: (n_conversations, 4) student action flags
+            tutor_rows: (n_responses_total, 5) tutor action flags, conversation after conversation
+            lengths: (n_conversations,) number of responses in each conversation
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        n_conversations, n_responses = len(lengths), int(lengths.max(initial=0))
+
+        conversation_index = np.repeat(np.arange(n_conversations), lengths)
+        response_index = np.arange(offsets[-1]) - offsets[conversation_index]
+
+        tutor = np.zeros((n_conversations, n_responses, len(TUTOR_ACTION_TYPES)), dtype=bool)
+        mask = np.zeros((n_conversations, n_responses), dtype=bool)
+        tutor[conversation_index, response_index] = tutor_rows
+        mask[conversation_index, response_index] = True
+        return cls(np.array(student, dtype=bool).reshape(n_conversations, len(STUDENT_ACTION_TYPES)), tutor, mask)
+
+    @classmethod
+    def from_responses(cls, data: Dict, student_actions: np.ndarray = None) -> 'ActionMatrices':
+        """
+        Build matrices from a responses file ({conv_id: response or [responses]}).
+
+        Args:
+            data: Loaded responses JSON, single-response or ensemble (list) layout
+            student_actions: (n_conversations, 4) matrix indexed by integer conversation id,
+                             e.g. load_columns().student_actions. Zeros if not given
+        """
+        rows = [responses if isinstance(responses, list) else [responses] for responses in data.values()]
+        n_responses = max((len(responses) for responses in rows), default=0)
+        tutor = np.zeros((len(rows), n_responses, len(TUTOR_ACTION_TYPES)), dtype=bool)
+        mask = np.zeros((len(rows), n_responses), dtype=bool)
+        for c, responses in enumerate(rows):
+            for r, response in enumerate(responses):
+                tutor[c, r] = as_flags(response['actions'], TUTOR_ACTION_TYPES)
+                mask[c, r] = True
+
+        if student_actions is None:
+            student = np.zeros((len(rows), len(STUDENT_ACTION_TYPES)), dtype=bool)
+        else:
+            student = np.asarray(student_actions, dtype=bool)[[int(conv_id) for conv_id in data.keys()]]
+        return cls(student, tutor, mask)
+
+    @property
+    def n_responses(self) -> np.ndarray:
+        """Number of real responses per conversation"""
+        return self.mask.sum(-1)
+
+def stack(matrices: List[ActionMatrices]) -> ActionMatrices:
+    """Stack corpora of the same conversations (e.g. several models) along a new leading axis"""
+    n_responses = max(m.tutor.shape[-2] for m in matrices)
+
+    def pad(array, axis_from_end):
+        widths = [(0, 0)] * array.ndim
+        widths[array.ndim - axis_from_end] = (0, n_responses - array.shape[-axis_from_end])
+        return np.pad(array, widths)
+
+    return ActionMatrices(
+        student=np.stack([m.student for m in matrices]),
+        tutor=np.stack([pad(m.tutor, 2) for m in matrices]),
+        mask=np.stack([pad(m.mask, 1) for m in matrices]),
+    )
+
+def _normalize(counts: np.ndarray, axis=-1) -> np.ndarray:
+    """Divide by the sum over `axis`, leaving all-zero rows at zero"""
+    totals = counts.sum(axis=axis, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros(counts.shape, dtype=float), where=totals > 0)
+
+def action_counts(m: ActionMatrices) -> np.ndarray:
+    """(..., 5) number of responses using each tutor action"""
+    return m.tutor.sum(axis=(-3, -2))
+
+def marginal_distribution(m: ActionMatrices) -> np.ndarray:
+    """(..., 5) share of all tutor actions taken by each action"""
+    return _normalize(action_counts(m))
+
+def conditional_counts(m: ActionMatrices) -> np.ndarray:
+    """
+    (..., 4, 5) tutor action counts following each student action.
+
+    A conversation where the student did several things counts its tutor
+    actions once for every student action, as the original loops did.
+    """
+    per_conversation = m.tutor.sum(axis=-2)  # (..., C, 5)
+    return np.einsum('...cs,...ct->...st', m.student.astype(np.int64), per_conversation)
+
+def conditional_distribution(m: ActionMatrices) -> np.ndarray:
+    """(..., 4, 5) P(tutor action | student action), rows sum to 1 (or 0 if unseen)"""
+    return _normalize(conditional_counts(m))
+
+def joint_distribution(m: ActionMatrices) -> np.ndarray:
+    """(..., 4, 5) P(student action, tutor action) over all interactions"""
+    return _normalize(conditional_counts(m), axis=(-2, -1))
+
+def student_action_counts(m: ActionMatrices) -> np.ndarray:
+    """(..., 4) number of conversations with each student action"""
+    return m.student.sum(axis=-2)
+
+def actions_per_response_counts(m: ActionMatrices, max_actions: int = len(TUTOR_ACTION_TYPES)) -> np.ndarray:
+    """(..., max_actions + 1) number of real responses using 0, 1, ... actions"""
+    n_actions = m.tutor.sum(axis=-1)  # (..., C, R)
+    one_hot = n_actions[..., None] == np.arange(max_actions + 1)
+    return (one_hot & m.mask[..., None]).sum(axis=(-3, -2))
+
+def labelled(values: np.ndarray, labels: List[str]) -> Dict[str, float]:
+    """Turn a 1-d array into {label: value}"""
+    return {label: value.item() for label, value in zip(labels, values)}
+
+def labelled_2d(values: np.ndarray, row_labels: List[str], column_labels: List[str]) -> Dict[str, Dict[str, float]]:
+    """Turn a 2-d array into {row label: {column label: value}}"""
+    return {row: labelled(values[i], column_labels) for i, row in enumerate(row_labels)}
@@ -0,0 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from action_matrix import ActionMatrices, _normalize, labelled, labelled_2d
+from data_processing import STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES
+from profiling import stage
+
+FAMILIES = ['marginal', 'conditional', 'actions_per_response']
+MAX_ACTIONS = len(TUTOR_ACTION_TYPES)
+# Elements per (resamples, conversations, responses) array in one batch, about 32 MB of float64
+BATCH_ELEMENTS = 1 << 22
+# Resamples per independently seeded chunk. Fixed, so a seed gives the same results for any `workers`
+SEED_CHUNK = 250
+
+def response_features(m: ActionMatrices, tutor_idx: List[int]) -> np.ndarray:
+    """
+    (C, R, K) per-response features every statistic is a sum of: the selected tutor
+    action flags, then a one-hot of how many actions the response uses. Padding is zero.
+    """
+    flags = m.tutor[..., tutor_idx]
+    n_actions = m.tutor.sum(axis=-1)
+    one_hot = n_actions[..., None] == np.arange(MAX_ACTIONS + 1)
+    return np.concatenate([flags, one_hot], axis=-1) & m.mask[..., None]
+
+def family_counts(conversation_sums: np.ndarray, student: np.ndarray, n_tutor: int) -> np.ndarray:
+    """
+    (..., F) counts for all families from (..., C, K) per-conversation feature sums.
+
+    The columns are the marginal action counts, the actions-per-response histogram,
+    and the flattened student x tutor conditional counts, so one array holds everything.
+    """
+    totals = conversation_sums.sum(axis=-2)
+    conditional = student.T @ conversation_sums[..., :n_tutor]
+    return np.concatenate([totals, conditional.reshape(*conditional.shape[:-2], -1)], axis=-1)
+
+def _per_conversation_counts(conversation_sums: np.ndarray, student: np.ndarray, n_tutor: int) -> np.ndarray:
+    """(C, F) family_counts of each conversation on its own, so weighted sums give resampled counts"""
+    conditional = student[:, :, None] * conversation_sums[:, None, :n_tutor]
+    return np.concatenate([conversation_sums, conditional.reshape(len(student), -1)], axis=-1)
+
+def split_families(counts: np.ndarray, n_student: int, n_tutor: int) -> Dict[str, np.ndarray]:
+    """Normalised distributions for each family from family_counts columns"""
+    return {
+        'marginal': _normalize(counts[..., :n_tutor]),
+        'actions_per_response': _normalize(counts[..., n_tutor:n_tutor + MAX_ACTIONS + 1]),
+        'conditional': _normalize(counts[..., n_tutor + MAX_ACTIONS + 1:].reshape(*counts.shape[:-1], n_student, n_tutor)),
+    }
+
+def total_variation(p: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """Half the L1 distance over the last axis"""
+    return 0.5 * np.abs(p - q).sum(axis=-1)
+
+def _chunks(total: int) -> List[int]:
+    return [min(SEED_CHUNK, total - start) for start in range(0, total, SEED_CHUNK)]
+
+def _run_chunks(fn, total: int, seed, workers: int) -> np.ndarray:
+    """
+    Run fn(n, rng) for SEED_CHUNK-sized chunks of `total` resamples, on threads (NumPy
+    releases the GIL). Every chunk has its own seed, so results don't depend on `workers`
+    """
+    sizes = _chunks(total)
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(len(sizes))]
+    if workers == 1:
+        parts = [fn(n, rng) for n, rng in zip(sizes, rngs)]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(fn, sizes, rngs))
+    return np.concatenate(parts)
+
+def compare(human: ActionMatrices, model: ActionMatrices, n_resamples: int = 2000, n_permutations: int = 2000,
+            confidence: float = 0.95, seed: int = 0, workers: int = 1,
+            student_actions: List[str] = STUDENT_ACTION_TYPES, tutor_actions: List[str] = TUTOR_ACTION_TYPES,
+            chunk: int = None) -> Dict[str, Dict]:
+    """
+    Bootstrap confidence intervals and permutation tests for human vs model action distributions.
+
+    Both corpora must cover the same conversations in the same order (see paired_matrices),
+    so conversations are the resampling unit and the comparison is paired:
+    - Bootstrap: conversations are drawn with replacement as an index array, turned into
+      per-conversation weights, and every statistic is a weighted sum (one matrix product
+      per batch). The same draw is used for both corpora, giving CIs for the difference.
+    - Permutation: within each conversation, the pooled human and model responses are
+      reassigned at random, keeping how many each side had. The statistic is the total
+      variation distance between the two distributions (per student action for
+      'conditional'), plus per-action differences for 'marginal'.
+
+    Multi-label responses are handled by working on response-level flags throughout
+    rather than treating actions as exclusive categories.
+
+    Args:
+        n_resamples: Bootstrap resamples
+        n_permutations: Permutations
+        confidence: Width of the percentile intervals
+        seed: Seed for both procedures
+        workers: Threads to spread resamples over, doesn't change the results
+        student_actions, tutor_actions: Actions to include (distributions are renormalised over them)
+        chunk: Resamples per batch, bounds memory. By default sized to BATCH_ELEMENTS for the corpus
+
+    Returns:
+        {family: {'human', 'model', 'difference', 'human_ci', 'model_ci', 'difference_ci',
+                  'statistic', 'p_value', ...}} with labelled values
+    """
+    if human.student.shape[0] != model.student.shape[0]:
+        raise ValueError("human and model must cover the same conversations, see paired_matrices()")
+
+    student_idx = [STUDENT_ACTION_TYPES.index(a) for a in student_actions]
+    tutor_idx = [TUTOR_ACTION_TYPES.index(a) for a in tutor_actions]
+    n_student, n_tutor = len(student_idx), len(tutor_idx)
+    student = human.student[:, student_idx].astype(np.float64)
+
+    human_features = response_features(human, tutor_idx).astype(np.float64)
+    model_features = response_features(model, tutor_idx).astype(np.float64)
+    human_conv = human_features.sum(axis=1)  # (C, K)
+    model_conv = model_features.sum(axis=1)
+    n_conversations = student.shape[0]
+    slots = n_conversations * (human.mask.shape[1] + model.mask.shape[1])
+    chunk = chunk or max(1, min(1000, BATCH_ELEMENTS // max(slots, 1)))
+
+    human_counts = family_counts(human_conv, student, n_tutor)
+    model_counts = family_counts(model_conv, student, n_tutor)
+    observed_human = split_families(human_counts, n_student, n_tutor)
+    observed_model = split_families(model_counts, n_student, n_tutor)
+
+    # Bootstrap: (B, C) weights from index arrays, then family counts are linear in them
+    conversation_counts_human = _per_conversation_counts(human_conv, student, n_tutor)  # (C, F)
+    conversation_counts_model = _per_conversation_counts(model_conv, student, n_tutor)
+
+    def bootstrap(n, rng):
+        out = []
+        for start in range(0, n, chunk):
+            size = min(chunk, n - start)
+            idx = rng.integers(0, n_conversations, size=(size, n_conversations))
+            rows = np.repeat(np.arange(size), n_conversations)
+            weights = np.bincount(rows * n_conversations + idx.ravel(), minlength=size * n_conversations)
+            weights = weights.reshape(size, n_conversations).astype(np.float64)
+            out.append(np.stack([weights @ conversation_counts_human, weights @ conversation_counts_model], axis=1))
+        return np.concatenate(out)
+
+    with stage('bootstrap'):
+        boot = _run_chunks(bootstrap, n_resamples, [seed, 0], workers)  # (B, 2, F)
+    boot_human = split_families(boot[:, 0], n_student, n_tutor)
+    boot_model = split_families(boot[:, 1], n_student, n_tutor)
+
+    # Permutation: pool each conversation's responses and re-split them
+    pooled = np.concatenate([human_features, model_features], axis=1)  # (C, Rh + Rm, K)
+    pooled_mask = np.concatenate([human.mask, model.mask], axis=1)
+    n_human = human.mask.sum(axis=1)  # (C,)
+    total_conv = human_conv + model_conv
+    picked = (np.arange(pooled_mask.shape[1]) < n_human[:, None]).astype(np.float64)  # (C, R)
+
+    def permute(n, rng):
+        out = []
+        for start in range(0, n, chunk):
+            size = min(chunk, n - start)
+            keys = rng.random((size,) + pooled_mask.shape)
+            keys[:, ~pooled_mask] = np.inf  # Padding sorts last and is never picked
+            # The first n_human slots of each random order go to the human side
+            to_human = np.zeros(keys.shape)
+            np.put_along_axis(to_human, keys.argsort(axis=-1), picked, axis=-1)  # (P, C, R)
+            human_sums = (to_human.transpose(1, 0, 2) @ pooled).transpose(1, 0, 2)  # (P, C, K)
+            out.append(np.stack([
+                family_counts(human_sums, student, n_tutor),
+                family_counts(total_conv - human_sums, student, n_tutor),
+            ], axis=1))
+        return np.concatenate(out)
+
+    with stage('permutation test'):
+        perm = _run_chunks(permute, n_permutations, [seed, 1], workers)  # (P, 2, F)
+    perm_human = split_families(perm[:, 0], n_student, n_tutor)
+    perm_model = split_families(perm[:, 1], n_student, n_tutor)
+
+    alpha = (1 - confidence) / 2
+    labels = {
+        'marginal': (tutor_actions,),
+        'actions_per_response': ([str(n) for n in range(MAX_ACTIONS + 1)],),
+        'conditional': (student_actions, tutor_actions),
+    }
+
+    def label(values, family):
+        return labelled_2d(values, *labels[family]) if family == 'conditional' else labelled(values, *labels[family])
+
+    def interval(samples, family):
+        low, high = np.quantile(samples, [alpha, 1 - alpha], axis=0)
+        return {'low': label(low, family), 'high': label(high, family)}
+
+    def p_values(permuted, observed):
+        # Add-one estimate, never exactly zero
+        return (1 + (permuted >= observed - 1e-12).sum(axis=0)) / (1 + len(permuted))
+
+    results = {}
+    for family in FAMILIES:
+        observed_stat = total_variation(observed_human[family], observed_model[family])
+        permuted_stat = total_variation(perm_human[family], perm_model[family])
+        result = {
+            'human': label(observed_human[family], family),
+            'model': label(observed_model[family], family),
+            'difference': label(observed_model[family] - observed_human[family], family),
+            'human_ci': interval(boot_human[family], family),
+            'model_ci': interval(boot_model[family], family),
+            'difference_ci': interval(boot_model[family] - boot_human[family], family),
+        }
+        if family == 'conditional':
+            result['statistic'] = labelled(observed_stat, student_actions)
+            result['p_value'] = labelled(p_values(permuted_stat, observed_stat), student_actions)
+        else:
+            result['statistic'] = float(observed_stat)
+            result['p_value'] = float(p_values(permuted_stat, observed_stat))
+        if family == 'marginal':
+            observed_diff = np.abs(observed_model[family] - observed_human[family])
+            permuted_diff = np.abs(perm_model[family] - perm_human[family])
+            result['action_p_values'] = label(p_values(permuted_diff, observed_diff), family)
+        results[family] = result
+    return results
+
+def paired_matrices(human: ActionMatrices, data: Dict) -> Tuple[ActionMatrices, ActionMatrices]:
+    """
+    Matrices for a responses file ({conv_id: response or [responses]}) and the human
+    matrices restricted to the same conversations, in the same order.
+
+    Args:
+        human: Matrices for the whole dataset, row i being conversation id i
+               (e.g. ActionMatrices.from_columns(load_columns()))
+    """
+    rows = [int(conv_id) for conv_id in data.keys()]
+    model = ActionMatrices.from_responses(data, human.student)
+    return ActionMatrices(human.student[rows], human.tutor[rows], human.mask[rows]), model
+
+def compare_models(human: ActionMatrices, responses: Dict[str, Dict], **kwargs) -> Dict[str, Dict]:
+    """
+    compare() the human tutors against every model in one call
+
+    Args:
+        human: Matrices for the whole dataset (see paired_matrices)
+        responses: {model name: loaded responses JSON}
+        **kwargs: Passed on to compare()
+    """
+    return {name: compare(*paired_matrices(human, data), **kwargs) for name, data in responses.items()}
@@ -0,0 +1,118 @@
+from typing import Dict, List
+
+import numpy as np
+
+from action_matrix import ActionMatrices
+from data_processing import TUTOR_ACTION_TYPES
+
+def ratings_from_matrices(matrices: List[ActionMatrices]):
+    """
+    Pool the responses of several corpora over the same conversations into one rater set.
+
+    E.g. the CIMA tutors (up to 10 responses per conversation) plus k samples from an
+    LLM give 10 + k raters. Response slots become raters and conversations become items.
+
+    Returns:
+        ratings: (raters, items, actions) bool tensor
+        mask: (raters, items) bool, False where a rater didn't rate an item
+    """
+    ratings = np.concatenate([np.moveaxis(m.tutor, -2, 0) for m in matrices], axis=0)
+    mask = np.concatenate([np.moveaxis(m.mask, -1, 0) for m in matrices], axis=0)
+    return ratings, mask
+
+def _positive_counts(ratings: np.ndarray, mask: np.ndarray):
+    """Raters per item (items,) and raters marking each action per item (items, actions)"""
+    n = mask.sum(axis=0)
+    k = (ratings & mask[..., None]).sum(axis=0)
+    return n, k
+
+def pairwise_agreement(ratings: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    (actions,) share of rater pairs agreeing on each action.
+
+    With n raters of which k marked the action, an item has C(k, 2) + C(n - k, 2)
+    agreeing pairs out of C(n, 2), so no pairs need to be enumerated.
+    """
+    n, k = _positive_counts(ratings, mask)
+    n = n[:, None]
+    agree = (k * (k - 1) + (n - k) * (n - k - 1)).sum(axis=0) / 2
+    total = (n * (n - 1)).sum() / 2
+    return agree / total if total > 0 else np.zeros(ratings.shape[-1])
+
+def exact_match_agreement(ratings: np.ndarray, mask: np.ndarray) -> float:
+    """Share of rater pairs whose full action sets are identical"""
+    # Encode each action set as a bitmask and count equal codes per item
+    codes = (ratings.astype(np.int64) << np.arange(ratings.shape[-1])).sum(axis=-1)  # (raters, items)
+    n_codes = 1 << ratings.shape[-1]
+    code_counts = ((codes[..., None] == np.arange(n_codes)) & mask[..., None]).sum(axis=0)  # (items, codes)
+    agree = (code_counts * (code_counts - 1)).sum() / 2
+    n = mask.sum(axis=0)
+    total = (n * (n - 1)).sum() / 2
+    return float(agree / total) if total > 0 else 0.0
+
+def fleiss_kappa(ratings: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    (actions,) Fleiss' kappa for each action, treating it as a present/absent category.
+
+    Items may have different numbers of raters; items with fewer than two are skipped.
+    Matches statsmodels.stats.inter_rater.fleiss_kappa when every item has the same count.
+    """
+    n, k = _positive_counts(ratings, mask)
+    rated = n >= 2
+    n, k = n[rated, None], k[rated]
+    if len(n) == 0:
+        return np.full(ratings.shape[-1], np.nan)
+
+    # Observed agreement per item, averaged over items
+    p_item = (k * (k - 1) + (n - k) * (n - k - 1)) / (n * (n - 1))
+    p_observed = p_item.mean(axis=0)
+
+    # Chance agreement from the overall category proportions
+    p_yes = k.sum(axis=0) / n.sum()
+    p_expected = p_yes ** 2 + (1 - p_yes) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (p_observed - p_expected) / (1 - p_expected)
+
+def krippendorff_alpha(ratings: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    (actions,) Krippendorff's alpha (nominal) for each action.
+
+    Uses the coincidence-matrix form: alpha = 1 - (N - 1) * D_o / D_e, where D_o is the
+    weight of disagreeing pairable values and D_e the disagreement expected from the
+    pooled value counts. Handles missing ratings natively.
+    """
+    n, k = _positive_counts(ratings, mask)
+    pairable = n >= 2
+    n, k = n[pairable, None], k[pairable]
+    if len(n) == 0:
+        return np.full(ratings.shape[-1], np.nan)
+
+    observed_disagreement = (2 * k * (n - k) / (n - 1)).sum(axis=0)
+    n_yes = k.sum(axis=0)
+    n_total = n.sum()
+    expected_disagreement = 2 * n_yes * (n_total - n_yes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - (n_total - 1) * observed_disagreement / expected_disagreement
+
+def agreement_metrics(ratings: np.ndarray, mask: np.ndarray = None,
+                      action_types: List[str] = TUTOR_ACTION_TYPES) -> Dict:
+    """
+    All agreement metrics for a (raters, items, actions) rating tensor in one call.
+
+    Args:
+        ratings: Boolean tensor of which actions each rater marked on each item
+        mask: (raters, items) which ratings exist. Defaults to all of them
+        action_types: Labels for the last axis of `ratings`
+    """
+    ratings = np.asarray(ratings, dtype=bool)
+    mask = np.ones(ratings.shape[:2], dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+
+    def per_action(values):
+        return {action: float(value) for action, value in zip(action_types, values)}
+
+    return {
+        'overall_agreement': exact_match_agreement(ratings, mask),
+        'per_action_agreement': per_action(pairwise_agreement(ratings, mask)),
+        'fleiss_kappa': per_action(fleiss_kappa(ratings, mask)),
+        'krippendorff_alpha': per_action(krippendorff_alpha(ratings, mask)),
+    }
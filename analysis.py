@@ -1,6 +1,7 @@
 from collections import Counter
 from typing import List
 import matplotlib.pyplot as plt
+from action_matrix import ActionMatrices, action_counts as count_tutor_actions, conditional_distribution, labelled_2d
 from data_processing import ProcessedConversation
 
 def analyze_tutor_action_distribution(conversations: List[ProcessedConversation]):
@@ -10,16 +11,11 @@ def analyze_tutor_action_distribution(conversations: List[ProcessedConversation]
     Each tutor response has 5 possible actions:
     [question, hint, correction, confirmation, other]
     """
-    # Initialize counters for each action type
-    action_counts = Counter()
     action_types = ['Question', 'Hint', 'Correction', 'Confirmation', 'Other']
     
-    # Count occurrences of each action
-    for conv in conversations:
-        for tutor_response in conv.tutor_responses:
-            for action_type, is_present in zip(action_types, tutor_response.actions):
-                if is_present:
-                    action_counts[action_type] += 1
+    # Count occurrences of each action in one pass over the action matrix
+    counts = count_tutor_actions(ActionMatrices.from_conversations(conversations))
+    action_counts = Counter({action_type: int(count) for action_type, count in zip(action_types, counts) if count})
     # Create bar plot
     plt.figure(figsize=(10, 6))
     actions = list(action_counts.keys())
@@ -51,31 +47,9 @@ def analyze_conditional_action_distribution(conversations: List[ProcessedConvers
     student_action_types = ['Guess', 'Question', 'Affirmation', 'Other']
     tutor_action_types = ['Question', 'Hint', 'Correction', 'Confirmation', 'Other']
 
-    def create_conditional_counts(student_actions, tutor_actions):
-        return {
-            student: {tutor: 0 for tutor in tutor_actions}
-            for student in student_actions
-        }
-    
-    conditional_counts = create_conditional_counts(student_action_types, tutor_action_types)
-    
-    # Count occurrences of each tutor action given student action
-    for conv in conversations:
-        for student_action_type, is_student_action in zip(student_action_types, conv.student_actions):
-            is_student_action = is_student_action.lower() == "true"
-            if bool(is_student_action):
-                # For this student action, count all tutor actions that followed
-                for tutor_response in conv.tutor_responses:
-                    for tutor_action_type, is_tutor_action in zip(tutor_action_types, tutor_response.actions):
-                        if is_tutor_action:
-                            conditional_counts[student_action_type][tutor_action_type] += 1
-
-    # Normalize counts to 0-1 range for each student action type
-    for student_action in student_action_types:
-        total = sum(conditional_counts[student_action].values())
-        if total > 0:  # Avoid division by zero
-            for tutor_action in tutor_action_types:
-                conditional_counts[student_action][tutor_action] /= total
+    # Tutor action counts given each student action, normalized to 0-1 per student action
+    distribution = conditional_distribution(ActionMatrices.from_conversations(conversations))
+    conditional_counts = labelled_2d(distribution, student_action_types, tutor_action_types)
 
     # Print conditional distribution
     print("\nConditional Distribution of Tutor Actions Given Student Actions:")
@@ -0,0 +1,241 @@
+import json
+import os
+import time
+from typing import Dict, Hashable, Iterable, Iterator, List, Tuple
+
+from dotenv import load_dotenv
+
+from journal import responses_file_for
+from llm_responses import DEFAULT_BASE_URL, LLMResponse, LLMTutor
+from response_parser import ResponseParseError
+from response_store import DEFAULT_STORE_PATH, ResponseStore
+from transport import shared_http_client
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+DEFAULT_BATCH_DIR = '.cache/batches'
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+def custom_id_for(conv_id: Hashable, sample_idx: int = 0, samples: int = 1) -> str:
+    """Batch line id for a conversation, e.g. '17', or '17:3' for sample 3 of an ensemble"""
+    return str(conv_id) if samples == 1 else f"{conv_id}:{sample_idx}"
+
+def parse_custom_id(custom_id: str) -> Tuple[str, int]:
+    """Inverse of custom_id_for: (conversation id, sample index)"""
+    conv_id, _, sample_idx = custom_id.partition(':')
+    return conv_id, int(sample_idx or 0)
+
+def write_batch_file(path: str, llm_tutor: LLMTutor, model_name: str,
+                     jobs: Iterable[Tuple[Hashable, List[Dict]]], samples: int = 1) -> int:
+    """
+    Write a batch input file with one chat completion request per line
+
+    Args:
+        path: JSONL file to write
+        jobs: Pairs of conversation id and prebuilt messages
+        samples: Requests per conversation. Every sample gets its own line, since
+                 not every provider honours `n`
+
+    Returns:
+        Number of requests written
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for conv_id, messages in jobs:
+            body = llm_tutor._build_request(messages, model_name)
+            for sample_idx in range(samples):
+                f.write(json.dumps({
+                    "custom_id": custom_id_for(conv_id, sample_idx, samples),
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": body
+                }) + '\n')
+                count += 1
+    return count
+
+class BatchGenerator:
+    """
+    Generates responses through the provider's asynchronous Batch API instead of
+    one chat completion per request: the requests for a model are uploaded as one
+    JSONL file, run as a batch job, and the output file is streamed back.
+
+    The id of each submitted batch is kept in `batch_dir`, so a run that is
+    interrupted while waiting picks up the same batch instead of paying for it twice.
+
+    Args:
+        llm_tutor: Supplies the client and the request/response format
+        batch_dir: Where batch input files and submitted batch ids are kept
+        poll_interval: Seconds between status checks
+    """
+
+    def __init__(self, llm_tutor: LLMTutor, batch_dir: str = DEFAULT_BATCH_DIR, poll_interval: float = 30.0):
+        self.llm_tutor = llm_tutor
+        self.client = llm_tutor.client
+        self.batch_dir = batch_dir
+        self.poll_interval = poll_interval
+
+    def _paths(self, model_name: str, samples: int) -> Tuple[str, str]:
+        name = os.path.splitext(os.path.basename(responses_file_for(model_name, samples=samples)))[0]
+        return os.path.join(self.batch_dir, f"{name}.jsonl"), os.path.join(self.batch_dir, f"{name}.batch.json")
+
+    def submit(self, model_name: str, jobs: Iterable[Tuple[Hashable, List[Dict]]], samples: int = 1) -> str:
+        """Upload the requests for a model and start a batch job, returning its id"""
+        input_file, state_file = self._paths(model_name, samples)
+
+        # Resume a batch submitted by an earlier run if it is still usable
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                batch_id = json.load(f)['batch_id']
+            status = self.client.batches.retrieve(batch_id).status
+            if status not in ('failed', 'expired', 'cancelled'):
+                print(f"{model_name}: resuming batch {batch_id} ({status})")
+                return batch_id
+
+        count = write_batch_file(input_file, self.llm_tutor, model_name, jobs, samples)
+        with open(input_file, 'rb') as f:
+            uploaded = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window='24h',
+            metadata={'model': model_name}
+        )
+        with open(state_file, 'w') as f:
+            json.dump({'batch_id': batch.id, 'model': model_name, 'requests': count}, f)
+        print(f"{model_name}: submitted batch {batch.id} with {count} requests")
+        return batch.id
+
+    def wait(self, batch_id: str):
+        """Poll until the batch reaches a terminal status and return it"""
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in TERMINAL_STATUSES:
+                return batch
+            counts = batch.request_counts
+            progress = f" {counts.completed + counts.failed}/{counts.total}" if counts else ""
+            print(f"Batch {batch_id}: {batch.status}{progress}")
+            time.sleep(self.poll_interval)
+
+    def iter_results(self, batch, model_name: str) -> Iterator[Tuple[str, object]]:
+        """
+        Stream (custom_id, LLMResponse or Exception) pairs out of a finished batch's
+        output and error files without loading either into memory
+        """
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            with self.client.files.with_streaming_response.content(file_id) as response:
+                for line in response.iter_lines():
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    result = record.get('response') or {}
+                    if result.get('status_code') != 200:
+                        error = record.get('error') or result.get('body', {}).get('error') or {}
+                        yield record['custom_id'], RuntimeError(
+                            f"status {result.get('status_code')}: {error.get('message', error)}")
+                        continue
+                    content = result['body']['choices'][0]['message']['content']
+                    try:
+                        yield record['custom_id'], self.llm_tutor._parse_response(content, model_name)
+                    except ResponseParseError as e:
+                        yield record['custom_id'], e
+
+    def collect(self, batch_id: str, model_name: str, store: ResponseStore, samples: int = 1) -> Dict[str, Exception]:
+        """
+        Wait for a batch and append its results to the model's response store
+
+        An ensemble is only recorded once all of its samples arrived, so conversations
+        with failed requests are left out and picked up by the next run.
+
+        Returns:
+            Failed requests by custom_id
+        """
+        batch = self.wait(batch_id)
+        if batch.status != 'completed':
+            raise RuntimeError(f"Batch {batch_id} for {model_name} ended as {batch.status}: {batch.errors}")
+
+        failed = {}
+        ensembles: Dict[str, Dict[int, LLMResponse]] = {}
+        for custom_id, result in self.iter_results(batch, model_name):
+            if isinstance(result, Exception):
+                print(f"Failed request {custom_id} for {model_name}: {result}")
+                failed[custom_id] = result
+                continue
+            conv_id, sample_idx = parse_custom_id(custom_id)
+            if samples == 1:
+                store.append(conv_id, to_record(result))
+                continue
+            ensemble = ensembles.setdefault(conv_id, {})
+            ensemble[sample_idx] = result
+            if len(ensemble) == samples:
+                store.append(conv_id, [to_record(ensemble[i]) for i in range(samples)])
+                del ensembles[conv_id]
+
+        # The batch is fully accounted for, the next run submits a fresh one for what's left
+        for path in self._paths(model_name, samples):
+            if os.path.exists(path):
+                os.remove(path)
+        print(f"{model_name}: batch {batch_id} done, {batch.request_counts.completed} completed, {len(failed)} failed")
+        return failed
+
+def to_record(llm_response: LLMResponse) -> dict:
+    """The layout responses are saved in"""
+    return {
+        'response': llm_response.response,
+        'actions': llm_response.actions
+    }
+
+def generate_all_models_batch(processed_conversations, model_names, samples: int = 1,
+                              batch_dir: str = DEFAULT_BATCH_DIR, poll_interval: float = 30.0,
+                              store_path: str = DEFAULT_STORE_PATH):
+    """
+    Generate responses for every model through the Batch API
+
+    Same inputs and outputs as main.generate_all_models: conversations already in a
+    model's responses file are skipped and results go to the same response store.
+    All models' batches are submitted before waiting, so they run side by side.
+
+    The endpoint must implement the OpenAI Files and Batches APIs (/files, /batches),
+    e.g. API_BASE_URL=https://api.openai.com/v1 with the models named as that provider
+    expects, or fake_openai_server.py. OpenRouter, the default endpoint, doesn't, so
+    API_BASE_URL has to be set to something else.
+
+    Raises:
+        ValueError: API_KEY is missing, or API_BASE_URL is unset or points at OpenRouter
+
+    Returns:
+        Failed requests per model, by custom_id
+    """
+    load_dotenv()
+    api_key = os.getenv('API_KEY')
+    if not api_key:
+        raise ValueError("API_KEY not found in environment variables")
+    base_url = os.getenv('API_BASE_URL', DEFAULT_BASE_URL)
+    if base_url.rstrip('/') == DEFAULT_BASE_URL or 'openrouter.ai' in base_url:
+        raise ValueError(f"{base_url} has no Batch API (/files, /batches). Set API_BASE_URL to a "
+                         "batch-capable OpenAI-compatible endpoint, or generate without --batch")
+    llm_tutor = LLMTutor(api_key, base_url=base_url, http_client=shared_http_client())
+    generator = BatchGenerator(llm_tutor, batch_dir, poll_interval)
+
+    stores = {model_name: ResponseStore(model_name, samples, store_path) for model_name in model_names}
+    try:
+        todo = {}
+        for model_name, store in stores.items():
+            todo[model_name] = [i for i in range(len(processed_conversations)) if i not in store]
+            print(f"{model_name}: skipping {len(processed_conversations) - len(todo[model_name])} conversations - already processed")
+
+        needed = sorted(set().union(*todo.values()))
+        messages = dict(zip(needed, llm_tutor.build_messages_batch([processed_conversations[i] for i in needed])))
+
+        batch_ids = {
+            model_name: generator.submit(model_name, ((i, messages[i]) for i in indices), samples)
+            for model_name, indices in todo.items() if indices
+        }
+        return {
+            model_name: generator.collect(batch_id, model_name, stores[model_name], samples)
+            for model_name, batch_id in batch_ids.items()
+        }
+    finally:
+        for store in stores.values():
+            store.close()
@@ -0,0 +1,16 @@
+"""
+Benchmarks for the load, process, analyze, plot and generate hot paths.
+
+    python -m benchmarks.run                      # All benchmarks at 1x and 10x CIMA size
+    python -m benchmarks.run --scales 1 10 100    # Up to 100x
+    python -m benchmarks.run --only 'analyze.*'   # A subset, by glob pattern
+    python -m benchmarks.run --compare HEAD~3     # Against another commit's results
+
+Corpora are synthetic: CIMA conversations resampled up to the requested size (corpus.py).
+Every benchmark is timed over several runs, then run once more under tracemalloc
+for its peak memory. Results go to benchmarks/results/<commit>.json and are compared
+with the previous results file, flagging regressions.
+
+Before timing, the optimised code paths are checked against straightforward loop
+implementations of the same analyses (reference.py, equivalence.py).
+"""
@@ -0,0 +1,56 @@
+import json
+import os
+import random
+from typing import Tuple
+
+from dataset_cache import DEFAULT_SOURCE
+from data_processing import TUTOR_ACTION_TYPES
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Absolute, the runner works from a scratch directory
+DEFAULT_CORPUS_DIR = os.path.join(REPO_ROOT, '.cache', 'benchmarks', 'corpora')
+
+# Roughly how often the models use each tutor action, for synthetic responses files
+ACTION_RATES = [0.3, 0.45, 0.2, 0.1, 0.02]
+
+def make_corpus(scale: float, seed: int = 0, source: str = os.path.join(REPO_ROOT, DEFAULT_SOURCE),
+                corpus_dir: str = DEFAULT_CORPUS_DIR) -> Tuple[str, str]:
+    """
+    Write a synthetic dataset `scale` times the size of CIMA, and a responses file for it
+
+    Conversations are drawn from the real dataset with replacement and renumbered
+    0..n-1, so processing costs what it would on real data. The responses file has
+    one response per conversation with random actions (at ACTION_RATES, at least one).
+    Both are cached by scale and seed.
+
+    Returns:
+        (dataset path, responses path), absolute
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    name = f"cima_x{scale:g}_seed{seed}"
+    dataset_path = os.path.abspath(os.path.join(corpus_dir, f"{name}.json"))
+    responses_path = os.path.abspath(os.path.join(corpus_dir, f"{name}_responses.json"))
+    if os.path.exists(dataset_path) and os.path.exists(responses_path):
+        return dataset_path, responses_path
+
+    with open(source, 'r') as f:
+        conversations = list(json.load(f)['prepDataset'].values())
+    rng = random.Random(seed)
+    n = max(1, int(round(len(conversations) * scale)))
+    sampled = [rng.choice(conversations) for _ in range(n)]
+
+    responses = {}
+    for i, conversation in enumerate(sampled):
+        actions = [a for a, rate in zip(TUTOR_ACTION_TYPES, ACTION_RATES) if rng.random() < rate]
+        responses[str(i)] = {
+            'response': rng.choice(conversation['tutorResponses']),
+            'actions': actions or [rng.choice(TUTOR_ACTION_TYPES[:4])],
+        }
+
+    # Written to temp names first, so an interrupted run never leaves half a corpus behind
+    for path, data in ((dataset_path, {'prepDataset': dict(zip(map(str, range(n)), sampled)), 'shapeDataset': {}}),
+                       (responses_path, responses)):
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+    return dataset_path, responses_path
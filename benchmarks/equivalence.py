@@ -0,0 +1,88 @@
+from typing import List
+
+import numpy as np
+
+from benchmarks import reference
+from benchmarks.suite import Corpus
+
+def _close(a, b, tol: float = 1e-9) -> bool:
+    """Nested dicts/lists of numbers equal up to float rounding"""
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_close(a[k], b[k], tol) for k in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(_close(x, y, tol) for x, y in zip(a, b))
+    if isinstance(a, (int, float, np.number)) and isinstance(b, (int, float, np.number)):
+        return abs(float(a) - float(b)) <= tol
+    return a == b
+
+def check_equivalence(c: Corpus) -> List[str]:
+    """
+    Compare the optimised code paths with the reference loops on a corpus
+
+    Returns:
+        Names of the checks that failed (empty when everything matches)
+    """
+    from action_distribution_analysis import ActionAnalysis
+    from action_matrix import ActionMatrices, marginal_distribution
+    from action_stats import _per_conversation_counts, family_counts, paired_matrices, response_features
+    from analysis import analyze_conditional_action_distribution, analyze_tutor_action_distribution
+    from data_processing import TUTOR_ACTION_TYPES, process_conversation
+    from streaming import stream_conversations
+    from visualization import compute_aggregates
+
+    conversations = c.conversations
+    analysis = ActionAnalysis()
+    checks = {}
+
+    # Loading: the column cache and streaming give what processing the raw JSON gives
+    processed = [process_conversation(conv) for conv in c.raw['prepDataset'].values()]
+    checks['columns == process_conversation'] = conversations == processed
+    checks['stream == process_conversation'] = [conv for _, conv in stream_conversations(c.dataset_path)] == processed
+
+    # Analyses
+    counts = analyze_tutor_action_distribution(conversations)
+    expected = {action.title(): n for action, n in reference.tutor_action_counts(conversations).items()}
+    checks['analyze_tutor_action_distribution'] = dict(counts) == expected
+
+    conditional = analyze_conditional_action_distribution(conversations)
+    expected = reference.conditional_distribution(conversations)
+    checks['analyze_conditional_action_distribution'] = _close(
+        {s.lower(): {t.lower(): v for t, v in row.items()} for s, row in conditional.items()}, expected)
+
+    checks['ActionAnalysis.compute_action_distributions'] = _close(
+        analysis.compute_action_distributions(conversations),
+        reference.action_distributions(conversations, analysis.action_types))
+    checks['ActionAnalysis.compute_conditional_distributions'] = _close(
+        analysis.compute_conditional_distributions(conversations),
+        reference.conditional_distributions(conversations, analysis.action_types))
+
+    # Plot aggregates
+    aggregates = compute_aggregates(c.responses, c.columns.student_actions)
+    student_actions = {i: conv.student_actions for i, conv in enumerate(conversations)}
+    action_counts, per_response, student_counts, pair_counts = reference.aggregates(c.responses, student_actions)
+    checks['compute_aggregates'] = (aggregates.action_counts, aggregates.actions_per_response,
+                                    aggregates.student_action_counts, aggregates.conditional_counts) == \
+        (action_counts, per_response, student_counts, pair_counts)
+
+    # Statistics: weighted bootstrap counts equal recounting resampled conversations
+    human, _ = paired_matrices(c.matrices, c.responses)
+    features = response_features(human, list(range(len(TUTOR_ACTION_TYPES)))).astype(np.float64)
+    conversation_sums = features.sum(axis=1)
+    student = human.student.astype(np.float64)
+    per_conversation = _per_conversation_counts(conversation_sums, student, len(TUTOR_ACTION_TYPES))
+    rng = np.random.default_rng(0)
+    resampled_ok = True
+    for _ in range(5):
+        idx = rng.integers(0, len(student), size=len(student))
+        weights = np.bincount(idx, minlength=len(student)).astype(np.float64)
+        resampled = ActionMatrices(human.student[idx], human.tutor[idx], human.mask[idx])
+        direct = family_counts(conversation_sums[idx], student[idx], len(TUTOR_ACTION_TYPES))
+        n_tutor = len(TUTOR_ACTION_TYPES)
+        resampled_ok &= np.allclose(weights @ per_conversation, direct)
+        resampled_ok &= np.allclose(direct[:n_tutor] / direct[:n_tutor].sum(), marginal_distribution(resampled))
+    checks['action_stats bootstrap counts'] = bool(resampled_ok)
+
+    failed = [name for name, ok in checks.items() if not ok]
+    for name, ok in checks.items():
+        print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+    return failed
@@ -0,0 +1,82 @@
+"""
+Straightforward loop implementations of the analyses, written the way the code
+first computed them. equivalence.py checks the optimised paths against these.
+"""
+from typing import Dict, List, Tuple
+
+from data_processing import STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES, ProcessedConversation
+
+def tutor_action_counts(conversations: List[ProcessedConversation]) -> Dict[str, int]:
+    """Responses using each tutor action (analysis.analyze_tutor_action_distribution)"""
+    counts = {}
+    for conv in conversations:
+        for tutor_response in conv.tutor_responses:
+            for action in tutor_response.actions:
+                counts[action] = counts.get(action, 0) + 1
+    return counts
+
+def conditional_distribution(conversations: List[ProcessedConversation]) -> Dict[str, Dict[str, float]]:
+    """P(tutor action | student action) (analysis.analyze_conditional_action_distribution)"""
+    counts = {student: {tutor: 0 for tutor in TUTOR_ACTION_TYPES} for student in STUDENT_ACTION_TYPES}
+    for conv in conversations:
+        for student_action in conv.student_actions:
+            for tutor_response in conv.tutor_responses:
+                for tutor_action in tutor_response.actions:
+                    counts[student_action][tutor_action] += 1
+
+    for student_action in STUDENT_ACTION_TYPES:
+        total = sum(counts[student_action].values())
+        if total > 0:
+            for tutor_action in TUTOR_ACTION_TYPES:
+                counts[student_action][tutor_action] /= total
+    return counts
+
+def action_distributions(conversations: List[ProcessedConversation], action_types: List[str]) -> Dict[str, float]:
+    """ActionAnalysis.compute_action_distributions"""
+    counts = {action: 0 for action in action_types}
+    total = 0
+    for conv in conversations:
+        for tutor_response in conv.tutor_responses:
+            for action in tutor_response.actions:
+                if action in counts:
+                    counts[action] += 1
+                    total += 1
+    return {k: v / total for k, v in counts.items()}
+
+def conditional_distributions(conversations: List[ProcessedConversation], action_types: List[str]) -> Dict:
+    """ActionAnalysis.compute_conditional_distributions"""
+    result = {}
+    for student_action in ['guess', 'question', 'affirmation']:
+        counts = {action: 0 for action in action_types}
+        total = 0
+        for conv in conversations:
+            if student_action in conv.student_actions:
+                for tutor_response in conv.tutor_responses:
+                    for action in tutor_response.actions:
+                        if action in counts:
+                            counts[action] += 1
+                            total += 1
+        if total > 0:
+            result[student_action] = {k: v / total for k, v in counts.items()}
+    return result
+
+def aggregates(data: Dict, student_actions: Dict[int, List[str]]) -> Tuple[Dict, Dict, Dict, Dict]:
+    """
+    The counts behind the plots, from a responses file (visualization.compute_aggregates)
+
+    Returns:
+        (action counts, actions per response, student action counts, conditional counts)
+    """
+    action_counts, per_response, student_counts, pair_counts = {}, {}, {}, {}
+    for conv_id, conv_data in data.items():
+        responses = conv_data if isinstance(conv_data, list) else [conv_data]
+        students = student_actions.get(int(conv_id), [])
+        for student_action in students:
+            student_counts[student_action] = student_counts.get(student_action, 0) + 1
+        for response in responses:
+            per_response[len(response['actions'])] = per_response.get(len(response['actions']), 0) + 1
+            for action in response['actions']:
+                action_counts[action] = action_counts.get(action, 0) + 1
+                for student_action in students:
+                    pair_counts[(student_action, action)] = pair_counts.get((student_action, action), 0) + 1
+    return action_counts, per_response, student_counts, pair_counts
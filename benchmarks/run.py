@@ -0,0 +1,217 @@
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from fnmatch import fnmatch
+from typing import Dict, List, Optional
+
+from benchmarks.corpus import REPO_ROOT
+
+RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+def git_commit() -> str:
+    """Short hash of HEAD, with '-dirty' when tracked files have uncommitted changes"""
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return f"{commit}-dirty" if git('status', '--porcelain', '--untracked-files=no') else commit
+
+@contextlib.contextmanager
+def quiet():
+    """Hide what the benchmarked code prints"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def time_benchmark(bench, corpus, repeats: int, max_time: float, memory: bool) -> Dict:
+    """
+    Time `repeats` runs of a benchmark (fewer once they've taken max_time seconds)
+    and, with memory=True, one more under tracemalloc for the peak allocation
+    """
+    times = []
+    for _ in range(repeats):
+        with quiet():
+            prepared = bench.setup(corpus) if bench.setup else None
+            gc.collect()
+            started = time.perf_counter()
+            bench.fn(corpus, prepared)
+            times.append(time.perf_counter() - started)
+        if sum(times) >= max_time:
+            break
+
+    result = {'median': statistics.median(times), 'min': min(times), 'runs': len(times)}
+    if memory:
+        with quiet():
+            prepared = bench.setup(corpus) if bench.setup else None
+            gc.collect()
+            tracemalloc.start()
+            try:
+                bench.fn(corpus, prepared)
+                result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            finally:
+                tracemalloc.stop()
+    return result
+
+def run_suite(scales: List[float], patterns: List[str] = None, repeats: int = 5, max_time: float = 10.0,
+              memory: bool = True, seed: int = 0, check: bool = True) -> Dict[str, Dict[str, Dict]]:
+    """
+    Run the selected benchmarks at every scale
+
+    Returns:
+        {benchmark name: {scale: {'median', 'min', 'runs', 'peak_mb'} or {'error'}}}
+    """
+    from benchmarks.equivalence import check_equivalence
+    from benchmarks.suite import BENCHMARKS, Corpus
+
+    selected = [b for b in BENCHMARKS if not patterns or any(fnmatch(b.name, p) for p in patterns)]
+    results: Dict[str, Dict[str, Dict]] = {}
+    work_dir = tempfile.mkdtemp(prefix='cima-bench-')
+    cwd = os.getcwd()
+    os.chdir(work_dir)  # Some of the benchmarked code writes to the working directory
+    try:
+        for i, scale in enumerate(sorted(scales)):
+            corpus = Corpus(scale, seed, tempfile.mkdtemp(dir=work_dir))
+            print(f"\nScale {scale:g}x ({corpus.dataset_path})")
+            if check and i == 0:
+                print("Checking optimised paths against the reference implementations")
+                with quiet():
+                    failed = check_equivalence(corpus)
+                for name in failed:
+                    print(f"  FAIL {name}")
+                if failed:
+                    raise SystemExit(f"{len(failed)} equivalence checks failed")
+                print("  all equivalent")
+
+            for bench in selected:
+                if not bench.scaled and i > 0:
+                    continue
+                try:
+                    result = time_benchmark(bench, corpus, repeats, max_time, memory)
+                except Exception as e:
+                    result = {'error': f"{type(e).__name__}: {e}"}
+                results.setdefault(bench.name, {})[f"{scale:g}" if bench.scaled else 'any'] = result
+                print(format_result(bench.name, scale if bench.scaled else None, result))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def format_result(name: str, scale: Optional[float], result: Dict) -> str:
+    label = f"{name} [{'any' if scale is None else f'{scale:g}x'}]"
+    if 'error' in result:
+        return f"  {label:<50} ERROR {result['error']}"
+    memory = f"  peak {result['peak_mb']:8.1f} MB" if 'peak_mb' in result else ""
+    return f"  {label:<50} {result['median'] * 1000:10.1f} ms (min {result['min'] * 1000:.1f}, {result['runs']} runs){memory}"
+
+def save_results(benchmarks: Dict, commit: str, results_dir: str = RESULTS_DIR) -> str:
+    """Write (or update) benchmarks/results/<commit>.json"""
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{commit}.json")
+    record = {'benchmarks': {}}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            record = json.load(f)
+    for name, by_scale in benchmarks.items():
+        record['benchmarks'].setdefault(name, {}).update(by_scale)
+    record.update({
+        'commit': commit,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'machine': f"{platform.system()} {platform.machine()}, {os.cpu_count()} cores",
+    })
+    with open(path, 'w') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+    return path
+
+def find_baseline(ref: Optional[str], current: str, results_dir: str = RESULTS_DIR) -> Optional[str]:
+    """
+    Results file to compare with: a path, a git revision, or by default the most recent
+    results of another commit
+    """
+    if ref:
+        if os.path.exists(ref):
+            return ref
+        commit = subprocess.run(['git', 'rev-parse', '--short', ref], cwd=REPO_ROOT,
+                                capture_output=True, text=True).stdout.strip() or ref
+        path = os.path.join(results_dir, f"{commit}.json")
+        return path if os.path.exists(path) else None
+
+    candidates = []
+    for filename in os.listdir(results_dir) if os.path.isdir(results_dir) else []:
+        if filename.endswith('.json') and filename != f"{current}.json":
+            with open(os.path.join(results_dir, filename), 'r') as f:
+                candidates.append((json.load(f).get('timestamp', 0), os.path.join(results_dir, filename)))
+    return max(candidates)[1] if candidates else None
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = 1.2) -> List[str]:
+    """
+    Print current vs baseline medians and return the benchmarks that got slower than threshold x
+
+    Returns:
+        'name [scale]' for each regression
+    """
+    regressions = []
+    print(f"\n{'benchmark':<50} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, by_scale in current.items():
+        for scale, result in by_scale.items():
+            before = baseline.get(name, {}).get(scale)
+            if not before or 'median' not in before or 'median' not in result:
+                continue
+            ratio = result['median'] / max(before['median'], 1e-12)
+            flag = ''
+            if ratio > threshold:
+                flag = '  REGRESSION'
+                regressions.append(f"{name} [{scale}]")
+            elif ratio < 1 / threshold:
+                flag = '  faster'
+            print(f"{f'{name} [{scale}]':<50} {before['median'] * 1000:8.1f}ms {result['median'] * 1000:8.1f}ms "
+                  f"{ratio:6.2f}x{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the load, process, analyze, plot and generate paths")
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10], help="Corpus sizes, in multiples of CIMA")
+    parser.add_argument('--only', nargs='+', help="Benchmark name patterns, e.g. 'analyze.*'")
+    parser.add_argument('--repeats', type=int, default=5, help="Timed runs per benchmark")
+    parser.add_argument('--max-time', type=float, default=10.0, help="Stop repeating once runs took this many seconds")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc run")
+    parser.add_argument('--no-check', action='store_true', help="Skip the equivalence checks")
+    parser.add_argument('--seed', type=int, default=0, help="Corpus seed")
+    parser.add_argument('--compare', metavar='REF', help="Results to compare with: git revision or file (default: latest)")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Slowdown ratio reported as a regression")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Exit with status 1 on regressions")
+    parser.add_argument('--no-save', action='store_true', help="Don't write benchmarks/results/<commit>.json")
+    args = parser.parse_args(argv)
+
+    # Headless plotting before anything imports pyplot
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    commit = git_commit()
+    results = run_suite(args.scales, args.only, args.repeats, args.max_time, not args.no_memory, args.seed,
+                        not args.no_check)
+    if not args.no_save:
+        print(f"\nSaved {save_results(results, commit)}")
+
+    baseline_path = find_baseline(args.compare, commit)
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {baseline.get('commit', baseline_path)}")
+        regressions = compare_results(baseline['benchmarks'], results, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+            if args.fail_on_regression:
+                sys.exit(1)
+    elif args.compare:
+        print(f"\nNo results found for {args.compare}")
+
+if __name__ == "__main__":
+    main()
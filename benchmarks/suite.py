@@ -0,0 +1,237 @@
+import json
+import os
+import tempfile
+from dataclasses import dataclass, replace
+from functools import cached_property
+from typing import Callable, List
+
+from benchmarks.corpus import make_corpus
+
+@dataclass
+class Benchmark:
+    """
+    One timed operation: fn(corpus, prepared) where prepared = setup(corpus), run before each timing
+
+    Benchmarks with scaled=False don't depend on the corpus size and only run once per
+    suite run, at the smallest scale.
+    """
+    name: str
+    fn: Callable
+    setup: Callable = None
+    scaled: bool = True
+
+class Corpus:
+    """A synthetic corpus and everything derived from it, computed on first use and kept for later benchmarks"""
+
+    def __init__(self, scale: float, seed: int, work_dir: str):
+        self.scale = scale
+        self.work_dir = work_dir
+        self.cache_dir = os.path.join(work_dir, '.cache')
+        self.dataset_path, self.responses_path = make_corpus(scale, seed)
+
+    def temp_dir(self) -> str:
+        return tempfile.mkdtemp(dir=self.work_dir)
+
+    @cached_property
+    def raw(self):
+        with open(self.dataset_path, 'r') as f:
+            return json.load(f)
+
+    @cached_property
+    def columns(self):
+        from dataset_cache import load_columns
+        return load_columns(self.dataset_path, self.cache_dir)
+
+    @cached_property
+    def conversations(self):
+        return self.columns.to_conversations()
+
+    @cached_property
+    def model_conversations(self):
+        """The conversations with the synthetic model response as their only tutor response"""
+        from data_processing import TutorResponse
+        return [
+            replace(conv, tutor_responses=(TutorResponse.from_actions(record['response'], record['actions']),))
+            for conv, record in zip(self.conversations, self.responses.values())
+        ]
+
+    @cached_property
+    def matrices(self):
+        from action_matrix import ActionMatrices
+        return ActionMatrices.from_columns(self.columns)
+
+    @cached_property
+    def responses(self):
+        with open(self.responses_path, 'r') as f:
+            return json.load(f)
+
+    @cached_property
+    def aggregates(self):
+        from visualization import compute_aggregates
+        return compute_aggregates(self.responses, self.columns.student_actions)
+
+# Load and parse
+
+def load_json(c: Corpus, _):
+    with open(c.dataset_path, 'r') as f:
+        json.load(f)
+
+def load_columns_cold(c: Corpus, cache_dir):
+    from dataset_cache import load_columns
+    load_columns(c.dataset_path, cache_dir)
+
+def load_columns_warm(c: Corpus, _):
+    from dataset_cache import load_columns
+    load_columns(c.dataset_path, c.cache_dir)
+
+def warm_columns(c: Corpus):
+    c.columns
+
+# Process
+
+def process_conversations(c: Corpus, _):
+    from main import process_all_conversations
+    process_all_conversations(c.raw)
+
+def process_from_columns(c: Corpus, _):
+    c.columns.to_conversations()
+
+def process_stream(c: Corpus, _):
+    from streaming import stream_conversations
+    for _ in stream_conversations(c.dataset_path):
+        pass
+
+# Analyze
+
+def warm_conversations(c: Corpus):
+    c.conversations
+
+def analyze_tutor_actions(c: Corpus, _):
+    from analysis import analyze_tutor_action_distribution
+    analyze_tutor_action_distribution(c.conversations)
+
+def analyze_conditional(c: Corpus, _):
+    from analysis import analyze_conditional_action_distribution
+    analyze_conditional_action_distribution(c.conversations)
+
+def action_analysis_distributions(c: Corpus, _):
+    from action_distribution_analysis import ActionAnalysis
+    ActionAnalysis().compute_action_distributions(c.conversations)
+
+def action_analysis_conditional(c: Corpus, _):
+    from action_distribution_analysis import ActionAnalysis
+    ActionAnalysis().compute_conditional_distributions(c.conversations)
+
+def action_analysis_agreement(c: Corpus, _):
+    from action_distribution_analysis import ActionAnalysis
+    ActionAnalysis().compute_agreement_metrics(c.conversations)
+
+def warm_model_conversations(c: Corpus):
+    c.model_conversations
+
+def action_analysis_comparison(c: Corpus, _):
+    from action_distribution_analysis import ActionAnalysis
+    ActionAnalysis().statistical_comparison(c.conversations, c.model_conversations, n_resamples=500)
+
+def warm_matrices(c: Corpus):
+    c.matrices, c.responses
+
+def compare_stats(c: Corpus, _):
+    from action_stats import compare, paired_matrices
+    compare(*paired_matrices(c.matrices, c.responses), n_resamples=1000, n_permutations=1000)
+
+def compute_aggregates(c: Corpus, _):
+    from visualization import compute_aggregates
+    compute_aggregates(c.responses, c.columns.student_actions)
+
+def warm_responses(c: Corpus):
+    c.responses, c.columns
+
+def analyse_stream(c: Corpus, _):
+    from streaming import analyse_stream, stream_conversations
+    analyse_stream(stream_conversations(c.dataset_path))
+
+# Plot
+
+def prepare_plot(c: Corpus):
+    c.aggregates
+    return c.temp_dir()
+
+def plot_action_distribution(c: Corpus, output_dir):
+    from visualization import render_action_distribution
+    render_action_distribution(c.aggregates, "Action Distribution - Benchmark", output_dir)
+
+def plot_actions_per_response(c: Corpus, output_dir):
+    from visualization import render_actions_per_response
+    render_actions_per_response(c.aggregates, "Actions per Response - Benchmark", output_dir)
+
+def plot_conditional(c: Corpus, output_dir):
+    from visualization import render_conditional_distribution
+    render_conditional_distribution(c.aggregates, "Interaction Flow - Benchmark", output_dir)
+
+def prepare_combine(c: Corpus):
+    """A folder of 16 rendered figures"""
+    from visualization import render_action_distribution
+    folder = os.path.join(c.work_dir, 'combine_input')
+    if not os.path.isdir(folder):
+        for i in range(16):
+            render_action_distribution(c.aggregates, f"Figure {i:02d}", folder)
+    return folder
+
+def combine_plots(c: Corpus, folder):
+    from pretty_plots import combine_plots_from_folder
+    combine_plots_from_folder(folder, 'benchmark.png')
+
+# Generate
+
+GENERATE_CONVERSATIONS = 200
+GENERATE_MODELS = ['bench/model-a', 'bench/model-b']
+
+def prepare_generate(c: Corpus):
+    """Fake server, environment and a fresh run directory (responses files are written under data/)"""
+    from fake_openai_server import FakeOpenAIServer
+
+    c.conversations
+    if not hasattr(c, 'fake_server'):
+        c.fake_server = FakeOpenAIServer(latency=0.005).start()
+        os.environ['API_KEY'] = 'benchmark'
+        os.environ['API_BASE_URL'] = c.fake_server.base_url
+    run_dir = c.temp_dir()
+    os.makedirs(os.path.join(run_dir, 'data'))
+    return run_dir
+
+def generate_end_to_end(c: Corpus, run_dir):
+    from generation import GenerationConfig
+    from main import generate_all_models
+
+    config = GenerationConfig(concurrency=16, requests_per_second=1000.0, burst=64)
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        generate_all_models(c.conversations[:GENERATE_CONVERSATIONS], GENERATE_MODELS, config,
+                            cache_path='cache.sqlite', metrics_file='metrics.jsonl', store_path='data/responses.sqlite')
+    finally:
+        os.chdir(cwd)
+
+BENCHMARKS: List[Benchmark] = [
+    Benchmark('load.json', load_json),
+    Benchmark('load.columns_cold', load_columns_cold, setup=lambda c: c.temp_dir()),
+    Benchmark('load.columns_warm', load_columns_warm, setup=warm_columns),
+    Benchmark('process.conversations', process_conversations, setup=lambda c: c.raw),
+    Benchmark('process.from_columns', process_from_columns, setup=warm_columns),
+    Benchmark('process.stream', process_stream),
+    Benchmark('analyze.tutor_action_distribution', analyze_tutor_actions, setup=warm_conversations),
+    Benchmark('analyze.conditional_action_distribution', analyze_conditional, setup=warm_conversations),
+    Benchmark('analyze.action_distributions', action_analysis_distributions, setup=warm_conversations),
+    Benchmark('analyze.conditional_distributions', action_analysis_conditional, setup=warm_conversations),
+    Benchmark('analyze.agreement_metrics', action_analysis_agreement, setup=warm_conversations),
+    Benchmark('analyze.statistical_comparison', action_analysis_comparison, setup=warm_model_conversations),
+    Benchmark('analyze.action_stats_compare', compare_stats, setup=warm_matrices),
+    Benchmark('analyze.compute_aggregates', compute_aggregates, setup=warm_responses),
+    Benchmark('analyze.stream', analyse_stream),
+    Benchmark('plot.action_distribution', plot_action_distribution, setup=prepare_plot),
+    Benchmark('plot.actions_per_response', plot_actions_per_response, setup=prepare_plot),
+    Benchmark('plot.conditional_flow', plot_conditional, setup=prepare_plot),
+    Benchmark('plot.combine', combine_plots, setup=prepare_combine, scaled=False),
+    Benchmark('generate.end_to_end', generate_end_to_end, setup=prepare_generate, scaled=False),
+]
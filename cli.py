@@ -0,0 +1,266 @@
+"""
+Command line entry point for the whole pipeline.
+
+    python cli.py generate [--models ...] [--samples N] [--batch] ...
+    python cli.py analyze [responses files ...] [--resamples N]
+    python cli.py plot [--force]
+    python cli.py transform [--output FILE]
+    python cli.py combine
+    python cli.py pipeline [--dry-run] [stage patterns ...]
+    python cli.py startup
+    python cli.py --profile DIR <command> ...   (see profiling.py)
+
+Only argparse is imported up front. Each command imports what it needs when it runs,
+so `--help` and `analyze` (NumPy only) don't pay for openai, pandas, seaborn or
+matplotlib. `startup` checks those import times against STARTUP_BUDGET_MS.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+DEFAULT_SOURCE = 'data/cima_dataset.json'  # Same as dataset_cache.DEFAULT_SOURCE, not imported to keep startup light
+PLOT_FOLDERS = ['action_dist', 'actions_per_response', 'conditional_flows']
+
+# Startup budget for --help and the analytics commands, checked by `cli.py startup`
+STARTUP_BUDGET_MS = 300
+# What `analyze` imports, kept free of the plotting and API client stacks
+ANALYTICS_MODULES = ['action_stats', 'dataset_cache']
+
+def cmd_generate(args):
+    from dataset_cache import load_processed_conversations
+    from main import MODEL_NAMES, generate_all_models
+
+    model_names = args.models or MODEL_NAMES
+    conversations = load_processed_conversations(args.source)
+    # Paths left unset keep the defaults of the generation functions
+    paths = {key: value for key, value in (('store_path', args.store), ('cache_path', args.cache)) if value}
+    if args.local_model:
+        if args.batch or args.models:
+            sys.exit("--local-model generates with that one model, without --batch or --models")
+        from generation import GenerationConfig
+        from local_backend import LocalBackend, TransformersModel
+
+        model = TransformersModel(args.local_model, gguf_file=args.gguf_file, threads=args.threads)
+        backend = LocalBackend(model, max_batch=args.max_batch, max_new_tokens=args.max_new_tokens,
+                               temperature=args.temperature)
+        # Twice the batch in flight keeps a request waiting for every slot that frees up, no rate limit
+        config = GenerationConfig(concurrency=2 * args.max_batch, requests_per_second=1e6,
+                                  burst=2 * args.max_batch)
+        try:
+            generate_all_models(conversations, [args.local_model], config, samples=args.samples,
+                                backend=backend, **paths)
+        finally:
+            backend.close()
+    elif args.batch:
+        from batch_generation import generate_all_models_batch
+        paths.pop('cache_path', None)  # Batch results don't go through the completion cache
+        generate_all_models_batch(conversations, model_names, samples=args.samples, **paths)
+    else:
+        generate_all_models(conversations, model_names, replay=args.replay, samples=args.samples,
+                            stream=args.stream, **paths)
+
+def cmd_analyze(args):
+    from action_matrix import (ActionMatrices, actions_per_response_counts, conditional_distribution, labelled,
+                               labelled_2d, marginal_distribution)
+    from action_stats import compare_models
+    from data_processing import STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES
+    from dataset_cache import load_columns
+
+    human = ActionMatrices.from_columns(load_columns(args.source))
+    files = args.files or sorted(glob.glob('data/*_responses.json'))
+    responses = {}
+    for path in files:
+        with open(path, 'r', encoding='utf-8') as f:
+            responses[os.path.basename(path).replace('_responses.json', '')] = json.load(f)
+
+    def describe(m):
+        per_response = actions_per_response_counts(m)
+        return {
+            'marginal': labelled(marginal_distribution(m), TUTOR_ACTION_TYPES),
+            'conditional': labelled_2d(conditional_distribution(m), STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES),
+            'actions_per_response': labelled(per_response / max(per_response.sum(), 1), [str(n) for n in range(len(per_response))]),
+        }
+
+    result = {'distributions': {'human': describe(human)}}
+    for name, data in responses.items():
+        result['distributions'][name] = describe(ActionMatrices.from_responses(data, human.student))
+    if args.resamples > 0:
+        result['comparisons'] = compare_models(human, responses, n_resamples=args.resamples,
+                                               n_permutations=args.resamples, seed=args.seed, workers=args.workers)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"Wrote {args.output}")
+    else:
+        print(output)
+
+def cmd_plot(args):
+    from visualization import SOURCES, plot_all_sources
+
+    sources = [tuple(pair) for pair in args.sources] if args.sources else SOURCES
+    os.makedirs(args.plots_dir, exist_ok=True)
+    plot_all_sources(sources, plots_dir=args.plots_dir, workers=args.workers, force=args.force)
+
+def cmd_transform(args):
+    from dataset_cache import load_columns
+    from transform_cima import transform_columns_to_gemini_format
+
+    # Read the processed dataset from the column cache instead of re-parsing the JSON
+    output_data = transform_columns_to_gemini_format(load_columns(args.source))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(output_data, f, indent=2, ensure_ascii=False)
+    print(f"Wrote {len(output_data)} conversations to {args.output}")
+
+def cmd_combine(args):
+    from pretty_plots import combine_plots_from_folder
+
+    for folder in args.folders:
+        combine_plots_from_folder(os.path.join(args.plots_dir, folder), f'{folder}.png',
+                                  rows_per_tile=args.rows_per_tile, workers=args.workers)
+
+def cmd_pipeline(args):
+    from pipeline import run_pipeline
+
+    status = run_pipeline(workers=args.workers, force=args.force, targets=args.targets, dry_run=args.dry_run,
+                          dataset=args.source, n_resamples=args.resamples, seed=args.seed)
+    if 'failed' in status.values():
+        sys.exit(1)
+
+def measure_startup(argv, runs: int = 5):
+    """
+    Best-of-`runs` wall time in ms of running a Python command, and its slowest imports
+
+    Returns:
+        (milliseconds, [(cumulative import ms, module)] for the 5 slowest top-level imports)
+    """
+    import subprocess
+    import time
+
+    best, imports = float('inf'), []
+    for _ in range(runs):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime'] + argv, capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed = (time.perf_counter() - started) * 1000
+        if proc.returncode != 0:
+            raise RuntimeError(f"{argv} failed: {proc.stderr[-500:]}")
+        if elapsed < best:
+            best = elapsed
+            # Lines look like "import time:  self [us] | cumulative | <indent>package"
+            imports = []
+            for line in proc.stderr.splitlines():
+                parts = line.split('|')
+                if line.startswith('import time:') and len(parts) == 3 and parts[1].strip().isdigit():
+                    name = parts[2].rstrip()
+                    if not name.startswith('  '):  # Top-level imports only
+                        imports.append((int(parts[1]) / 1000, name.strip()))
+            imports = sorted(imports, reverse=True)[:5]
+    return best, imports
+
+def cmd_startup(args):
+    checks = [
+        ('cli.py --help', ['cli.py', '--help']),
+        ('analyze imports', ['-c', f"import cli, {', '.join(ANALYTICS_MODULES)}"]),
+    ]
+    failed = False
+    for label, argv in checks:
+        elapsed, imports = measure_startup(argv)
+        ok = elapsed <= args.budget
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'SLOW'} {label}: {elapsed:.0f} ms (budget {args.budget} ms)")
+        if not ok or args.verbose:
+            for ms, name in imports:
+                print(f"       {ms:7.1f} ms  {name}")
+    if failed:
+        sys.exit(1)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="CIMA tutor action analysis pipeline")
+    parser.add_argument('--profile', metavar='DIR', help="Profile the command and write stage timings, a flamegraph "
+                                                        "(profile.collapsed) and memory snapshots to DIR")
+    parser.add_argument('--profile-tracer', choices=['cprofile', 'pyinstrument', 'none'], default='cprofile',
+                        help="Deterministic profiler to run alongside the sampler")
+    parser.add_argument('--profile-no-memory', action='store_true', help="Skip the tracemalloc snapshots")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help="Generate model responses for every conversation")
+    generate.add_argument('--models', nargs='+', help="Models to run (default: main.MODEL_NAMES)")
+    generate.add_argument('--samples', type=int, default=1, help="Responses per conversation (ensembles if > 1)")
+    generate.add_argument('--source', default=DEFAULT_SOURCE, help="Dataset file")
+    generate.add_argument('--store', help="Response store database (default: response_store.DEFAULT_STORE_PATH)")
+    generate.add_argument('--cache', help="Completion cache database (default: response_cache.DEFAULT_CACHE_PATH)")
+    generate.add_argument('--replay', action='store_true', help="Serve everything from the cache, make no API calls")
+    generate.add_argument('--stream', action='store_true', help="Stream completions and abandon malformed ones early")
+    generate.add_argument('--batch', action='store_true', help="Use the Batch API instead of live requests (API_BASE_URL must support /files and /batches, OpenRouter doesn't)")
+    generate.add_argument('--local-model', help="Generate offline with this Hugging Face model (id or directory) on CPU")
+    generate.add_argument('--gguf-file', help="GGUF checkpoint in --local-model to load")
+    generate.add_argument('--max-batch', type=int, default=8, help="Sequences decoded together by --local-model")
+    generate.add_argument('--max-new-tokens', type=int, default=512)
+    generate.add_argument('--temperature', type=float, default=1.0, help="Sampling temperature for --local-model, 0 for greedy")
+    generate.add_argument('--threads', type=int, help="CPU threads for --local-model (default: torch's choice)")
+    generate.set_defaults(func=cmd_generate)
+
+    analyze = subparsers.add_parser('analyze', help="Action distributions and human vs model statistics")
+    analyze.add_argument('files', nargs='*', help="Responses files (default: data/*_responses.json)")
+    analyze.add_argument('--source', default=DEFAULT_SOURCE, help="Dataset file with the human tutor responses")
+    analyze.add_argument('--resamples', type=int, default=2000, help="Bootstrap resamples and permutations, 0 to skip the tests")
+    analyze.add_argument('--seed', type=int, default=0)
+    analyze.add_argument('--workers', type=int, default=1, help="Threads for resampling")
+    analyze.add_argument('--output', help="Write JSON here instead of stdout")
+    analyze.set_defaults(func=cmd_analyze)
+
+    plot = subparsers.add_parser('plot', help="Render the distribution plots for every source")
+    plot.add_argument('--source', dest='sources', nargs=2, action='append', metavar=('FILE', 'NAME'),
+                      help="Responses file and display name, repeatable (default: visualization.SOURCES)")
+    plot.add_argument('--plots-dir', default='plots')
+    plot.add_argument('--workers', type=int, help="Render processes (default: one per core)")
+    plot.add_argument('--force', action='store_true', help="Redraw figures that are up to date")
+    plot.set_defaults(func=cmd_plot)
+
+    transform = subparsers.add_parser('transform', help="Write the dataset in the model responses layout")
+    transform.add_argument('--source', default=DEFAULT_SOURCE, help="Dataset file")
+    transform.add_argument('--output', default='cima_gemini_format.json')
+    transform.set_defaults(func=cmd_transform)
+
+    combine = subparsers.add_parser('combine', help="Combine each plot folder into one grid image")
+    combine.add_argument('folders', nargs='*', default=PLOT_FOLDERS, help=f"Folders under --plots-dir (default: {' '.join(PLOT_FOLDERS)})")
+    combine.add_argument('--plots-dir', default='plots')
+    combine.add_argument('--rows-per-tile', type=int, help="Write the grid in strips of this many rows")
+    combine.add_argument('--workers', type=int, help="Image decoding threads")
+    combine.set_defaults(func=cmd_combine)
+
+    pipeline = subparsers.add_parser('pipeline', help="Rebuild whatever is out of date: baseline, aggregates, figures, grids, stats")
+    pipeline.add_argument('targets', nargs='*', help="Stage name patterns to build, e.g. 'figures:*' (default: all)")
+    pipeline.add_argument('--source', default=DEFAULT_SOURCE, help="Dataset file")
+    pipeline.add_argument('--resamples', type=int, default=2000, help="Bootstrap resamples and permutations for the stats stages")
+    pipeline.add_argument('--seed', type=int, default=0)
+    pipeline.add_argument('--workers', type=int, help="Worker processes (default: one per core)")
+    pipeline.add_argument('--force', action='store_true', help="Re-run every selected stage")
+    pipeline.add_argument('--dry-run', action='store_true', help="Only list which stages are out of date")
+    pipeline.set_defaults(func=cmd_pipeline)
+
+    startup = subparsers.add_parser('startup', help="Check that --help and analyze start within the time budget")
+    startup.add_argument('--budget', type=float, default=STARTUP_BUDGET_MS, help="Budget in ms")
+    startup.add_argument('--verbose', action='store_true', help="Show the slowest imports even when within budget")
+    startup.set_defaults(func=cmd_startup)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not args.profile:
+        args.func(args)
+        return
+
+    import profiling
+    tracer = None if args.profile_tracer == 'none' else args.profile_tracer
+    with profiling.enabled(args.profile, tracer=tracer, memory=not args.profile_no_memory):
+        with profiling.stage(args.command):
+            args.func(args)
+
+if __name__ == "__main__":
+    main()
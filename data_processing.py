@@ -1,25 +1,97 @@
 from dataclasses import dataclass
 import json
-from typing import List, Dict, Optional, Tuple
+from typing import Iterator, List, Dict, Optional, Tuple
 from enum import Enum
 import ast
+import sys
 
-@dataclass
+from profiling import stage
+
+try:
+    import ijson
+except ImportError:  # Optional, only needed to stream datasets too large to load at once
+    ijson = None
+
+STUDENT_ACTION_TYPES = ['guess', 'question', 'affirmation', 'other']
+TUTOR_ACTION_TYPES = ['question', 'hint', 'correction', 'confirmation', 'other']
+
+# Single-bit masks, e.g. TUTOR_ACTION_BITS['hint'] == 0b10
+STUDENT_ACTION_BITS = {action: 1 << i for i, action in enumerate(STUDENT_ACTION_TYPES)}
+TUTOR_ACTION_BITS = {action: 1 << i for i, action in enumerate(TUTOR_ACTION_TYPES)}
+
+def encode_actions(actions: List[str], action_types: List[str]) -> int:
+    """Pack a list of action names into a bitmask (bit i is action_types[i])"""
+    mask = 0
+    for action in actions:
+        mask |= 1 << action_types.index(action.lower())
+    return mask
+
+def decode_actions(mask: int, action_types: List[str]) -> List[str]:
+    """Unpack a bitmask into the list of action names, in action_types order"""
+    return [action for i, action in enumerate(action_types) if mask >> i & 1]
+
+@dataclass(frozen=True, slots=True)
 class TutorResponse:
     """A single tutor's response and their actions"""
     response: str
-    actions: List[bool]  # [question, hint, correction, confirmation, other]
+    action_mask: int  # Bits over TUTOR_ACTION_TYPES: [question, hint, correction, confirmation, other]
+
+    @classmethod
+    def from_actions(cls, response: str, actions: List[str]) -> 'TutorResponse':
+        return cls(response, encode_actions(actions, TUTOR_ACTION_TYPES))
+
+    @property
+    def actions(self) -> List[str]:
+        """Names of the actions in this response"""
+        return decode_actions(self.action_mask, TUTOR_ACTION_TYPES)
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ProcessedConversation:
     """A single exchange between student and tutor"""
 
     # Actions and responses
-    student_actions: List[bool]  # [guess, question, affirmation, other]
-    tutor_responses: List[TutorResponse]  # Always 3 responses
-    context: dict  # Contains all target words/translations
+    student_mask: int  # Bits over STUDENT_ACTION_TYPES: [guess, question, affirmation, other]
+    tutor_responses: Tuple[TutorResponse, ...]  # Usually 3 responses
+
+    # Context. Target phrases and grammar rules repeat across conversations, so they're interned
+    target_phrase_it: str
+    target_phrase_en: str
+    grammar_rules: Tuple[str, ...]
+    conversation_history: Tuple[str, ...]
+
+    @classmethod
+    def create(cls, student_actions: List[str], tutor_responses: List[TutorResponse], target_phrase: Dict[str, str],
+               grammar_rules: List[str], conversation_history: List[str]) -> 'ProcessedConversation':
+        """Build a conversation from action names and plain lists"""
+        return cls(
+            student_mask=encode_actions(student_actions, STUDENT_ACTION_TYPES),
+            tutor_responses=tuple(tutor_responses),
+            target_phrase_it=sys.intern(target_phrase['it']),
+            target_phrase_en=sys.intern(target_phrase['en']),
+            grammar_rules=tuple(sys.intern(rule) for rule in grammar_rules),
+            conversation_history=tuple(conversation_history),
+        )
 
-def process_conversation(data: Dict) -> List[ProcessedConversation]:
+    @property
+    def student_actions(self) -> List[str]:
+        """Names of the student's actions"""
+        return decode_actions(self.student_mask, STUDENT_ACTION_TYPES)
+
+    @property
+    def tutor_action_masks(self) -> bytes:
+        """One action bitmask per tutor response"""
+        return bytes(tr.action_mask for tr in self.tutor_responses)
+
+    @property
+    def context(self) -> dict:
+        """The context as the dict earlier versions stored (target phrase, grammar rules, history)"""
+        return {
+            'target_phrase': {'it': self.target_phrase_it, 'en': self.target_phrase_en},
+            'grammar_rules': list(self.grammar_rules),
+            'conversation_history': list(self.conversation_history),
+        }
+
+def process_conversation(data: Dict) -> ProcessedConversation:
     """Process a single conversation"""
 
     # Basic validation
@@ -33,23 +105,19 @@ def process_conversation(data: Dict) -> List[ProcessedConversation]:
         'en': f"{data['engPrep']} {data['engObj']} {data['engColor']}"
     }
 
-    context = {
-        'target_phrase': target_phrase,
-        'grammar_rules': parse_grammar_rules(data['grammarRules']),
-        'conversation_history': data['past_convo'],
-    }   
-
     tutor_responses = [
-        TutorResponse(response=resp, actions=process_tutor_actions(actions))
+        TutorResponse.from_actions(resp, process_tutor_actions(actions))
         for resp, actions in zip(data['tutorResponses'], data['tutorActions'])
     ]
 
     student_actions = process_student_actions(data['studentActions'])
     
-    conv = ProcessedConversation(
+    conv = ProcessedConversation.create(
         student_actions=student_actions,
         tutor_responses=tutor_responses,
-        context=context
+        target_phrase=target_phrase,
+        grammar_rules=parse_grammar_rules(data['grammarRules']),
+        conversation_history=data['past_convo']
     )
     return conv
 
@@ -63,7 +131,7 @@ def process_student_actions(actions: List[bool]) -> List[str]:
     Returns:
         List of action type strings that were marked as True
     """
-    action_types = ['guess', 'question', 'affirmation', 'other']
+    action_types = STUDENT_ACTION_TYPES
     result = []
     
     # Loop through both lists at the same time using their index
@@ -87,7 +155,7 @@ def process_tutor_actions(actions: List[bool]) -> List[str]:
     Returns:
         List of action type strings that were marked as True
     """
-    action_types = ['question', 'hint', 'correction', 'confirmation', 'other']
+    action_types = TUTOR_ACTION_TYPES
     result = []
     
     # Loop through both lists at the same time using their index
@@ -110,7 +178,8 @@ def parse_grammar_rules(grammar_string: str) -> List[str]:
     grammar_part = grammar_string[:grammar_string.find(']]') + 2]
     
     try:
-        rules_list = ast.literal_eval(grammar_part)
+        with stage('literal_eval'):
+            rules_list = ast.literal_eval(grammar_part)
         rules = [pair[0] for pair in rules_list]
         return rules
     except (ValueError, SyntaxError) as e:
@@ -118,13 +187,37 @@ def parse_grammar_rules(grammar_string: str) -> List[str]:
         print(f"Failed string: {grammar_part}")
         return []
 
+def iter_raw_conversations(path: str, section: str = 'prepDataset') -> Iterator[Tuple[str, Dict]]:
+    """
+    Yield (conversation id, raw conversation) pairs from a CIMA-style JSON file.
+
+    With ijson installed the file is parsed incrementally, so memory stays flat
+    however large the file is and the first conversation is available right away.
+    Without it the whole file is loaded first.
+    """
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.kvitems(f, section, use_float=True)
+        else:
+            print("ijson not installed, loading the whole dataset into memory")
+            yield from json.load(f)[section].items()
+
+def iter_processed_conversations(raw_conversations) -> Iterator[Tuple[str, ProcessedConversation]]:
+    """Process (conversation id, raw conversation) pairs lazily, one at a time"""
+    for conv_id, conv_data in raw_conversations:
+        yield conv_id, process_conversation(conv_data)
+
 class DataProcessor:
     def __init__(self, raw_data: Dict):
         self.raw_data = raw_data
         self.processed_conversations: List[ProcessedConversation] = []
+
+    def iter_processed(self) -> Iterator[ProcessedConversation]:
+        """Process conversations one at a time without keeping them"""
+        for _, conversation in iter_processed_conversations(self.raw_data.items()):
+            yield conversation
         
     def process_all(self):
         """Process all conversations into a standard format"""
-        for conv_id, conv_data in self.raw_data.items():
-            conversation = process_conversation(conv_data)
-            self.processed_conversations.extend(conversation)
\ No newline at end of file
+        for conversation in self.iter_processed():
+            self.processed_conversations.append(conversation)
\ No newline at end of file
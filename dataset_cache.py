@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from profiling import profiled, stage
+from data_processing import (STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES, ProcessedConversation, TutorResponse,
+                             process_conversation)
+
+CACHE_VERSION = 1
+DEFAULT_SOURCE = 'data/cima_dataset.json'
+DEFAULT_CACHE_DIR = '.cache'
+
+# Text columns are stored as one UTF-8 blob plus int64 offsets
+TEXT_COLUMNS = ['conversation_ids', 'target_it', 'target_en', 'tutor_text', 'grammar_rules', 'history']
+
+def file_hash(path: str) -> str:
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def encode_text(strings: Sequence[str]):
+    """Pack strings into a uint8 blob and an offsets array (string i is blob[off[i]:off[i+1]])"""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+def unpack_masks(masks: np.ndarray, n_actions: int) -> np.ndarray:
+    """(n,) action bitmasks -> (n, n_actions) boolean matrix"""
+    return (masks[:, None] >> np.arange(n_actions, dtype=np.uint8) & 1).astype(bool)
+
+def pack_masks(flags: np.ndarray) -> np.ndarray:
+    """(n, n_actions) boolean matrix -> (n,) action bitmasks"""
+    return (flags.astype(np.int64) << np.arange(flags.shape[-1])).sum(axis=-1)
+
+def build_columns(data: Dict) -> Dict[str, np.ndarray]:
+    """
+    Process every conversation in the raw dataset once and lay the result out as columns.
+
+    Per-conversation lists (tutor responses, grammar rules, history) are flattened,
+    with a `<name>_offsets` array of length n + 1 marking where each conversation starts.
+    """
+    conversation_ids = list(data['prepDataset'].keys())
+    conversations = [process_conversation(data['prepDataset'][conv_id]) for conv_id in conversation_ids]
+
+    student_masks = np.array([conv.student_mask for conv in conversations], dtype=np.uint8)
+    tutor_masks = np.frombuffer(b''.join(conv.tutor_action_masks for conv in conversations), dtype=np.uint8)
+    student_actions = unpack_masks(student_masks, len(STUDENT_ACTION_TYPES))
+    tutor_actions = unpack_masks(tutor_masks, len(TUTOR_ACTION_TYPES))
+
+    def group_offsets(lengths):
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return offsets
+
+    texts = {
+        'conversation_ids': conversation_ids,
+        'target_it': [conv.target_phrase_it for conv in conversations],
+        'target_en': [conv.target_phrase_en for conv in conversations],
+        'tutor_text': [tr.response for conv in conversations for tr in conv.tutor_responses],
+        'grammar_rules': [rule for conv in conversations for rule in conv.grammar_rules],
+        'history': [msg for conv in conversations for msg in conv.conversation_history],
+    }
+
+    columns = {
+        'student_actions': student_actions,
+        'tutor_actions': tutor_actions,
+        'response_offsets': group_offsets([len(conv.tutor_responses) for conv in conversations]),
+        'rule_offsets': group_offsets([len(conv.grammar_rules) for conv in conversations]),
+        'history_offsets': group_offsets([len(conv.conversation_history) for conv in conversations]),
+    }
+    for name, strings in texts.items():
+        columns[f'{name}_blob'], columns[f'{name}_text_offsets'] = encode_text(strings)
+    return columns
+
+class ConversationColumns:
+    """
+    Processed CIMA conversations stored column-wise.
+
+    Boolean action matrices can be used directly for counting; text is decoded
+    only when a conversation is materialised with conversation() / to_conversations().
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+        self.student_actions = columns['student_actions']  # (n_conversations, 4)
+        self.tutor_actions = columns['tutor_actions']  # (n_responses, 5)
+        self.response_offsets = columns['response_offsets']  # (n_conversations + 1,)
+        self.rule_offsets = columns['rule_offsets']
+        self.history_offsets = columns['history_offsets']
+
+    def __len__(self) -> int:
+        return len(self.student_actions)
+
+    def text(self, name: str, index: int) -> str:
+        offsets = self.columns[f'{name}_text_offsets']
+        return self.columns[f'{name}_blob'][offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+    def texts(self, name: str, start: int, stop: int) -> List[str]:
+        return [self.text(name, i) for i in range(start, stop)]
+
+    @property
+    def conversation_ids(self) -> List[str]:
+        return self.decode_all('conversation_ids')
+
+    def conversation(self, i: int) -> ProcessedConversation:
+        """Rebuild the ProcessedConversation that process_conversation produced for row i"""
+        start, stop = self.response_offsets[i], self.response_offsets[i + 1]
+        tutor_masks = pack_masks(np.asarray(self.tutor_actions[start:stop])).tolist()
+        return ProcessedConversation(
+            student_mask=int(pack_masks(np.asarray(self.student_actions[i]))),
+            tutor_responses=tuple(
+                TutorResponse(self.text('tutor_text', j), mask) for j, mask in zip(range(start, stop), tutor_masks)
+            ),
+            target_phrase_it=sys.intern(self.text('target_it', i)),
+            target_phrase_en=sys.intern(self.text('target_en', i)),
+            grammar_rules=tuple(sys.intern(rule) for rule in self.texts('grammar_rules', self.rule_offsets[i], self.rule_offsets[i + 1])),
+            conversation_history=tuple(self.texts('history', self.history_offsets[i], self.history_offsets[i + 1])),
+        )
+
+    def decode_all(self, name: str) -> List[str]:
+        """Decode a whole text column in one go"""
+        blob = self.columns[f'{name}_blob'].tobytes()
+        offsets = self.columns[f'{name}_text_offsets'].tolist()
+        return [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+    def to_conversations(self) -> List[ProcessedConversation]:
+        """Rebuild every conversation, decoding each text column once"""
+        text = {name: self.decode_all(name) for name in TEXT_COLUMNS}
+        for name in ['target_it', 'target_en', 'grammar_rules']:
+            text[name] = [sys.intern(value) for value in text[name]]
+        student_masks = pack_masks(np.asarray(self.student_actions)).tolist()
+        tutor_masks = pack_masks(np.asarray(self.tutor_actions)).tolist()
+        response_offsets = self.response_offsets.tolist()
+        rule_offsets = self.rule_offsets.tolist()
+        history_offsets = self.history_offsets.tolist()
+
+        return [
+            ProcessedConversation(
+                student_mask=student_masks[i],
+                tutor_responses=tuple(
+                    TutorResponse(text['tutor_text'][j], tutor_masks[j])
+                    for j in range(response_offsets[i], response_offsets[i + 1])
+                ),
+                target_phrase_it=text['target_it'][i],
+                target_phrase_en=text['target_en'][i],
+                grammar_rules=tuple(text['grammar_rules'][rule_offsets[i]:rule_offsets[i + 1]]),
+                conversation_history=tuple(text['history'][history_offsets[i]:history_offsets[i + 1]]),
+            )
+            for i in range(len(self))
+        ]
+
+@profiled('load dataset')
+def load_columns(source: str = DEFAULT_SOURCE, cache_dir: str = DEFAULT_CACHE_DIR) -> ConversationColumns:
+    """
+    Load processed conversations from the column cache, building it first if needed.
+
+    The cache lives in `<cache_dir>/<source name>-<content hash>/` as one .npy file
+    per column, opened with mmap so loading doesn't copy anything into memory.
+    Editing the source file changes its hash, so a stale cache is never used.
+    """
+    source_hash = file_hash(source)
+    name = os.path.splitext(os.path.basename(source))[0]
+    cache_path = os.path.join(cache_dir, f'{name}-{source_hash[:16]}')
+    meta_path = os.path.join(cache_path, 'meta.json')
+
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') == CACHE_VERSION and meta.get('source_hash') == source_hash:
+            return ConversationColumns({
+                column: np.load(os.path.join(cache_path, f'{column}.npy'), mmap_mode='r')
+                for column in meta['columns']
+            })
+        shutil.rmtree(cache_path, ignore_errors=True)
+
+    with stage('parse json'), open(source, 'r') as f:
+        data = json.load(f)
+    with stage('process conversations'):
+        columns = build_columns(data)
+
+    # Write into a temp dir and rename it into place so readers never see a partial cache
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    for column, array in columns.items():
+        np.save(os.path.join(tmp_path, f'{column}.npy'), array)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'source_hash': source_hash, 'columns': sorted(columns)}, f)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process built the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return ConversationColumns(columns)
+
+def load_processed_conversations(source: str = DEFAULT_SOURCE, cache_dir: str = DEFAULT_CACHE_DIR) -> List[ProcessedConversation]:
+    """Cached equivalent of process_all_conversations(load_dataset())"""
+    columns = load_columns(source, cache_dir)
+    with stage('decode conversations'):
+        return columns.to_conversations()
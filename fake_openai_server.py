@@ -0,0 +1,263 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ACTION_TYPES = ["question", "hint", "correction", "confirmation", "other"]
+
+def fake_content(messages: list, malformed_rate: float = 0.0) -> str:
+    """A valid tutor_response JSON payload, or with probability malformed_rate a broken one"""
+    content = json.dumps({
+        "response": f"Fake tutor reply to: {messages[-1]['content'][-40:]}",
+        "actions": random.sample(ACTION_TYPES, random.randint(1, 3))
+    })
+    if random.random() >= malformed_rate:
+        return content
+    return random.choice([
+        "Sure! Here is my reply as a tutor: " + content,  # Prose around the JSON
+        content.replace('"actions": [', '"actions": ["praise", '),  # Action outside the enum
+        content[:len(content) // 2],  # Cut off mid-object
+    ])
+
+def fake_completion(model: str, messages: list, n: int = 1, malformed_rate: float = 0.0) -> dict:
+    """Build a chat.completion body with n choices"""
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": fake_content(messages, malformed_rate)},
+                "finish_reason": "stop"
+            }
+            for i in range(n)
+        ],
+        "usage": {"prompt_tokens": 200, "completion_tokens": 40 * n, "total_tokens": 200 + 40 * n}
+    }
+
+def parse_multipart(content_type: str, body: bytes) -> dict:
+    """Form fields of a multipart/form-data body as {name: bytes}"""
+    message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    return {
+        part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+        for part in message.get_payload()
+    }
+
+def run_fake_batch(server: 'FakeOpenAIServer', batch_id: str):
+    """Answer every line of a batch input file, then mark the batch completed"""
+    batch = server.batches[batch_id]
+    batch.update(status='in_progress', in_progress_at=int(time.time()))
+    time.sleep(server.latency)
+
+    output, errors = [], []
+    for line in server.files[batch['input_file_id']]['content'].decode().splitlines():
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        body = request.get('body', {})
+        record = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request['custom_id'], "error": None}
+        if random.random() < server.error_rate:
+            record["response"] = {"status_code": 500, "body": {"error": {"message": "Internal error"}}}
+            errors.append(record)
+        else:
+            n = body.get('n', 1) if server.support_n else 1
+            completion = fake_completion(body.get('model', 'fake'), body.get('messages', [{"content": ""}]), n,
+                                         server.malformed_rate)
+            record["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": completion}
+            output.append(record)
+
+    def store(records):
+        if not records:
+            return None
+        content = "".join(json.dumps(record) + "\n" for record in records).encode()
+        return server.add_file(f"{batch_id}_output.jsonl", 'batch_output', content)['id']
+
+    batch.update(
+        status='completed',
+        completed_at=int(time.time()),
+        output_file_id=store(output),
+        error_file_id=store(errors),
+        request_counts={"total": len(output) + len(errors), "completed": len(output), "failed": len(errors)}
+    )
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Answers POST /v1/chat/completions like an OpenAI-compatible API, plus the
+    /v1/files and /v1/batches endpoints used by batch_generation.py
+    """
+    protocol_version = 'HTTP/1.1'  # Keep connections alive like a real API, every reply sets Content-Length
+
+    def do_POST(self):
+        server = self.server
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        with server.lock:
+            server.request_count += 1
+
+        path = self.path.rstrip('/')
+        if path.endswith('/files'):
+            fields = parse_multipart(self.headers['Content-Type'], raw)
+            return self.send_json(200, server.add_file('batch_input.jsonl', fields['purpose'].decode(), fields['file']))
+        if path.endswith('/batches'):
+            return self.send_json(200, server.add_batch(json.loads(raw)))
+
+        body = json.loads(raw or b'{}')
+        time.sleep(server.latency)
+
+        if not path.endswith('/chat/completions'):
+            return self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+        if random.random() < server.rate_limit_rate:
+            return self.send_json(429, {"error": {"message": "Rate limited"}}, {"Retry-After": "0.1"})
+        if random.random() < server.error_rate:
+            return self.send_json(500, {"error": {"message": "Internal error"}})
+
+        n = body.get('n', 1) if server.support_n else 1
+        completion = fake_completion(body.get('model', 'fake'), body.get('messages', [{"content": ""}]), n,
+                                     server.malformed_rate)
+        if body.get('stream'):
+            return self.send_stream(completion)
+        self.send_json(200, completion)
+
+    def send_stream(self, completion: dict, piece: int = 8):
+        """Send a completion as server-sent chat.completion.chunk events, a few characters at a time"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def event(payload):
+            data = f"data: {payload}\n\n".encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(choices, usage=None):
+            return json.dumps({"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                               "model": completion["model"], "choices": choices, "usage": usage})
+
+        try:
+            for choice in completion["choices"]:
+                content = choice["message"]["content"]
+                for start in range(0, len(content), piece):
+                    event(chunk([{"index": choice["index"], "delta": {"content": content[start:start + piece]},
+                                  "finish_reason": None}]))
+                    time.sleep(self.server.token_latency)
+                event(chunk([{"index": choice["index"], "delta": {}, "finish_reason": "stop"}]))
+            event(chunk([], completion["usage"]))
+            event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up mid-stream, e.g. after rejecting the output early
+            with self.server.lock:
+                self.server.aborted_streams += 1
+            self.close_connection = True
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.split('?')[0].rstrip('/').split('/')
+
+        if len(parts) >= 3 and parts[-3] == 'files' and parts[-1] == 'content' and parts[-2] in server.files:
+            return self.send_bytes(200, server.files[parts[-2]]['content'], 'application/octet-stream')
+        if len(parts) >= 2 and parts[-2] == 'batches' and parts[-1] in server.batches:
+            return self.send_json(200, server.batches[parts[-1]])
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def send_json(self, status: int, payload: dict, headers: dict = None):
+        self.send_bytes(status, json.dumps(payload).encode(), 'application/json', headers)
+
+    def send_bytes(self, status: int, data: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    Local stand-in for OpenRouter, for exercising the generation engine without
+    network access or an API key. Point LLMTutor at `server.base_url`.
+
+    Args:
+        port: Port to listen on (0 picks a free one)
+        latency: Seconds each request takes (and each batch job, as a whole)
+        error_rate: Fraction of requests (or batch lines) answered with a 500
+        rate_limit_rate: Fraction of requests answered with a 429
+        support_n: Whether to honour the `n` parameter (some providers ignore it)
+        malformed_rate: Fraction of generated outputs that aren't a valid tutor_response
+        token_latency: Seconds between streamed chunks of a few characters
+    """
+    daemon_threads = True
+    request_queue_size = 256  # Accept bursts from many concurrent workers
+
+    def __init__(self, port: int = 0, latency: float = 0.5, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 support_n: bool = True, malformed_rate: float = 0.0, token_latency: float = 0.0):
+        super().__init__(('127.0.0.1', port), FakeOpenAIHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.support_n = support_n
+        self.malformed_rate = malformed_rate
+        self.token_latency = token_latency
+        self.request_count = 0
+        self.aborted_streams = 0
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> dict:
+        """Store an uploaded (or batch output) file and return its file object"""
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed"
+        }
+        self.files[file_id]['content'] = content
+        return {k: v for k, v in self.files[file_id].items() if k != 'content'}
+
+    def add_batch(self, body: dict) -> dict:
+        """Create a batch job and start answering it in the background"""
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body['endpoint'], "errors": None,
+            "input_file_id": body['input_file_id'], "completion_window": body['completion_window'],
+            "status": "validating", "output_file_id": None, "error_file_id": None,
+            "created_at": int(time.time()), "in_progress_at": None, "completed_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": body.get('metadata')
+        }
+        threading.Thread(target=run_fake_batch, args=(self, batch_id), daemon=True).start()
+        return dict(self.batches[batch_id])
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        """Serve from a background thread and return self"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI-compatible server")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--no-n', action='store_true', help="Ignore the n parameter like some providers do")
+    parser.add_argument('--malformed-rate', type=float, default=0.0)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.port, args.latency, args.error_rate, args.rate_limit_rate, not args.no_n,
+                              args.malformed_rate, args.token_latency)
+    print(f"Serving fake OpenAI API at {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,325 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+import openai
+
+from data_processing import ProcessedConversation
+from llm_responses import LLMResponse, LLMTutor
+from response_parser import ResponseParseError
+from telemetry import current_attempt
+
+@dataclass
+class GenerationConfig:
+    """Settings for a concurrent generation run"""
+    concurrency: int = 16  # Max requests in flight at once per model
+    model_concurrency: Dict[str, int] = field(default_factory=dict)  # Per-model overrides of `concurrency`
+    requests_per_second: float = 8.0  # Sustained request rate per model
+    burst: int = 16  # Requests allowed back to back before the rate kicks in
+    max_retries: int = 5  # Retries for 429s, 5xx and connection errors
+    backoff_base: float = 1.0  # Seconds, doubled on every retry
+    backoff_max: float = 60.0  # Upper bound for a single backoff sleep
+    parse_retries: int = 2  # Fresh requests for outputs that fail validation, made from the back of the queue
+
+class TokenBucket:
+    """Thread-safe token bucket limiting the request rate for one model"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Apply backpressure after a 429: stop handing out tokens for `seconds`
+        and drain the bucket so workers don't all resume in one burst
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors and dropped connections are worth retrying"""
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, if it sent a Retry-After header"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+class GenerationEngine:
+    """
+    Runs LLMTutor requests for many conversations (and models) on a bounded thread pool.
+
+    Every model gets its own token bucket and concurrency cap, so one slow or
+    rate-limited model doesn't hold back the others. Retryable errors are retried
+    with full-jitter exponential backoff, and a 429 pauses the whole bucket.
+    """
+
+    def __init__(self, llm_tutor: LLMTutor, config: GenerationConfig = None):
+        self.llm_tutor = llm_tutor
+        self.config = config or GenerationConfig()
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.buckets_lock = threading.Lock()
+        self.failed: Dict[Hashable, Exception] = {}
+        self.no_n_models = set()  # Models found to ignore the `n` parameter
+
+    def bucket_for(self, model_name: str) -> TokenBucket:
+        with self.buckets_lock:
+            if model_name not in self.buckets:
+                self.buckets[model_name] = TokenBucket(self.config.requests_per_second, self.config.burst)
+            return self.buckets[model_name]
+
+    def concurrency_for(self, model_name: str) -> int:
+        return self.config.model_concurrency.get(model_name, self.config.concurrency)
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: uniform between 0 and the capped exponential delay"""
+        ceiling = min(self.config.backoff_max, self.config.backoff_base * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def call_with_retries(self, model_name: str, request: Callable[[], object]):
+        """Run `request`, respecting the model's rate limit and retrying transient errors"""
+        bucket = self.bucket_for(model_name)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            current_attempt.set(attempt)  # Lets telemetry tag the call with its retry count
+            try:
+                return request()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.config.max_retries:
+                    raise
+                delay = retry_after(e) or self.backoff(attempt)
+                if isinstance(e, openai.RateLimitError):
+                    bucket.pause(delay)
+                attempt += 1
+                print(f"Retrying {model_name} in {delay:.1f}s after {type(e).__name__} (attempt {attempt})")
+                time.sleep(delay)
+
+    def generate_one(self, messages: List[Dict], model_name: str) -> LLMResponse:
+        """Generate a single response"""
+        return self.call_with_retries(model_name, lambda: self.llm_tutor.complete(messages, model_name))
+
+    def generate_samples(self, messages: List[Dict], model_name: str, n: int, first_sample: int = 0) -> List[LLMResponse]:
+        """Generate samples first_sample .. first_sample + n - 1 (possibly fewer, see LLMTutor.complete_samples)"""
+        return self.call_with_retries(
+            model_name, lambda: self.llm_tutor.complete_samples(messages, model_name, n, first_sample)
+        )
+
+    def run(self,
+            jobs: Iterable[Tuple[Hashable, ProcessedConversation]],
+            model_name: str,
+            on_result: Callable[[Hashable, LLMResponse], None] = None) -> Dict[Hashable, LLMResponse]:
+        """
+        Generate responses for (key, conversation) jobs concurrently.
+
+        Args:
+            jobs: Pairs of an identifier (e.g. the conversation index) and a conversation
+            model_name: Model to query
+            on_result: Called from the calling thread as each response completes,
+                       so it can save results without extra locking
+
+        Returns:
+            Dictionary mapping each successful job key to its response.
+            Keys whose retries were exhausted are left out and reported in self.failed
+        """
+        results = self.run_many(
+            ((model_name, key, self.llm_tutor.build_messages(conversation)) for key, conversation in jobs),
+            on_result=(lambda model, key, response: on_result(key, response)) if on_result else None
+        )
+        self.failed = {key: e for (_, key), e in self.failed.items()}
+        return {key: response for (_, key), response in results.items()}
+
+    def run_many(self,
+                 jobs: Iterable[Tuple[str, Hashable, List[Dict]]],
+                 on_result: Callable[[str, Hashable, object], None] = None,
+                 samples: int = 1) -> Dict[Tuple[str, Hashable], object]:
+        """
+        Generate responses for (model, key, messages) jobs across several models at once.
+
+        All jobs share one work queue and thread pool, but each model only has up to
+        concurrency_for(model) requests in flight, so the total wall time is close to
+        that of the slowest model rather than the sum over models.
+
+        With samples > 1 every job is an ensemble: all samples are first requested in
+        one call with the API's `n` parameter. If a model returns fewer choices, it is
+        remembered in self.no_n_models and its missing samples (and those of later
+        jobs) are queued as separate requests instead.
+
+        Outputs that fail validation are never returned. Their samples go to the back
+        of the model's queue to be asked for again, up to config.parse_retries times.
+
+        Returns:
+            Dictionary mapping (model, key) to each successful response, or to the
+            list of samples when samples > 1. Failed jobs are reported in self.failed
+        """
+        # Queue entries are (key, messages, first sample index, number of samples)
+        pending: Dict[str, deque] = {}
+        for model_name, key, messages in jobs:
+            pending.setdefault(model_name, deque()).append((key, messages, 0, samples))
+
+        results = {}
+        collected: Dict[Tuple[str, Hashable], Dict[int, LLMResponse]] = {}
+        parse_failures: Dict[Tuple[str, Hashable], int] = {}
+        self.failed = {}
+        workers = sum(min(self.concurrency_for(model), len(queue)) for model, queue in pending.items())
+        if workers == 0:
+            return results
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = {}
+
+            def submit_next(model_name):
+                key, messages, first, count = pending[model_name].popleft()
+                if count > 1 and model_name in self.no_n_models:
+                    # Split the ensemble into single-sample requests
+                    pending[model_name].appendleft((key, messages, first + 1, count - 1))
+                    count = 1
+                future = executor.submit(self.generate_samples, messages, model_name, count, first)
+                in_flight[future] = (model_name, key, messages, first, count)
+
+            # Fill every model up to its cap, then top it up as its requests finish
+            for model_name, queue in pending.items():
+                for _ in range(min(self.concurrency_for(model_name), len(queue))):
+                    submit_next(model_name)
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    model_name, key, messages, first, count = in_flight.pop(future)
+                    job = (model_name, key)
+                    returned, requeue = None, None
+                    try:
+                        responses = future.result()
+                    except ResponseParseError as e:
+                        parse_failures[job] = parse_failures.get(job, 0) + 1
+                        if parse_failures[job] > self.config.parse_retries:
+                            print(f"Failed conversation {key} for {model_name}: {e}")
+                            self.failed[job] = e
+                            collected.pop(job, None)
+                            responses = None
+                        else:
+                            # Keep the samples that parsed and ask for the rest again later
+                            print(f"Requeueing conversation {key} for {model_name}: {e}")
+                            responses, returned, requeue = e.parsed, e.choices, pending[model_name].append
+                    except Exception as e:
+                        print(f"Failed conversation {key} for {model_name}: {e}")
+                        self.failed[job] = e
+                        collected.pop(job, None)
+                        responses = None
+
+                    if responses is not None and job not in self.failed:
+                        returned = len(responses) if returned is None else returned
+                        if returned < count and model_name not in self.no_n_models:
+                            print(f"{model_name} ignores the n parameter, requesting samples one by one")
+                            self.no_n_models.add(model_name)
+                        if len(responses) < count:
+                            requeue = requeue or pending[model_name].appendleft
+                            requeue((key, messages, first + len(responses), count - len(responses)))
+                        got = collected.setdefault(job, {})
+                        got.update({first + i: response for i, response in enumerate(responses)})
+
+                        if len(got) == samples:
+                            del collected[job]
+                            result = got[0] if samples == 1 else [got[i] for i in range(samples)]
+                            results[job] = result
+                            if on_result:
+                                on_result(model_name, key, result)
+
+                    if pending[model_name]:
+                        submit_next(model_name)
+        return results
+
+    def stream(self,
+               jobs: Iterable[Tuple[Hashable, ProcessedConversation]],
+               model_name: str,
+               window: int = None) -> Iterator[Tuple[Hashable, LLMResponse]]:
+        """
+        Lazily generate responses for a stream of (key, conversation) jobs.
+
+        Jobs are pulled from `jobs` only while fewer than `window` requests are in
+        flight (default: the model's concurrency cap), so an upstream generator is
+        consumed as fast as the API allows and never materialised. Responses are
+        yielded as they complete, not in input order. Outputs that fail validation are
+        asked for again up to config.parse_retries times, ahead of new jobs so their
+        conversations aren't held for the rest of the stream. Failures go to self.failed.
+        """
+        window = window or self.concurrency_for(model_name)
+        jobs = iter(jobs)
+        retries: deque = deque()
+        parse_failures: Dict[Hashable, int] = {}
+        self.failed = {}
+
+        with ThreadPoolExecutor(max_workers=window) as executor:
+            in_flight = {}
+
+            def fill():
+                while len(in_flight) < window:
+                    if retries:
+                        key, messages = retries.popleft()
+                    else:
+                        job = next(jobs, None)
+                        if job is None:
+                            return
+                        key, conversation = job
+                        messages = self.llm_tutor.build_messages(conversation)
+                    in_flight[executor.submit(self.generate_one, messages, model_name)] = (key, messages)
+
+            fill()
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, messages = in_flight.pop(future)
+                    try:
+                        llm_response = future.result()
+                    except ResponseParseError as e:
+                        parse_failures[key] = parse_failures.get(key, 0) + 1
+                        if parse_failures[key] > self.config.parse_retries:
+                            print(f"Failed conversation {key} for {model_name}: {e}")
+                            self.failed[key] = e
+                            del parse_failures[key]
+                        else:
+                            print(f"Requeueing conversation {key} for {model_name}: {e}")
+                            retries.append((key, messages))
+                        continue
+                    except Exception as e:
+                        print(f"Failed conversation {key} for {model_name}: {e}")
+                        self.failed[key] = e
+                        continue
+                    parse_failures.pop(key, None)
+                    yield key, llm_response
+                fill()
@@ -0,0 +1,167 @@
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Hashable
+
+from profiling import profiled
+
+def responses_file_for(model_name: str, data_dir: str = 'data', samples: int = 1) -> str:
+    """
+    Path of a model's responses file, e.g. data/gpt-4o-2024-08-06_responses.json,
+    or data/gpt-4o-2024-08-06_ensemble10_responses.json for 10 samples per conversation
+    """
+    suffix = f"_ensemble{samples}" if samples > 1 else ""
+    return os.path.join(data_dir, f"{model_name.split('/')[-1]}{suffix}_responses.json")
+
+@profiled('write json')
+def atomic_write_json(path: str, data, indent: int = 2):
+    """Write JSON to a temp file next to `path` and rename it over `path`"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fsync_dir(directory)
+
+def fsync_dir(directory: str):
+    """Persist a rename by syncing the directory entry (no-op where unsupported)"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _read_journal(journal_file: str, responses: Dict[str, object]) -> int:
+    """Add the complete records of a journal to `responses`, returning how many bytes they span"""
+    good_bytes = 0
+    with open(journal_file, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            responses[record['id']] = record['value']
+            good_bytes += len(line)
+    return good_bytes
+
+def read_responses(output_file: str, journal: bool = True) -> Dict[str, object]:
+    """
+    What a ResponseJournal on output_file would hold, read without opening the journal
+    for writing, so neither file is created or changed
+    """
+    responses: Dict[str, object] = {}
+    if os.path.exists(output_file):
+        with open(output_file, 'r', encoding='utf-8') as f:
+            responses.update(json.load(f))
+    journal_file = f"{output_file}.journal.jsonl"
+    if journal and os.path.exists(journal_file):
+        _read_journal(journal_file, responses)
+    return responses
+
+class ResponseJournal:
+    """
+    Crash-safe store for one model's generated responses.
+
+    New responses are appended as single lines to `<output_file>.journal.jsonl`
+    and fsynced in batches, so saving costs one short write instead of rewriting
+    the whole responses file. compact() folds the journal into `output_file`
+    (the usual {conversation_id: {...}} JSON layout) with an atomic rename.
+
+    On open, the compacted file and the journal are replayed into an in-memory
+    index keyed by string conversation id, so `conv_id in journal` is O(1) and
+    matches the keys json.load gives back. A line torn by a crash is dropped.
+
+    Args:
+        output_file: Compacted JSON file, e.g. data/gpt-4o-2024-08-06_responses.json
+        sync_every: fsync after this many appended records
+        sync_interval: ... or after this many seconds, whichever comes first
+    """
+
+    def __init__(self, output_file: str, sync_every: int = 32, sync_interval: float = 2.0):
+        self.output_file = output_file
+        self.journal_file = f"{output_file}.journal.jsonl"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        self.responses: Dict[str, object] = read_responses(output_file, journal=False)
+        self._replay_journal()
+
+        os.makedirs(os.path.dirname(self.journal_file) or '.', exist_ok=True)
+        self.file = open(self.journal_file, 'a', encoding='utf-8')
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def _replay_journal(self):
+        """Load journal records, truncating a trailing partial line left by a crash"""
+        if not os.path.exists(self.journal_file):
+            return
+        good_bytes = _read_journal(self.journal_file, self.responses)
+        if good_bytes < os.path.getsize(self.journal_file):
+            print(f"Dropping torn record at end of {self.journal_file}")
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(good_bytes)
+
+    def __contains__(self, conv_id: Hashable) -> bool:
+        return str(conv_id) in self.responses
+
+    def __len__(self) -> int:
+        return len(self.responses)
+
+    def append(self, conv_id: Hashable, value):
+        """Record the response(s) for a conversation"""
+        conv_id = str(conv_id)
+        self.file.write(json.dumps({'id': conv_id, 'value': value}) + '\n')
+        self.responses[conv_id] = value
+        self.pending += 1
+        if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """Flush buffered records and fsync the journal"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def compact(self):
+        """Atomically rewrite output_file with everything recorded, then empty the journal"""
+        self.sync()
+        ordered = dict(sorted(self.responses.items(), key=lambda item: _conversation_sort_key(item[0])))
+        atomic_write_json(self.output_file, ordered)
+        # Only truncate once the compacted file is safely in place
+        self.file.truncate(0)
+        self.file.seek(0)
+        self.sync()
+
+    def close(self, compact: bool = True):
+        if compact:
+            self.compact()
+        else:
+            self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Compact even on errors/KeyboardInterrupt so the JSON file reflects all finished work
+        self.close()
+
+def _conversation_sort_key(conv_id: str):
+    return (0, int(conv_id), '') if conv_id.isdigit() else (1, 0, conv_id)
@@ -1,8 +1,16 @@
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import List, Dict, Sequence, Tuple
 import json
+import time
+import httpx
+import openai
 from openai import OpenAI
 from data_processing import ProcessedConversation, TutorResponse
+from profiling import stage
+from prompts import RESPONSE_FORMAT, build_messages, build_messages_batch
+from response_cache import ResponseCache, request_key
+from response_parser import ResponseParseError, TutorResponseParser, parse_tutor_response
+from telemetry import Telemetry
 
 @dataclass
 class LLMResponse:
@@ -11,102 +19,242 @@ class LLMResponse:
     actions: List[str]  # [question, hint, correction, confirmation, other]
     model_name: str
 
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+
 class LLMTutor:
-    def __init__(self, api_key: str):
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key
-        )
+    def __init__(self, api_key: str = None, base_url: str = DEFAULT_BASE_URL, max_retries: int = 2,
+                 cache: ResponseCache = None, http_client: httpx.Client = None, telemetry: Telemetry = None,
+                 stream: bool = False, backend=None):
+        """
+        Args:
+            api_key: Key for the OpenAI-compatible endpoint
+            base_url: Endpoint to talk to (OpenRouter by default, or a local fake server)
+            max_retries: Retries done by the OpenAI client itself. Set to 0 when the
+                         caller handles retries (see generation.GenerationEngine)
+            cache: Optional response cache consulted before every API call
+            http_client: Client to send requests with, e.g. transport.shared_http_client()
+                         so connections are pooled across tutors and models. Its timeouts apply
+            telemetry: Optional recorder for per-call latency, tokens, status and parse outcome
+            stream: Stream single-sample completions and validate them as they arrive,
+                    abandoning malformed ones early (see response_parser.py)
+            backend: Serve requests with this local_backend.ChatBackend instead of the
+                     OpenAI-compatible endpoint. api_key, base_url, max_retries, http_client
+                     and stream don't apply then
+        """
+        self.cache = cache
+        self.telemetry = telemetry
+        self.stream = stream and backend is None
+        self.backend = backend
+        self.client = None
+        if backend is None:
+            self.client = OpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                max_retries=max_retries,
+                http_client=http_client
+            )
+            if telemetry:
+                telemetry.install(self.client._client)
 
     def generate_response(self, conversation: ProcessedConversation, model_name: str) -> LLMResponse:
         """Generate response for a single conversation turn"""
-        
-        # Construct prompt
-        system_prompt = self._build_system_prompt(conversation)
-        user_prompt = self._build_user_prompt(conversation)
-        
-        # Get response from model
-        response = self.client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "tutor_response",
-                    "strict": True,
-                    "schema": {
-                        "type": "object",
-                        "additionalProperties": False, # need this for openai, remove for others
-                        "properties": {
-                            "response": {
-                                "type": "string",
-                                "description": "The tutor's response text"
-                            },
-                            "actions": {
-                                "type": "array",
-                                "items": {
-                                    "type": "string",
-                                    "enum": ["question", "hint", "correction", "confirmation", "other"]
-                                },
-                                "description": "List of action types for this response"
-                            }
-                        },
-                        "required": ["response", "actions"],
-                    }
-                }
-            }
-        )
+        return self.complete(self.build_messages(conversation), model_name)
+
+    def build_messages(self, conversation: ProcessedConversation) -> List[Dict]:
+        """Build the chat messages for a conversation. They don't depend on the model,
+        so callers querying several models can build them once and reuse them"""
+        return build_messages(conversation)
+
+    def build_messages_batch(self, conversations: Sequence[ProcessedConversation]) -> List[List[Dict]]:
+        """Build the chat messages for many conversations in one pass (see prompts.py)"""
+        return build_messages_batch(conversations)
+
+    def complete(self, messages: List[Dict], model_name: str, sample_idx: int = 0) -> LLMResponse:
+        """
+        Get a response from a model for prebuilt messages
+
+        Args:
+            sample_idx: Which sample of an ensemble this is. Samples are cached
+                        separately so repeated samples aren't served the same completion
+
+        Raises:
+            ResponseParseError: The output isn't a valid tutor_response. Invalid
+                                outputs aren't cached, so asking again makes a fresh request
+        """
+        request = self._build_request(messages, model_name)
+        key_request = {**request, 'sample': sample_idx} if sample_idx else request
+
+        # Serve identical requests from the cache instead of calling the API again
+        key = request_key(key_request) if self.cache else None
+        content = self.cache.get(key) if self.cache else None
+        if content is not None:
+            try:
+                llm_response = self._parse_response(content, model_name)
+            except ResponseParseError:
+                # Entries cached before outputs were validated may not parse, fetch a fresh one
+                if self.cache.replay:
+                    raise
+            else:
+                if self.telemetry:
+                    self.telemetry.record_cached(model_name)
+                return llm_response
+
+        content, llm_response = self._stream(request, model_name) if self.stream else self._call(request, model_name)
+        if self.cache:
+            self.cache.put(key, model_name, content)
+        return llm_response
+
+    def complete_samples(self, messages: List[Dict], model_name: str, n: int, first_sample: int = 0) -> List[LLMResponse]:
+        """
+        Get up to n samples for the same messages in a single request, using the API's `n` parameter
+
+        Backends that ignore `n` return fewer choices, so callers should check the
+        length and request the missing samples separately (see GenerationEngine).
+
+        Raises:
+            ResponseParseError: Some choices didn't parse. The ones that did are in its
+                                `parsed` attribute and the number of choices in `choices`
+        """
+        if n == 1:
+            return [self.complete(messages, model_name, first_sample)]
+
+        request = {**self._build_request(messages, model_name), 'n': n}
+        key = request_key({**request, 'sample': first_sample}) if self.cache else None
+        cached = self.cache.get(key) if self.cache else None
+        response, call = None, None
+        if cached is not None:
+            contents = json.loads(cached)
+        else:
+            response, call = self._create(request, model_name)
+            contents = [choice.message.content for choice in response.choices]
+
+        parsed, errors = [], []
+        for content in contents[:n]:
+            try:
+                parsed.append(self._parse_response(content, model_name))
+            except ResponseParseError as e:
+                errors.append(e)
 
-        # print(response)
-        
-        # Parse JSON response
+        if self.telemetry:
+            if call:
+                self.telemetry.record_call(model_name, *call, usage=response.usage, samples=len(contents),
+                                           parse_failures=len(errors))
+            else:
+                self.telemetry.record_cached(model_name, samples=len(contents), parse_failures=len(errors))
+        if errors:
+            raise ResponseParseError(f"{len(errors)} of {len(contents[:n])} samples didn't parse: {errors[0]}",
+                                     errors[0].content, parsed, len(contents))
+
+        # Partial results are returned but not cached, the caller fills in the rest
+        if cached is None and self.cache and len(contents) >= n:
+            self.cache.put(key, model_name, json.dumps(contents))
+        return parsed
+
+    def _call(self, request: dict, model_name: str) -> Tuple[str, LLMResponse]:
+        """Make a single-choice request and parse it, returning the raw content too"""
+        response, call = self._create(request, model_name)
+        content = response.choices[0].message.content
+
+        parse_error = None
         try:
-            response_content = json.loads(response.choices[0].message.content)
-            # print("Parsed response:", response_content)
-            return LLMResponse(
-                response=response_content["response"],
-                actions=response_content["actions"],
-                model_name=model_name
-            )
-        except (json.JSONDecodeError, KeyError) as e:
-            error_msg = f"Error parsing model response: {e}"
-            print(error_msg)
-            print("Raw response:", response.choices[0].message.content)
-            return LLMResponse(
-                response=error_msg,
-                actions=["other"],  # Use a valid action type instead of False values
-                model_name=model_name
-            )
+            llm_response = self._parse_response(content, model_name)
+        except ResponseParseError as e:
+            parse_error = e
+        if call:
+            self.telemetry.record_call(model_name, *call, usage=response.usage, parse_failures=int(parse_error is not None))
+        if parse_error:
+            raise parse_error
+        return content, llm_response
+
+    def _stream(self, request: dict, model_name: str) -> Tuple[str, LLMResponse]:
+        """
+        Stream a single-choice completion through TutorResponseParser
+
+        The output is validated as tokens arrive, and the stream is closed (which
+        aborts the generation) as soon as it can no longer become a valid response.
+        """
+        parser = TutorResponseParser()
+        started = time.perf_counter()
+        status, http_response, usage, parse_error = None, None, None, None
+        try:
+            with stage('network'):
+                raw = self.client.chat.completions.with_raw_response.create(
+                    **request, stream=True, stream_options={"include_usage": True}
+                )
+            status, http_response = raw.http_response.status_code, raw.http_response
+            stream = raw.parse()
+            try:
+                # Mostly waiting on tokens, the parser's share shows up in the sampled stacks
+                with stage('network stream'):
+                    for chunk in stream:
+                        usage = getattr(chunk, 'usage', None) or usage
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            parser.feed(chunk.choices[0].delta.content)
+                parsed = parser.close()
+            finally:
+                stream.close()
+        except ResponseParseError as e:
+            parse_error = e
+        except openai.APIStatusError as e:
+            status, http_response = e.status_code, e.response
+            raise
+        except Exception as e:
+            status = type(e).__name__
+            raise
+        finally:
+            if self.telemetry:
+                self.telemetry.record_call(model_name, started, time.perf_counter(), status, http_response,
+                                           usage=usage, parse_failures=int(parse_error is not None))
+        if parse_error:
+            raise parse_error
+        return parser.text(), LLMResponse(response=parsed["response"], actions=parsed["actions"], model_name=model_name)
+
+    def _create(self, request: dict, model_name: str):
+        """
+        Send a chat completion request
 
-    def _build_system_prompt(self, conversation: ProcessedConversation) -> str:
-        """Build system prompt with context and instructions"""
-        target_phrase = conversation.context['target_phrase']
-        return f"""You are a language tutor teaching Italian. 
-
-Available actions (one response can correspond to multiple action types):
-- Question: Ask student for clarification or to elaborate
-- Hint: Provide indirect guidance
-- Correction: Point out and fix errors
-- Confirmation: Acknowledge correct responses
-- Other: Any other type of response
-
-Context:
-- Target phrase (IT): {target_phrase['it']}
-- Target phrase (EN): {target_phrase['en']}
-- Grammar rules: {conversation.context['grammar_rules']}
-
-Respond in JSON format with:
-{{
-    "response": "your response text",
-    "actions": ["your action types"]  // Corresponds to actions list above (lowercase). One response can correspond to multiple action types.
-}}"""
-
-    def _build_user_prompt(self, conversation: ProcessedConversation) -> str:
-        """Build user prompt with conversation history"""
-        return f"""Conversation history:
-{conversation.context['conversation_history']}
-
-Please provide a response as a tutor to the student's last message."""
\ No newline at end of file
+        Returns:
+            The completion, and when telemetry is on the (started, finished, status, http_response)
+            of the call for Telemetry.record_call. Failed calls are recorded here
+        """
+        if self.backend:
+            started = time.perf_counter()
+            with stage('local generation'):
+                response = self.backend.create(request)
+            # Recorded as a 200 so the telemetry summary counts it as a successful call
+            return response, (started, time.perf_counter(), 200, None) if self.telemetry else None
+
+        if not self.telemetry:
+            with stage('network'):
+                return self.client.chat.completions.create(**request), None
+
+        samples = request.get('n', 1)
+        started = time.perf_counter()
+        try:
+            with stage('network'):
+                raw = self.client.chat.completions.with_raw_response.create(**request)
+            response = raw.parse()
+        except openai.APIStatusError as e:
+            self.telemetry.record_call(model_name, started, time.perf_counter(), e.status_code, e.response, samples=samples)
+            raise
+        except Exception as e:
+            self.telemetry.record_call(model_name, started, time.perf_counter(), type(e).__name__, samples=samples)
+            raise
+        return response, (started, time.perf_counter(), raw.http_response.status_code, raw.http_response)
+
+    def _build_request(self, messages: List[Dict], model_name: str) -> dict:
+        """Build the chat completion request for a model"""
+        return dict(
+            model=model_name,
+            messages=messages,
+            response_format=RESPONSE_FORMAT
+        )
+
+    def _parse_response(self, content: str, model_name: str) -> LLMResponse:
+        """Parse the model's JSON output into an LLMResponse, raising ResponseParseError if it isn't valid"""
+        response_content = parse_tutor_response(content)
+        return LLMResponse(
+            response=response_content["response"],
+            actions=response_content["actions"],
+            model_name=model_name
+        )
@@ -0,0 +1,501 @@
+"""
+Local CPU inference for LLMTutor: a small open model run in-process, with continuous
+batching and decoding constrained to the tutor_response schema, so generation runs
+offline without an API key.
+
+    backend = LocalBackend(TransformersModel('Qwen/Qwen2.5-0.5B-Instruct'), max_batch=8)
+    tutor = LLMTutor(backend=backend)
+
+or `python cli.py generate --local-model Qwen/Qwen2.5-0.5B-Instruct`. GGUF checkpoints
+load through transformers with `gguf_file` (dequantized, so they take float32 memory).
+
+Requests from all GenerationEngine threads feed one ContinuousBatcher: every step it
+decodes one token for each sequence in flight, and a sequence that finishes frees its
+slot for the next waiting request right away instead of waiting for the whole batch.
+Outputs are constrained token by token with TutorResponseGrammar, so every completion
+is valid JSON with a response string and a non-empty list of distinct actions.
+"""
+import json
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from profiling import stage
+
+try:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+except ImportError:  # Optional, only needed for TransformersModel
+    torch = None
+
+# The parts of an OpenAI chat.completion LLMTutor reads
+
+@dataclass
+class Message:
+    content: str
+    role: str = 'assistant'
+
+@dataclass
+class Choice:
+    index: int
+    message: Message
+    finish_reason: str
+
+@dataclass
+class Usage:
+    prompt_tokens: int
+    completion_tokens: int
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+@dataclass
+class ChatCompletion:
+    model: str
+    choices: List[Choice]
+    usage: Usage
+
+class ChatBackend(ABC):
+    """
+    What LLMTutor needs from a backend other than an OpenAI-compatible endpoint
+
+    create() gets the request LLMTutor would have sent (model, messages, response_format
+    and n) and returns a ChatCompletion with n choices. It's called from many threads at once.
+    """
+
+    @abstractmethod
+    def create(self, request: dict) -> ChatCompletion:
+        ...
+
+    def close(self):
+        pass
+
+class TutorResponseGrammar:
+    """
+    Character-level automaton accepting exactly
+
+        {"response": "<JSON string>", "actions": ["<action>", ...]}
+
+    with the keys and actions of a tutor_response schema, at least one action and no
+    action twice. States are hashable tuples so token masks can be cached per state.
+    """
+
+    def __init__(self, text_key: str, list_key: str, actions: List[str]):
+        self.actions = sorted(actions)
+        self.prefix = '{' + json.dumps(text_key) + ': "'
+        self.middle = ', ' + json.dumps(list_key) + ': ["'
+
+    @classmethod
+    def from_response_format(cls, response_format: dict) -> 'TutorResponseGrammar':
+        """Grammar for a response_format like prompts.RESPONSE_FORMAT"""
+        properties = response_format['json_schema']['schema']['properties']
+        text_keys = [key for key, spec in properties.items() if spec.get('type') == 'string']
+        list_keys = [key for key, spec in properties.items()
+                     if spec.get('type') == 'array' and 'enum' in spec.get('items', {})]
+        if len(properties) != 2 or len(text_keys) != 1 or len(list_keys) != 1:
+            raise ValueError("Only schemas shaped like tutor_response (a string and a list of enum values) are supported")
+        return cls(text_keys[0], list_keys[0], properties[list_keys[0]]['items']['enum'])
+
+    def start(self) -> tuple:
+        return ('literal', self.prefix, 0, ('string', False))
+
+    def is_final(self, state: tuple) -> bool:
+        return state[0] == 'done'
+
+    def advance(self, state: tuple, char: str) -> Optional[tuple]:
+        """The state after `char`, or None if the output can't continue with it"""
+        kind = state[0]
+        if kind == 'literal':
+            _, text, offset, then = state
+            if char != text[offset]:
+                return None
+            return ('literal', text, offset + 1, then) if offset + 1 < len(text) else then
+        if kind == 'string':
+            if state[1]:  # After a backslash
+                if char in '"\\/bfnrt':
+                    return ('string', False)
+                return ('hex', 4) if char == 'u' else None
+            if char == '"':
+                return ('literal', self.middle, 0, ('action', '', ()))
+            if char == '\\':
+                return ('string', True)
+            return ('string', False) if char >= ' ' else None
+        if kind == 'hex':
+            if char not in '0123456789abcdefABCDEF':
+                return None
+            return ('hex', state[1] - 1) if state[1] > 1 else ('string', False)
+        if kind == 'action':
+            _, prefix, used = state
+            if char == '"':
+                return ('after', tuple(sorted(used + (prefix,)))) if prefix in self.actions and prefix not in used else None
+            name = prefix + char
+            if any(action.startswith(name) and action not in used for action in self.actions):
+                return ('action', name, used)
+            return None
+        if kind == 'after':
+            used = state[1]
+            if char == ']':
+                return ('literal', '}', 0, ('done',))
+            if char == ',' and len(used) < len(self.actions):
+                return ('literal', ' "', 0, ('action', '', used))
+            return None
+        return None
+
+class TokenConstraint:
+    """
+    Which tokens keep the output inside a grammar
+
+    The vocabulary is stored as a character trie, and the allowed token ids for a
+    grammar state are found by walking it once and caching the result. There are only
+    a few dozen distinct states, so after the first completions every step is a lookup.
+
+    Args:
+        token_texts: Text of each token id. Empty strings (special tokens, partial
+                     UTF-8 bytes) are never allowed
+    """
+
+    def __init__(self, grammar: TutorResponseGrammar, token_texts: List[str]):
+        self.grammar = grammar
+        self.token_texts = token_texts
+        self.trie: Dict = {}
+        for token_id, text in enumerate(token_texts):
+            if not text:
+                continue
+            node = self.trie
+            for char in text:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(token_id)
+        self.masks: Dict[tuple, np.ndarray] = {}
+
+    def allowed(self, state: tuple) -> np.ndarray:
+        if state not in self.masks:
+            allowed = []
+            pending = [(self.trie, state)]
+            while pending:
+                node, node_state = pending.pop()
+                for char, child in node.items():
+                    if char is None:
+                        allowed.extend(child)
+                        continue
+                    next_state = self.grammar.advance(node_state, char)
+                    if next_state is not None:
+                        pending.append((child, next_state))
+            self.masks[state] = np.array(sorted(allowed), dtype=np.int64)
+        return self.masks[state]
+
+    def advance(self, state: tuple, token_id: int) -> tuple:
+        for char in self.token_texts[token_id]:
+            state = self.grammar.advance(state, char)
+        return state
+
+@dataclass
+class GenerationResult:
+    text: str
+    prompt_tokens: int
+    completion_tokens: int
+    finish_reason: str  # 'stop' once the output is complete, 'length' if it hit max_new_tokens
+
+@dataclass
+class _Sequence:
+    """A request inside the batcher"""
+    prompt: List[int]
+    constraint: Optional[TokenConstraint]
+    temperature: float
+    max_new_tokens: int
+    rng: np.random.Generator
+    future: Future
+    state: tuple = None
+    tokens: List[int] = field(default_factory=list)
+
+class ContinuousBatcher:
+    """
+    Runs generation for concurrent submit() calls on one background thread
+
+    Each iteration admits waiting requests into free slots (prefilling their prompts and
+    merging their caches into the batch's), then decodes one token for every active
+    sequence in a single batched forward pass. Sequences leave the batch as soon as they
+    finish, so short completions don't wait for long ones and the batch stays full while
+    there's work queued. Row i of the model's batch is always active[i].
+
+    Args:
+        model: Step model, see TransformersModel for the interface
+        max_batch: Sequences decoded together
+    """
+
+    def __init__(self, model, max_batch: int = 8):
+        self.model = model
+        self.max_batch = max_batch
+        self.waiting: deque = deque()
+        self.lock = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._loop, name='local-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt: List[int], constraint: Optional[TokenConstraint], temperature: float,
+               max_new_tokens: int, rng: np.random.Generator) -> Future:
+        """Queue a prompt, the future resolves to a GenerationResult"""
+        sequence = _Sequence(prompt, constraint, temperature, max_new_tokens, rng, Future())
+        if constraint:
+            sequence.state = constraint.grammar.start()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The batcher is closed")
+            self.waiting.append(sequence)
+            self.lock.notify()
+        return sequence.future
+
+    def close(self):
+        """Stop after the sequences in flight, failing requests that never started"""
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        self.thread.join()
+
+    def _loop(self):
+        active: List[_Sequence] = []
+        batch = None
+        while True:
+            with self.lock:
+                while not self.waiting and not active and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    while self.waiting:
+                        self.waiting.popleft().future.set_exception(RuntimeError("The batcher was closed"))
+                    if not active:
+                        return
+                admitted = [self.waiting.popleft() for _ in range(min(len(self.waiting), self.max_batch - len(active)))]
+
+            joined, caches = [], []
+            for sequence in admitted:
+                try:
+                    with stage('prefill'):
+                        cache, logits = self.model.prefill(sequence.prompt)
+                except Exception as e:
+                    sequence.future.set_exception(e)
+                    continue
+                if self._step(sequence, logits):
+                    joined.append(sequence)
+                    caches.append(cache)
+            if not active and not joined:
+                continue
+
+            try:
+                if joined:
+                    with stage('merge'):
+                        batch = self.model.merge(batch, caches)
+                    active += joined
+                with stage('decode step'):
+                    batch, logits = self.model.decode(batch, [s.tokens[-1] for s in active])
+            except Exception as e:
+                for sequence in active:
+                    sequence.future.set_exception(e)
+                active, batch = [], None
+                continue
+            keep = [i for i, (sequence, row) in enumerate(zip(active, logits)) if self._step(sequence, row)]
+            if len(keep) < len(active):
+                batch = self.model.select(batch, keep) if keep else None
+                active = [active[i] for i in keep]
+
+    def _step(self, sequence: _Sequence, logits: np.ndarray) -> bool:
+        """Sample the next token, returning False once the sequence is finished"""
+        if sequence.constraint:
+            candidates = sequence.constraint.allowed(sequence.state)
+        else:
+            candidates = np.arange(len(logits))
+        if not len(candidates):
+            return self._finish(sequence, 'length')
+
+        scores = logits[candidates].astype(np.float64)
+        if sequence.temperature <= 0:
+            token = int(candidates[np.argmax(scores)])
+        else:
+            scores = (scores - scores.max()) / sequence.temperature
+            probabilities = np.exp(scores)
+            token = int(sequence.rng.choice(candidates, p=probabilities / probabilities.sum()))
+
+        if sequence.constraint:
+            sequence.tokens.append(token)
+            sequence.state = sequence.constraint.advance(sequence.state, token)
+            if sequence.constraint.grammar.is_final(sequence.state):
+                return self._finish(sequence, 'stop')
+        elif token in self.model.eos_token_ids:
+            return self._finish(sequence, 'stop')
+        else:
+            sequence.tokens.append(token)
+        if len(sequence.tokens) >= sequence.max_new_tokens:
+            return self._finish(sequence, 'length')
+        return True
+
+    def _finish(self, sequence: _Sequence, reason: str) -> bool:
+        text = ''.join(self.model.token_texts[token] for token in sequence.tokens)
+        sequence.future.set_result(GenerationResult(text, len(sequence.prompt), len(sequence.tokens), reason))
+        return False
+
+class LocalBackend(ChatBackend):
+    """
+    ChatBackend generating with a local model
+
+    Args:
+        model: Step model, e.g. TransformersModel
+        max_batch: Sequences decoded together. Run the GenerationEngine with at least
+                   this much concurrency (cli.py uses twice as much) to keep the batch full
+        max_new_tokens: Completions longer than this end unfinished and fail validation
+        temperature: Sampling temperature (0 for greedy), unless the request sets one
+        seed: Seed for sampling
+    """
+
+    def __init__(self, model, max_batch: int = 8, max_new_tokens: int = 512, temperature: float = 1.0, seed: int = 0):
+        self.model = model
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.seed_lock = threading.Lock()
+        self.batcher = ContinuousBatcher(model, max_batch)
+        self.constraints: Dict[str, TokenConstraint] = {}
+
+    def constraint_for(self, response_format: Optional[dict]) -> Optional[TokenConstraint]:
+        if not response_format:
+            return None
+        key = json.dumps(response_format, sort_keys=True)
+        with self.seed_lock:
+            if key not in self.constraints:
+                grammar = TutorResponseGrammar.from_response_format(response_format)
+                self.constraints[key] = TokenConstraint(grammar, self.model.token_texts)
+            return self.constraints[key]
+
+    def create(self, request: dict) -> ChatCompletion:
+        prompt = self.model.encode_chat(request['messages'])
+        constraint = self.constraint_for(request.get('response_format'))
+        temperature = request.get('temperature', self.temperature)
+        with self.seed_lock:
+            seeds = self.seed_sequence.spawn(request.get('n', 1))
+        futures = [
+            self.batcher.submit(prompt, constraint, temperature, request.get('max_tokens', self.max_new_tokens),
+                                np.random.default_rng(seed))
+            for seed in seeds
+        ]
+        results = [future.result() for future in futures]
+        return ChatCompletion(
+            model=request['model'],
+            choices=[Choice(i, Message(result.text), result.finish_reason) for i, result in enumerate(results)],
+            usage=Usage(len(prompt), sum(result.completion_tokens for result in results)),
+        )
+
+    def close(self):
+        self.batcher.close()
+
+def decode_vocabulary(tokenizer) -> List[str]:
+    """
+    Text each token adds when appended to others, '' for special tokens and partial UTF-8
+
+    Tokens are decoded after a fixed prefix, since decoding one alone drops the
+    leading space of SentencePiece tokens.
+    """
+    prefix = tokenizer.encode('a', add_special_tokens=False)
+    base = tokenizer.decode(prefix)
+    special = set(tokenizer.all_special_ids)
+    texts = []
+    for token_id in range(len(tokenizer)):
+        text = '' if token_id in special else tokenizer.decode(prefix + [token_id])[len(base):]
+        texts.append('' if '\ufffd' in text else text)
+    return texts
+
+@dataclass
+class _Batch:
+    """KV cache of the sequences being decoded, left-padded to a common length"""
+    cache: object  # DynamicCache, (B, heads, L, head_dim) per layer
+    mask: object  # (B, L) attention mask, 0 over each row's padding
+    positions: object  # (B,) position id of each row's next token
+
+class TransformersModel:
+    """
+    A Hugging Face causal LM on CPU, as a step model for ContinuousBatcher
+
+    The interface the batcher uses: encode_chat(messages) -> prompt token ids,
+    prefill(tokens) -> (cache, last logits) for one sequence, merge(batch, caches) ->
+    batch with those sequences appended as rows, decode(batch, last tokens) -> (batch,
+    logits (B, V)), select(batch, rows) -> batch of just those rows, token_texts and
+    eos_token_ids. The batch keeps one KV cache for every sequence in flight: it is only
+    padded and copied when sequences join or leave, and a decode step just appends the
+    new token to it.
+
+    Args:
+        model: Hub id or local directory
+        gguf_file: GGUF checkpoint inside `model` to load instead of safetensors
+        threads: torch intra-op threads, defaults to torch's choice
+        dtype: Weights dtype, float32 or bfloat16
+    """
+
+    def __init__(self, model: str, gguf_file: str = None, threads: int = None, dtype: str = 'float32'):
+        if torch is None:
+            raise ImportError("TransformersModel needs torch and transformers: pip install torch transformers")
+        if threads:
+            torch.set_num_threads(threads)
+        self.name = model
+        self.tokenizer = AutoTokenizer.from_pretrained(model, gguf_file=gguf_file)
+        self.model = AutoModelForCausalLM.from_pretrained(model, gguf_file=gguf_file, torch_dtype=getattr(torch, dtype))
+        self.model.eval()
+        self.token_texts = decode_vocabulary(self.tokenizer)
+        eos = self.model.generation_config.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, list) else [eos if eos is not None else self.tokenizer.eos_token_id])
+
+    def encode_chat(self, messages: List[Dict]) -> List[int]:
+        return self.tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+
+    @staticmethod
+    def _layers(cache) -> Tuple:
+        return cache.to_legacy_cache() if hasattr(cache, 'to_legacy_cache') else cache
+
+    def prefill(self, tokens: List[int]):
+        with torch.inference_mode():
+            output = self.model(input_ids=torch.tensor([tokens]), use_cache=True)
+        return self._layers(output.past_key_values), output.logits[0, -1].float().numpy()
+
+    def merge(self, batch: Optional[_Batch], caches: List) -> _Batch:
+        """Append prefilled caches to the batch as new rows, left-padding everything to the longest"""
+        parts = [] if batch is None else [(self._layers(batch.cache), batch.mask, batch.positions)]
+        for cache in caches:
+            length = cache[0][0].shape[2]
+            parts.append((cache, torch.ones(1, length, dtype=torch.long), torch.tensor([length])))
+        longest = max(mask.shape[1] for _, mask, _ in parts)
+
+        def pad(tensor, length):
+            return torch.nn.functional.pad(tensor, (0, 0, longest - length, 0))
+
+        with torch.inference_mode():
+            layers = tuple(
+                (torch.cat([pad(cache[layer][0], mask.shape[1]) for cache, mask, _ in parts]),
+                 torch.cat([pad(cache[layer][1], mask.shape[1]) for cache, mask, _ in parts]))
+                for layer in range(len(parts[0][0]))
+            )
+        mask = torch.cat([torch.nn.functional.pad(mask, (longest - mask.shape[1], 0)) for _, mask, _ in parts])
+        positions = torch.cat([positions for _, _, positions in parts])
+        return _Batch(DynamicCache.from_legacy_cache(layers), mask, positions)
+
+    def select(self, batch: _Batch, rows: List[int]) -> _Batch:
+        """The batch with only `rows` left, trimming the columns that are now padding in all of them"""
+        index = torch.tensor(rows)
+        mask = batch.mask[index]
+        start = int(mask.any(dim=0).long().argmax())
+        with torch.inference_mode():
+            layers = tuple((key[index, :, start:], value[index, :, start:]) for key, value in self._layers(batch.cache))
+        return _Batch(DynamicCache.from_legacy_cache(layers), mask[:, start:], batch.positions[index])
+
+    def decode(self, batch: _Batch, tokens: List[int]):
+        mask = torch.cat([batch.mask, torch.ones(len(tokens), 1, dtype=torch.long)], dim=1)
+        with torch.inference_mode():
+            output = self.model(
+                input_ids=torch.tensor(tokens)[:, None],
+                past_key_values=batch.cache,
+                attention_mask=mask,
+                position_ids=batch.positions[:, None],
+                use_cache=True,
+            )
+        # The cache grew by the new token in place, nothing else is copied
+        return _Batch(output.past_key_values, mask, batch.positions + 1), output.logits[:, -1].float().numpy()
@@ -1,12 +1,18 @@
 # main.py
-from action_distribution_analysis import ActionAnalysis
 from data_processing import process_conversation
+from dataset_cache import load_processed_conversations
 import json
 from dotenv import load_dotenv
 import os
 
-from analysis import analyze_conditional_action_distribution, analyze_tutor_action_distribution
-from llm_responses import LLMTutor
+from generation import GenerationConfig, GenerationEngine
+import profiling
+from profiling import stage
+from llm_responses import DEFAULT_BASE_URL, LLMTutor
+from response_cache import DEFAULT_CACHE_PATH, ResponseCache
+from response_store import DEFAULT_STORE_PATH, ResponseStore
+from telemetry import DEFAULT_METRICS_FILE, Telemetry
+from transport import TransportConfig, shared_http_client, shared_metrics
 
 def load_dataset():
     """Load and return the CIMA dataset"""
@@ -25,6 +31,9 @@ def process_all_conversations(data):
 
 def analyze_distributions(processed_conversations):
     """Analyze and print action distributions"""
+    # Imported here so generation doesn't load matplotlib
+    from analysis import analyze_conditional_action_distribution, analyze_tutor_action_distribution
+
     # Analyze human tutors actions
     action_distribution = analyze_tutor_action_distribution(processed_conversations)
     print("\nAction Distribution:")
@@ -34,46 +43,102 @@ def analyze_distributions(processed_conversations):
     conditional_distribution = analyze_conditional_action_distribution(processed_conversations)
     return action_distribution, conditional_distribution
 
-def generate_ai_responses(processed_conversations, model_name):
-    """Generate AI responses for each conversation using LLMTutor"""
+MODEL_NAMES = [
+    "google/gemini-pro-1.5",
+    "openai/gpt-4o-2024-08-06",
+    "meta-llama/llama-3.1-405b-instruct:nitro",
+]
+
+def generate_ai_responses(processed_conversations, model_name, config: GenerationConfig = None,
+                          cache_path: str = DEFAULT_CACHE_PATH, replay: bool = False, samples: int = 1):
+    """Generate AI responses from a single model (see generate_all_models)"""
+    return generate_all_models(processed_conversations, [model_name], config, cache_path, replay, samples)
+
+def generate_all_models(processed_conversations, model_names, config: GenerationConfig = None,
+                        cache_path: str = DEFAULT_CACHE_PATH, replay: bool = False, samples: int = 1,
+                        transport: TransportConfig = None, metrics_file: str = DEFAULT_METRICS_FILE,
+                        stream: bool = False, store_path: str = DEFAULT_STORE_PATH, backend=None):
+    """
+    Generate AI responses for each conversation from every model in one pass
+
+    Prompts are built once and shared by all models, and all (model, conversation)
+    jobs run on one work queue with per-model concurrency caps. Responses are saved
+    to the SQLite store at `store_path` as they arrive and exported to each model's
+    data/<model>_responses.json at the end.
+
+    Completions are cached in `cache_path`. With replay=True no API calls are made
+    and everything is served from the cache (missing entries are reported as failures).
+
+    With samples > 1 each conversation gets an ensemble of that many responses, stored
+    as a list per conversation in data/<model>_ensemble<samples>_responses.json.
 
-    # Load existing AI responses if available
-    ai_responses_file = f'{model_name}_responses.json'
-    existing_responses = {}
-    if os.path.exists(ai_responses_file):
-        with open(ai_responses_file, 'r') as f:
-            existing_responses = json.load(f)
+    All models share one pooled HTTP client configured by `transport`. Every call's
+    latency, tokens, status and retries are appended to `metrics_file` and summarised
+    per model at the end.
 
+    With stream=True completions are validated while they stream in and malformed ones
+    are abandoned early. Either way invalid outputs are requeued, never saved.
+
+    With a `backend` (see local_backend.py) completions are generated by it instead of
+    the API, and no API key is needed.
+    """
     load_dotenv()
     api_key = os.getenv('API_KEY')
-    if not api_key:
-        raise ValueError("API_KEY not found in environment variables")
-        
-    llm_tutor = LLMTutor(api_key)
-    
-    
-    new_responses = {}
-    # Generate responses for each conversation
-    for i, conversation in enumerate(processed_conversations):
-
-        if i in existing_responses:
-            print(f"Skipping conversation {i} - already processed")
-            continue
-
-        llm_response = llm_tutor.generate_response(conversation, model_name)
-        new_responses[i] = {
-            'response': llm_response.response,
-            'actions': llm_response.actions
-        }
-
-         # Save after each generation to prevent loss
-        all_responses = {**existing_responses, **new_responses}
-        os.makedirs(os.path.dirname(ai_responses_file), exist_ok=True)
-        with open(ai_responses_file, 'w') as f:
-            json.dump(all_responses, f, indent=2)
-            
-        print(f"Processed conversation {i}")
-    
+    if not api_key and backend is None:
+        if not replay:
+            raise ValueError("API_KEY not found in environment variables")
+        api_key = 'replay'  # Never sent, every request is answered from the cache
+
+    cache = ResponseCache(cache_path, replay=replay)
+    telemetry = Telemetry(metrics_file)
+
+    # API_BASE_URL lets a run target a local fake server (see fake_openai_server.py)
+    # Retries are handled by the engine, so the client itself doesn't retry
+    llm_tutor = LLMTutor(api_key, base_url=os.getenv('API_BASE_URL', DEFAULT_BASE_URL), max_retries=0, cache=cache,
+                         http_client=shared_http_client(transport), telemetry=telemetry, stream=stream, backend=backend)
+    engine = GenerationEngine(llm_tutor, config)
+
+    # Responses are written to the store as they arrive and exported to data/<model>_responses.json on close
+    stores = {model_name: ResponseStore(model_name, samples, store_path) for model_name in model_names}
+    try:
+        todo = {}
+        for model_name, store in stores.items():
+            todo[model_name] = [i for i in range(len(processed_conversations)) if i not in store]
+            print(f"{model_name}: skipping {len(processed_conversations) - len(todo[model_name])} conversations - already processed")
+
+        # Prompts don't depend on the model, build them once for every conversation still needed
+        needed = sorted(set().union(*todo.values()))
+        with stage('build prompts'):
+            messages = dict(zip(needed, llm_tutor.build_messages_batch([processed_conversations[i] for i in needed])))
+        jobs = [(model_name, i, messages[i]) for model_name, indices in todo.items() for i in indices]
+
+        def to_record(llm_response):
+            return {
+                'response': llm_response.response,
+                'actions': llm_response.actions
+            }
+
+        def save_response(model_name, i, result):
+            # Ensembles are saved in the list-of-responses layout the plots accept
+            record = [to_record(r) for r in result] if samples > 1 else to_record(result)
+            stores[model_name].append(i, record)
+            print(f"Processed conversation {i} for {model_name}")
+
+        with stage('generate'):
+            engine.run_many(jobs, on_result=save_response, samples=samples)
+    finally:
+        with stage('export responses'):
+            for store in stores.values():
+                store.close()
+        telemetry.close()
+        telemetry.print_summary()
+        shared_metrics().print_summary()
+
+    if engine.failed:
+        print(f"{len(engine.failed)} jobs failed, rerun to retry them: {sorted(engine.failed)}")
+    print(f"Response cache: {cache.stats()}")
+    cache.close()
+
     return processed_conversations
 
 def print_conversation_details(conversations):
@@ -90,40 +155,44 @@ def print_conversation_details(conversations):
             for j, tr in enumerate(conv.tutor_responses, 1):
                 print(f"\n  Response {j}:")
                 print(f"    Text: {tr.response}")
-                action_types = ['Question', 'Hint', 'Correction', 'Confirmation', 'Other']
                 print("    Actions:", end=" ")
-                active_actions = [action for action, is_active in zip(action_types, tr.actions) if is_active]
+                active_actions = [action.title() for action in tr.actions]
                 print(", ".join(active_actions) if active_actions else "None")
             
             # Print context information
             print("\nContext:")
-            target_phrase = conv.context['target_phrase']
-            print(f"  Target Phrase (IT): {target_phrase['it']}")
-            print(f"  Target Phrase (EN): {target_phrase['en']}")
+            print(f"  Target Phrase (IT): {conv.target_phrase_it}")
+            print(f"  Target Phrase (EN): {conv.target_phrase_en}")
             
             print("\nGrammar Rules:")
-            for rule in conv.context['grammar_rules']:
+            for rule in conv.grammar_rules:
                 print(f"  • {rule}")
             
             print("\nConversation History:")
-            for j, msg in enumerate(conv.context['conversation_history'], 1):
+            for j, msg in enumerate(conv.conversation_history, 1):
                 print(f"  {j}. {msg}")
             
             print("\n" + "=" * 50)
 
         
-def run_analysis():
-    """Main function to run the full analysis"""
-    data = load_dataset()
-    processed_conversations = process_all_conversations(data)
-
-    # model_name = "google/gemini-pro-1.5"
-    model_name = "openai/gpt-4o-2024-08-06"
-    # model_name = "meta-llama/llama-3.1-405b-instruct:nitro"
-    processed_conversations = generate_ai_responses(processed_conversations, model_name)
+def run_analysis(profile_dir: str = None):
+    """
+    Main function to run the full analysis
+
+    Args:
+        profile_dir: Profile the run and write the reports here (see profiling.py)
+    """
+    if profile_dir:
+        with profiling.enabled(profile_dir):
+            return run_analysis()
+
+    # Same result as process_all_conversations(load_dataset()), served from the column cache
+    processed_conversations = load_processed_conversations()
+
+    processed_conversations = generate_all_models(processed_conversations, MODEL_NAMES)
     # print_conversation_details(processed_conversations[:10])
     # action_dist, cond_dist = analyze_distributions(processed_conversations)
 
 if __name__ == "__main__":
-    run_analysis()
+    run_analysis(os.getenv('PROFILE_DIR'))
     
\ No newline at end of file
@@ -0,0 +1,361 @@
+import contextlib
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from fnmatch import fnmatch
+from typing import Callable, Dict, List, Tuple
+
+from dataset_cache import DEFAULT_SOURCE, file_hash
+import profiling
+from journal import atomic_write_json
+from render_scheduler import _init_worker
+
+DEFAULT_STATE_FILE = '.cache/pipeline_state.json'
+DEFAULT_WORK_DIR = '.cache/pipeline'
+
+@dataclass
+class Stage:
+    """
+    One step of the pipeline: run(inputs, outputs, **params) reads `inputs` and writes `outputs`.
+
+    Stages that read another stage's outputs run after it. Everything else is
+    independent and may run at the same time.
+    """
+    name: str
+    run: Callable  # Module-level function, so it can be sent to a worker process
+    inputs: List[str]
+    outputs: List[str]
+    params: Dict = field(default_factory=dict)
+    code: List[str] = field(default_factory=list)  # Modules besides run's own whose source is part of the stage
+
+def _module_source(module: str) -> str:
+    """Path of a module's source without importing it"""
+    spec = importlib.util.find_spec(module)
+    if spec is None or not spec.origin:
+        raise ValueError(f"Can't find the source of module {module!r}")
+    return spec.origin
+
+class Pipeline:
+    """
+    A graph of stages rebuilt incrementally from content hashes.
+
+    A stage's fingerprint covers the contents of its inputs, its parameters and the
+    source of its code. It is re-run when the fingerprint differs from the one recorded
+    after its last successful run, or when an output is missing or no longer matches
+    the hash recorded for it. Inputs are hashed only once their producers are done, so
+    a stage that re-runs but writes identical outputs doesn't cascade further.
+
+    Stages run on a process pool as soon as everything they read is up to date.
+
+    Args:
+        stages: The stages, in any order
+        state_file: Where fingerprints and output hashes are kept between runs
+    """
+
+    def __init__(self, stages: List[Stage], state_file: str = DEFAULT_STATE_FILE):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_file = state_file
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+
+        self.producers: Dict[str, str] = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f"{output} is written by both {self.producers[output]} and {stage.name}")
+                self.producers[output] = stage.name
+        self.deps = {
+            stage.name: sorted({self.producers[i] for i in stage.inputs if i in self.producers} - {stage.name})
+            for stage in stages
+        }
+        self.order = self._topological_order()
+
+        self.state = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.state = json.load(f)
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+
+    def _topological_order(self) -> List[str]:
+        order, visiting, visited = [], set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} depends on itself")
+            visiting.add(name)
+            for dep in self.deps[name]:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def hash_file(self, path: str) -> str:
+        """Content hash, reused while the file's size and mtime are unchanged"""
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        digest = file_hash(path)
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def fingerprint(self, stage: Stage) -> str:
+        """Hash of the stage's input contents, parameters and code"""
+        digest = hashlib.sha256()
+        digest.update(stage.name.encode('utf-8'))
+        digest.update(json.dumps(stage.params, sort_keys=True, default=repr).encode('utf-8'))
+        digest.update(inspect.getsource(stage.run).encode('utf-8'))
+        for module in sorted(stage.code):
+            digest.update(self.hash_file(_module_source(module)).encode('utf-8'))
+        for path in sorted(stage.inputs):
+            digest.update(path.encode('utf-8'))
+            digest.update(self.hash_file(path).encode('utf-8') if os.path.exists(path) else b'missing')
+        return digest.hexdigest()
+
+    def up_to_date(self, stage: Stage, fingerprint: str) -> bool:
+        recorded = self.state.get(stage.name)
+        if not recorded or recorded['fingerprint'] != fingerprint:
+            return False
+        return all(
+            os.path.exists(path) and self.hash_file(path) == recorded['outputs'].get(path)
+            for path in stage.outputs
+        )
+
+    def select(self, patterns: List[str] = None) -> List[str]:
+        """Stages whose name matches any of the glob patterns, plus everything they depend on"""
+        if not patterns:
+            return list(self.order)
+        selected = set()
+
+        def add(name):
+            if name not in selected:
+                selected.add(name)
+                for dep in self.deps[name]:
+                    add(dep)
+
+        for name in self.stages:
+            if any(fnmatch(name, pattern) for pattern in patterns):
+                add(name)
+        return [name for name in self.order if name in selected]
+
+    def run(self, workers: int = None, force: bool = False, targets: List[str] = None,
+            dry_run: bool = False) -> Dict[str, str]:
+        """
+        Bring the selected stages up to date
+
+        Args:
+            workers: Worker processes, defaults to one per core
+            force: Re-run every selected stage
+            targets: Glob patterns of stage names to build (with their dependencies), default all
+            dry_run: Only report what would run. Stages downstream of a stale one count as stale
+
+        Returns:
+            Status of each selected stage: 'ran', 'up to date', 'failed' or 'skipped'
+            (a dependency failed); 'stale' for a dry run
+        """
+        names = self.select(targets)
+        if dry_run:
+            status = {}
+            for name in names:
+                stage = self.stages[name]
+                stale = force or any(status.get(dep) == 'stale' for dep in self.deps[name]) \
+                    or not self.up_to_date(stage, self.fingerprint(stage))
+                status[name] = 'stale' if stale else 'up to date'
+            for name in names:
+                print(f"  {status[name]:>10}  {name}")
+            return status
+
+        status: Dict[str, str] = {}
+        fingerprints: Dict[str, str] = {}
+        timings: Dict[str, float] = {}
+        waiting = list(names)
+        running = {}
+
+        # When profiling, stages run inline on the main thread, which cProfile and tracemalloc follow
+        inline = profiling.is_enabled()
+        if inline:
+            _init_worker()
+        with contextlib.nullcontext() if inline else ProcessPoolExecutor(max_workers=workers,
+                                                                         initializer=_init_worker) as executor:
+            while waiting or running:
+                # Start (or skip) every stage whose dependencies are finished
+                for name in list(waiting):
+                    deps = [dep for dep in self.deps[name] if dep in names]
+                    if any(dep not in status for dep in deps):
+                        continue
+                    waiting.remove(name)
+                    if any(status[dep] in ('failed', 'skipped') for dep in deps):
+                        status[name] = 'skipped'
+                        continue
+                    stage = self.stages[name]
+                    fingerprints[name] = self.fingerprint(stage)
+                    if not force and self.up_to_date(stage, fingerprints[name]):
+                        status[name] = 'up to date'
+                        continue
+                    running[_run_inline(stage) if inline else executor.submit(_run_stage, stage)] = name
+
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    stage = self.stages[name]
+                    try:
+                        timings[name] = future.result()
+                        missing = [path for path in stage.outputs if not os.path.exists(path)]
+                        if missing:
+                            raise RuntimeError(f"didn't write {', '.join(missing)}")
+                    except Exception as e:
+                        print(f"Stage {name} failed: {e}")
+                        status[name] = 'failed'
+                        self.state.pop(name, None)
+                        continue
+                    status[name] = 'ran'
+                    self.state[name] = {
+                        'fingerprint': fingerprints[name],
+                        'outputs': {path: self.hash_file(path) for path in stage.outputs},
+                    }
+                    # Saved after every stage, so an interrupted run keeps what it finished
+                    atomic_write_json(self.state_file, self.state)
+
+        counts = {s: sum(1 for v in status.values() if v == s) for s in ('ran', 'up to date', 'failed', 'skipped')}
+        print(f"Pipeline: {', '.join(f'{n} {s}' for s, n in counts.items() if n)}")
+        for name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+            print(f"  {seconds:6.2f}s  {name}")
+        return status
+
+def _run_stage(stage: Stage) -> float:
+    start = time.perf_counter()
+    for path in stage.outputs:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with profiling.stage(stage.name):
+        stage.run(stage.inputs, stage.outputs, **stage.params)
+    return time.perf_counter() - start
+
+def _run_inline(stage: Stage) -> Future:
+    """Run a stage in this thread, returning its outcome as an already finished future"""
+    future = Future()
+    try:
+        future.set_result(_run_stage(stage))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+# Stage functions. Inputs and outputs are in the order the stage was declared with
+
+def run_transform(inputs, outputs):
+    """dataset -> human tutor responses in the model responses layout"""
+    from dataset_cache import load_columns
+    from transform_cima import transform_columns_to_gemini_format
+
+    # Written like `cli.py transform`, so an unchanged dataset gives a byte-identical file
+    with open(outputs[0], 'w', encoding='utf-8') as f:
+        json.dump(transform_columns_to_gemini_format(load_columns(inputs[0])), f, indent=2, ensure_ascii=False)
+
+def run_aggregates(inputs, outputs):
+    """(responses file, dataset) -> pickled SourceAggregates"""
+    from dataset_cache import load_columns
+    from visualization import compute_aggregates, load_json_data
+
+    aggregates = compute_aggregates(load_json_data(inputs[0]), load_columns(inputs[1]).student_actions)
+    with open(outputs[0], 'wb') as f:
+        pickle.dump(aggregates, f)
+
+def run_figures(inputs, outputs, name, plots_dir):
+    """pickled SourceAggregates -> the source's figures"""
+    from visualization import figure_jobs
+
+    with open(inputs[0], 'rb') as f:
+        aggregates = pickle.load(f)
+    for job in figure_jobs(name, aggregates, plots_dir):
+        job.render(job.aggregates, job.title, job.output_dir)
+
+def run_stats(inputs, outputs, n_resamples, seed):
+    """(dataset, responses file) -> human vs model action_stats.compare() results"""
+    from action_matrix import ActionMatrices
+    from action_stats import compare, paired_matrices
+    from dataset_cache import load_columns
+
+    human = ActionMatrices.from_columns(load_columns(inputs[0]))
+    with open(inputs[1], 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    result = compare(*paired_matrices(human, data), n_resamples=n_resamples, n_permutations=n_resamples, seed=seed)
+    atomic_write_json(outputs[0], result)
+
+def run_combine(inputs, outputs, folder):
+    """figures in a folder -> one grid image"""
+    from pretty_plots import combine_plots_from_folder
+
+    combine_plots_from_folder(folder, os.path.basename(outputs[0]))
+
+def _slug(name: str) -> str:
+    return name.lower().replace(' ', '_').replace('/', '_')
+
+def build_stages(sources: List[Tuple[str, str]] = None, dataset: str = DEFAULT_SOURCE,
+                 human_file: str = 'data/cima_formatted.json', plots_dir: str = 'plots',
+                 work_dir: str = DEFAULT_WORK_DIR, n_resamples: int = 2000, seed: int = 0) -> List[Stage]:
+    """
+    The analysis pipeline, from the dataset and model responses files to figures, grids and statistics
+
+    Every source gets its own aggregates and figures stages, and every model its own
+    stats stage, so editing one model's responses file only rebuilds that model's
+    stages (and the grids that include its figures). Generation isn't a stage: it
+    costs API calls, so it stays an explicit `cli.py generate`.
+
+    Args:
+        sources: (responses file, display name) pairs, default visualization.SOURCES
+        dataset: The CIMA dataset file
+        human_file: The human baseline among the sources, written from the dataset by the transform stage
+        plots_dir: Where figures go (grids always go to plots/grid, see pretty_plots)
+        work_dir: Where intermediate aggregates and statistics go
+        n_resamples, seed: Passed on to action_stats.compare()
+    """
+    from visualization import PLOT_TYPES, SOURCES, figure_jobs
+
+    sources = sources or SOURCES
+    stages = [Stage('transform', run_transform, [dataset], [human_file],
+                    code=['transform_cima', 'dataset_cache', 'data_processing'])]
+
+    figures_by_folder: Dict[str, List[str]] = {}
+    for file_path, name in sources:
+        aggregates_file = os.path.join(work_dir, 'aggregates', f'{_slug(name)}.pkl')
+        figures = [job.output_path for job in figure_jobs(name, None, plots_dir)]
+        stages.append(Stage(f'aggregates:{name}', run_aggregates, [file_path, dataset], [aggregates_file],
+                            code=['visualization', 'action_matrix']))
+        stages.append(Stage(f'figures:{name}', run_figures, [aggregates_file], figures,
+                            params={'name': name, 'plots_dir': plots_dir}, code=['visualization']))
+        for path in figures:
+            figures_by_folder.setdefault(os.path.dirname(path), []).append(path)
+
+        if file_path != human_file:
+            stages.append(Stage(f'stats:{name}', run_stats, [dataset, file_path],
+                                [os.path.join(work_dir, 'stats', f'{_slug(name)}.json')],
+                                params={'n_resamples': n_resamples, 'seed': seed},
+                                code=['action_stats', 'action_matrix']))
+
+    # Grids of the image figures (the interaction flows are HTML)
+    for _, _, subdir, extension in PLOT_TYPES:
+        if extension == 'html':
+            continue
+        folder = os.path.join(plots_dir, subdir)
+        stages.append(Stage(f'combine:{subdir}', run_combine, figures_by_folder[folder],
+                            [os.path.join('plots/grid', f'{subdir}.png')],
+                            params={'folder': folder}, code=['pretty_plots']))
+    return stages
+
+def run_pipeline(workers: int = None, force: bool = False, targets: List[str] = None, dry_run: bool = False,
+                 state_file: str = DEFAULT_STATE_FILE, **kwargs) -> Dict[str, str]:
+    """Build the default stages (see build_stages, which takes **kwargs) and bring them up to date"""
+    return Pipeline(build_stages(**kwargs), state_file).run(workers, force, targets, dry_run)
@@ -1,74 +1,104 @@
-import matplotlib.pyplot as plt
 import os
 from PIL import Image
 import math
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-def combine_plots_from_folder(folder_path, output_filename='combined_plots.png', max_size=(2000, 2000)):
+from profiling import profiled
+
+def load_tile(path, cell_size):
+    """
+    Decode an image downsampled to fit in cell_size
+
+    draft() lets JPEG decoding skip straight to a smaller scale, and thumbnail()
+    resizes in reduced steps, so large inputs are never decoded at full quality for nothing.
+    """
+    img = Image.open(path)
+    img.draft('RGB', cell_size)
+    img = img.convert('RGB')
+    img.thumbnail(cell_size, reducing_gap=2.0)
+    return img
+
+@profiled('combine plots')
+def combine_plots_from_folder(folder_path, output_filename='combined_plots.png', max_size=(2000, 2000),
+                              padding=20, rows_per_tile=None, workers=None):
     """
     Combines all image files from a folder into a grid layout
-    
+
+    Tiles are pasted straight into one preallocated canvas instead of being redrawn
+    through matplotlib.
+
     Args:
         folder_path (str): Path to the folder containing plot images
         output_filename (str): Name of the output file (default: 'combined_plots.png')
         max_size (tuple): Maximum dimensions (width, height) for the output image
+        padding (int): Pixels between tiles (before scaling to max_size)
+        rows_per_tile (int): If set, write the grid in horizontal strips of this many rows
+                             (<name>_tile<k>.png) so only one strip is in memory at a time
+        workers (int): Threads used to decode images, defaults to ThreadPoolExecutor's default
+
+    Returns:
+        List of written file paths
     """
     # Get all image files from the folder
-    image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    
+    image_files = sorted(f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+
     if not image_files:
         print("No image files found in the specified folder")
-        return
-    
+        return []
+
     # Calculate grid dimensions
     n_images = len(image_files)
     n_cols = math.ceil(math.sqrt(n_images))
     n_rows = math.ceil(n_images / n_cols)
-    
-    # Create figure with subplots
-    fig, axes = plt.subplots(n_rows, n_cols, figsize=(15, 15))
-    fig.tight_layout(pad=3.0)
-    
-    # If there's only one subplot, wrap it in a list for consistent indexing
-    if n_images == 1:
-        axes = np.array([[axes]])
-    elif n_rows == 1:
-        axes = axes.reshape(1, -1)
-    
-    # Plot each image
-    for idx, img_file in enumerate(image_files):
-        row = idx // n_cols
-        col = idx % n_cols
-        
-        
-        img = Image.open(os.path.join(folder_path, img_file))
-            
-        axes[row, col].imshow(img)
-        axes[row, col].axis('off')
-    
-    # Hide empty subplots
-    for idx in range(n_images, n_rows * n_cols):
-        row = idx // n_cols
-        col = idx % n_cols
-        axes[row, col].axis('off')
-        axes[row, col].set_visible(False)
-    
+
+    # Cell size from the largest image, read from headers without decoding pixels
+    paths = [os.path.join(folder_path, f) for f in image_files]
+    sizes = []
+    for path in paths:
+        with Image.open(path) as img:
+            sizes.append(img.size)
+    cell_w = max(w for w, _ in sizes) + padding
+    cell_h = max(h for _, h in sizes) + padding
+
+    # Shrink every cell so the whole grid fits in max_size
+    scale = min(1.0, max_size[0] / (n_cols * cell_w), max_size[1] / (n_rows * cell_h))
+    cell_w, cell_h = max(1, int(cell_w * scale)), max(1, int(cell_h * scale))
+    pad = int(padding * scale)
+    tile_box = (max(1, cell_w - pad), max(1, cell_h - pad))
+
     # Create grid subdirectory if it doesn't exist
     os.makedirs('plots/grid', exist_ok=True)
-    
-    # Save the combined plot
-    plt.savefig(os.path.join('plots/grid', output_filename), bbox_inches='tight', dpi=300)
-    # plt.show()
-    plt.close()
+    name, extension = os.path.splitext(output_filename)
+    rows_per_tile = rows_per_tile or n_rows
+    n_tiles = math.ceil(n_rows / rows_per_tile)
 
-if __name__ == "__main__":
-    # Create plots directory if it doesn't exist
-    os.makedirs('plots', exist_ok=True)
+    written = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for tile in range(n_tiles):
+            first_row = tile * rows_per_tile
+            rows = min(rows_per_tile, n_rows - first_row)
+            indices = range(first_row * n_cols, min(n_images, (first_row + rows) * n_cols))
+
+            canvas = Image.new('RGB', (n_cols * cell_w, rows * cell_h), 'white')
 
-    combine_plots_from_folder('plots/action_dist', 'action_dist.png')
-    combine_plots_from_folder('plots/actions_per_response', 'actions_per_response.png')
-    combine_plots_from_folder('plots/conditional_flows', 'conditional_flows.png')
+            # Decode this strip's images in parallel, paste each one centred in its cell
+            for idx, img in zip(indices, executor.map(lambda i: load_tile(paths[i], tile_box), indices)):
+                row = idx // n_cols - first_row
+                col = idx % n_cols
+                x = col * cell_w + (cell_w - img.width) // 2
+                y = row * cell_h + (cell_h - img.height) // 2
+                canvas.paste(img, (x, y))
+                img.close()
 
-    
-    
+            # Save the combined plot
+            filename = output_filename if n_tiles == 1 else f"{name}_tile{tile}{extension}"
+            output_path = os.path.join('plots/grid', filename)
+            canvas.save(output_path)
+            written.append(output_path)
 
+    return written
+
+if __name__ == "__main__":
+    # Same as `python cli.py combine`
+    from cli import main
+    main(['combine'])
@@ -0,0 +1,263 @@
+"""
+Opt-in profiling: per-stage wall/CPU timers, a sampling profiler writing flamegraph
+stacks, cProfile or pyinstrument, and tracemalloc snapshots.
+
+Code marks its stages with `with stage('name'):` or `@profiled('name')`. Until a
+profiler is enabled these cost one global lookup, so they stay in the hot paths:
+
+    with profiling.enabled('profiles/run'):
+        run_analysis()
+
+or `python cli.py --profile profiles/run <command>`. The output directory gets:
+    stages.txt / stages.json   Wall and CPU time per stage, nested stages as 'outer/inner'
+    profile.collapsed          Sampled stacks of every thread, in the collapsed format
+                               flamegraph.pl, speedscope and inferno read
+    profile.prof               cProfile stats of the main thread (snakeviz, pstats), or
+    profile.html               pyinstrument's report with tracer='pyinstrument'
+    memory.txt                 tracemalloc: current/peak after each top-level stage and
+                               where the memory it kept was allocated
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+_profiler: Optional['Profiler'] = None
+_NO_STAGE = contextlib.nullcontext()
+
+def stage(name: str):
+    """Context manager timing a stage while profiling is enabled, a shared no-op otherwise"""
+    if _profiler is None:
+        return _NO_STAGE
+    return _profiler.stage(name)
+
+def profiled(name: str = None):
+    """Decorator version of stage(), named after the function by default"""
+    def decorate(fn):
+        label = name or fn.__qualname__
+
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _profiler.stage(label):
+                return fn(*args, **kwargs)
+
+        wrapper.__name__, wrapper.__qualname__, wrapper.__doc__ = fn.__name__, fn.__qualname__, fn.__doc__
+        wrapper.__wrapped__ = fn
+        return wrapper
+    return decorate
+
+def is_enabled() -> bool:
+    return _profiler is not None
+
+class StageTimer:
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler.local_stack()
+        stack.append(self.name)
+        self.path = '/'.join(stack)
+        with self.profiler.lock:
+            self.profiler.first_seen.setdefault(self.path, len(self.profiler.first_seen))
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        stack = self.profiler.local_stack()
+        stack.pop()
+        self.profiler.add_timing(self.path, wall, cpu, top_level=not stack)
+
+class Sampler(threading.Thread):
+    """Samples the stacks of all other threads every `interval` seconds into collapsed-stack counts"""
+
+    def __init__(self, interval: float = 0.005):
+        super().__init__(name='profiling-sampler', daemon=True)
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                frames.append(names.get(ident, f'thread-{ident}'))
+                self.stacks[';'.join(reversed(frames))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class Profiler:
+    """
+    Collects everything profiling.py writes. Use enabled() rather than creating one directly.
+
+    Args:
+        output_dir: Where the reports go
+        tracer: 'cprofile', 'pyinstrument' (if installed) or None for sampling and timers only
+        memory: Take tracemalloc snapshots (slows allocation-heavy code down noticeably)
+        interval: Sampling interval in seconds
+    """
+
+    def __init__(self, output_dir: str, tracer: Optional[str] = 'cprofile', memory: bool = True,
+                 interval: float = 0.005):
+        self.output_dir = output_dir
+        self.tracer_name = tracer
+        self.memory = memory
+        self.timings: Dict[str, List[float]] = {}  # path -> [calls, wall, cpu]
+        self.first_seen: Dict[str, int] = {}  # path -> order stages were first entered in
+        self.snapshots: List[tuple] = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.sampler = Sampler(interval)
+        self.tracer = None
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    def local_stack(self) -> List[str]:
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def stage(self, name: str) -> StageTimer:
+        return StageTimer(self, name)
+
+    def add_timing(self, path: str, wall: float, cpu: float, top_level: bool):
+        with self.lock:
+            entry = self.timings.setdefault(path, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+        if top_level and self.memory and threading.current_thread() is threading.main_thread():
+            self.snapshot(path)
+
+    def snapshot(self, label: str):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        self.snapshots.append((label, current, peak, tracemalloc.take_snapshot()))
+
+    def start(self):
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+            self.snapshots.append(('start', 0, 0, tracemalloc.take_snapshot()))
+        if self.tracer_name == 'cprofile':
+            import cProfile
+            self.tracer = cProfile.Profile()
+            self.tracer.enable()
+        elif self.tracer_name == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler as Pyinstrument
+            except ImportError:
+                print("pyinstrument isn't installed, profiling with the sampler only")
+                self.tracer_name = None
+            else:
+                self.tracer = Pyinstrument(interval=self.sampler.interval)
+                self.tracer.start()
+        self.sampler.start()
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+        self.sampler.stop()
+        if self.tracer_name == 'cprofile':
+            self.tracer.disable()
+        elif self.tracer_name == 'pyinstrument':
+            self.tracer.stop()
+        if self.memory:
+            import tracemalloc
+            self.snapshot('end')
+            tracemalloc.stop()
+
+    def tree_key(self, path: str) -> tuple:
+        """Sorts every stage right after its parent, and siblings in the order they first ran"""
+        parts = path.split('/')
+        return tuple(self.first_seen['/'.join(parts[:depth])] for depth in range(1, len(parts) + 1))
+
+    def stage_rows(self) -> List[dict]:
+        with self.lock:
+            timings = {path: list(values) for path, values in self.timings.items()}
+        return [
+            {'stage': path, 'calls': calls, 'wall': wall, 'cpu': cpu,
+             'share': wall / self.elapsed if self.elapsed else 0.0}
+            for path, (calls, wall, cpu) in sorted(timings.items(), key=lambda item: self.tree_key(item[0]))
+        ]
+
+    def stage_table(self) -> str:
+        """Stages as a tree, each under its parent. Stages run on several threads can add up to more than the run's wall time"""
+        lines = [f"{'stage':<48} {'calls':>7} {'wall s':>9} {'% run':>6} {'cpu s':>9} {'mean ms':>9}"]
+        for row in self.stage_rows():
+            depth = row['stage'].count('/')
+            label = '  ' * depth + row['stage'].rsplit('/', 1)[-1]
+            lines.append(f"{label:<48} {row['calls']:>7} {row['wall']:>9.3f} {row['share'] * 100:>5.1f}% "
+                         f"{row['cpu']:>9.3f} {row['wall'] / row['calls'] * 1000:>9.2f}")
+        lines.append(f"{'total (profiled run)':<48} {'':>7} {self.elapsed:>9.3f}")
+        return '\n'.join(lines)
+
+    def memory_report(self, top: int = 5) -> str:
+        lines = []
+        for (_, _, _, before), (label, current, peak, after) in zip(self.snapshots, self.snapshots[1:]):
+            lines.append(f"{label}: current {current / 2 ** 20:.1f} MB, peak {peak / 2 ** 20:.1f} MB")
+            for diff in after.compare_to(before, 'lineno')[:top]:
+                if diff.size_diff:
+                    lines.append(f"    {diff.size_diff / 2 ** 20:+8.2f} MB  {diff.traceback}")
+        return '\n'.join(lines)
+
+    def write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, 'stages.txt'), 'w') as f:
+            f.write(self.stage_table() + '\n')
+        with open(os.path.join(self.output_dir, 'stages.json'), 'w') as f:
+            json.dump({'elapsed': self.elapsed, 'stages': self.stage_rows()}, f, indent=2)
+        with open(os.path.join(self.output_dir, 'profile.collapsed'), 'w') as f:
+            for stack, count in self.sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        if self.tracer_name == 'cprofile':
+            self.tracer.dump_stats(os.path.join(self.output_dir, 'profile.prof'))
+        elif self.tracer_name == 'pyinstrument':
+            with open(os.path.join(self.output_dir, 'profile.html'), 'w') as f:
+                f.write(self.tracer.output_html())
+        if self.memory:
+            with open(os.path.join(self.output_dir, 'memory.txt'), 'w') as f:
+                f.write(self.memory_report() + '\n')
+
+@contextlib.contextmanager
+def enabled(output_dir: str, tracer: Optional[str] = 'cprofile', memory: bool = True, interval: float = 0.005):
+    """
+    Profile everything run inside the block and write the reports to output_dir
+
+    Args:
+        tracer: 'cprofile', 'pyinstrument' or None
+        memory: Take tracemalloc snapshots
+        interval: Sampling interval in seconds
+    """
+    global _profiler
+    if _profiler is not None:
+        raise RuntimeError("Profiling is already enabled")
+    profiler = Profiler(output_dir, tracer, memory, interval)
+    profiler.start()
+    _profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _profiler = None
+        profiler.stop()
+        profiler.write()
+        print(f"\nStage timings (reports in {output_dir}):")
+        print(profiler.stage_table())
@@ -0,0 +1,89 @@
+from typing import Dict, List, Sequence
+
+from data_processing import TUTOR_ACTION_TYPES, ProcessedConversation
+
+# Everything that doesn't depend on the conversation lives in the system message, so
+# every request starts with the same bytes and provider-side prompt caching can reuse it.
+# The conversation-specific context follows in the user message.
+SYSTEM_PROMPT = """You are a language tutor teaching Italian.
+
+Available actions (one response can correspond to multiple action types):
+- Question: Ask student for clarification or to elaborate
+- Hint: Provide indirect guidance
+- Correction: Point out and fix errors
+- Confirmation: Acknowledge correct responses
+- Other: Any other type of response
+
+Respond in JSON format with:
+{
+    "response": "your response text",
+    "actions": ["your action types"]  // Corresponds to actions list above (lowercase). One response can correspond to multiple action types.
+}"""
+
+USER_PROMPT_TEMPLATE = """Context:
+- Target phrase (IT): {target_phrase_it}
+- Target phrase (EN): {target_phrase_en}
+- Grammar rules:
+{grammar_rules}
+
+Conversation history:
+{conversation_history}
+
+Please provide a response as a tutor to the student's last message."""
+
+# Shared by every message list, never mutated
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "tutor_response",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "additionalProperties": False, # need this for openai, remove for others
+            "properties": {
+                "response": {
+                    "type": "string",
+                    "description": "The tutor's response text"
+                },
+                "actions": {
+                    "type": "array",
+                    "items": {
+                        "type": "string",
+                        "enum": list(TUTOR_ACTION_TYPES)
+                    },
+                    "minItems": 1,  # Every tutor turn takes at least one action, as response_parser checks
+                    "description": "List of action types for this response"
+                }
+            },
+            "required": ["response", "actions"],
+        }
+    }
+}
+
+_fill_user_prompt = USER_PROMPT_TEMPLATE.format
+
+def _bullets(items: Sequence[str]) -> str:
+    """One '  - item' line per item instead of a Python list repr"""
+    if not items:
+        return "  - (none)"
+    return "\n".join(f"  - {item.strip()}" for item in items)
+
+def build_user_prompt(conversation: ProcessedConversation) -> str:
+    """Fill the user template with a conversation's context and history"""
+    return _fill_user_prompt(
+        target_phrase_it=conversation.target_phrase_it,
+        target_phrase_en=conversation.target_phrase_en,
+        grammar_rules=_bullets(conversation.grammar_rules),
+        conversation_history=_bullets(conversation.conversation_history),
+    )
+
+def build_messages(conversation: ProcessedConversation) -> List[Dict]:
+    """Chat messages for one conversation: the shared system message, then the context"""
+    return [SYSTEM_MESSAGE, {"role": "user", "content": build_user_prompt(conversation)}]
+
+def build_messages_batch(conversations: Sequence[ProcessedConversation]) -> List[List[Dict]]:
+    """Chat messages for many conversations at once, in the same order"""
+    return [[SYSTEM_MESSAGE, {"role": "user", "content": content}]
+            for content in map(build_user_prompt, conversations)]
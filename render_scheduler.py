@@ -0,0 +1,108 @@
+import hashlib
+import inspect
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
+
+import profiling
+
+DEFAULT_STATE_FILE = '.cache/render_state.json'
+
+@dataclass
+class FigureJob:
+    """One figure to render: render(aggregates, title, output_dir) writes output_path"""
+    render: Callable  # Module-level function, so it can be sent to a worker process
+    aggregates: object  # Picklable input the figure is drawn from
+    title: str
+    output_dir: str
+    output_path: str
+
+    def fingerprint(self) -> str:
+        """Hash of the figure's inputs and of the code that draws it (its style)"""
+        digest = hashlib.sha256()
+        digest.update(repr(self.aggregates).encode('utf-8'))
+        digest.update(self.title.encode('utf-8'))
+        digest.update(inspect.getsource(self.render).encode('utf-8'))
+        return digest.hexdigest()
+
+def _init_worker():
+    """Force a headless backend before anything in the worker imports pyplot"""
+    os.environ['MPLBACKEND'] = 'Agg'
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+def _render(job: FigureJob) -> Tuple[str, float]:
+    start = time.perf_counter()
+    with profiling.stage(f"render {os.path.basename(job.output_dir)}"):
+        job.render(job.aggregates, job.title, job.output_dir)
+    return job.output_path, time.perf_counter() - start
+
+def _render_in_process(jobs: List[FigureJob]):
+    """Render one job after another in this process, with the same interface as submitted futures"""
+    _init_worker()
+    for job in jobs:
+        try:
+            yield _render(job), None
+        except Exception as e:
+            yield None, e
+
+def _render_on_pool(jobs: List[FigureJob], workers: int):
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(_render, job) for job in jobs]
+        for future in futures:
+            try:
+                yield future.result(), None
+            except Exception as e:
+                yield None, e
+
+def render_figures(jobs: List[FigureJob], workers: int = None, force: bool = False,
+                   state_file: str = DEFAULT_STATE_FILE) -> Dict[str, float]:
+    """
+    Render figure jobs on a process pool, skipping figures that are already up to date.
+
+    A figure is skipped when its output exists and its fingerprint (input aggregates,
+    title and render code) matches the one recorded when it was last drawn.
+
+    Args:
+        jobs: Figures to render
+        workers: Worker processes, defaults to one per core
+        force: Render everything regardless of the recorded fingerprints
+        state_file: Where fingerprints of rendered figures are kept
+
+    Returns:
+        Render time in seconds for each figure that was drawn
+    """
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+
+    fingerprints = {job.output_path: job.fingerprint() for job in jobs}
+    todo = [
+        job for job in jobs
+        if force or state.get(job.output_path) != fingerprints[job.output_path] or not os.path.exists(job.output_path)
+    ]
+    print(f"Rendering {len(todo)} of {len(jobs)} figures ({len(jobs) - len(todo)} up to date)")
+
+    timings = {}
+    if todo:
+        # When profiling, draw in this process so the profilers see the drawing code
+        results = _render_in_process(todo) if profiling.is_enabled() else _render_on_pool(todo, workers)
+        for job, (result, error) in zip(todo, results):
+            if error is not None:
+                print(f"Failed to render {job.output_path}: {error}")
+                continue
+            output_path, seconds = result
+            timings[output_path] = seconds
+            state[output_path] = fingerprints[output_path]
+
+        os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+        with open(state_file, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+
+    for output_path, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        print(f"  {seconds:6.2f}s  {output_path}")
+    return timings
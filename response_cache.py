@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+DEFAULT_CACHE_PATH = '.cache/responses.sqlite'
+
+class CacheMissError(KeyError):
+    """Raised in replay mode when a request isn't in the cache"""
+
+def request_key(request: dict) -> str:
+    """Content address of a chat completion request (model, messages, schema, ...)"""
+    canonical = json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of completions keyed by the hash of the full request.
+
+    Identical requests (same model, prompts and response_format) are answered from
+    disk instead of being billed again, across runs and scripts. The cache is kept
+    under `max_bytes` by evicting the least recently used entries.
+
+    Args:
+        path: SQLite file to use
+        max_bytes: Size budget for stored completions
+        replay: Read-only mode. Nothing is written and a miss raises CacheMissError,
+                so a pipeline can run fully offline from earlier completions
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = 1 << 30, replay: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        if replay:
+            self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)')
+            self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """Cached completion content for `key`, or None (CacheMissError in replay mode)"""
+        with self.lock:
+            row = self.conn.execute('SELECT content FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.replay:
+                    raise CacheMissError(f"No cached completion for request {key[:12]} (replay mode)")
+                return None
+            self.hits += 1
+            if not self.replay:
+                self.conn.execute('UPDATE completions SET last_used = ? WHERE key = ?', (time.time(), key))
+                self.conn.commit()
+            return row[0]
+
+    def put(self, key: str, model: str, content: str):
+        """Store a completion, evicting old entries if the cache is over budget"""
+        if self.replay:
+            return
+        size = len(content.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute('SELECT size FROM completions WHERE key = ?', (key,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO completions (key, model, content, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model, content, size, now, now)
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache is back under 90% of its budget"""
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute('SELECT key, size FROM completions ORDER BY last_used').fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany('DELETE FROM completions WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': self.conn.execute('SELECT COUNT(*) FROM completions').fetchone()[0],
+            'bytes': self.total_bytes,
+        }
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,152 @@
+import json
+from typing import Dict, List, Sequence
+
+from data_processing import TUTOR_ACTION_TYPES
+
+class ResponseParseError(ValueError):
+    """
+    A model's output isn't a valid tutor_response.
+
+    Attributes:
+        content: The (possibly partial) output that was rejected
+        parsed: Responses that did parse, when only some choices of an n > 1 request failed
+        choices: Number of choices the request returned
+    """
+
+    def __init__(self, message: str, content: str = '', parsed: Sequence = (), choices: int = 1):
+        super().__init__(message)
+        self.content = content
+        self.parsed = list(parsed)
+        self.choices = choices
+
+class TutorResponseParser:
+    """
+    Incremental parser for the tutor_response JSON object, fed as tokens stream in.
+
+    It tracks just enough JSON structure (nesting, strings, escapes, the current key)
+    to check the output as early as possible: a reply that doesn't start with '{' is
+    rejected on its first character, every action is checked against the enum as soon
+    as its string closes, and the actions list once its ']' arrives. feed() raises
+    ResponseParseError at the first problem, so a streaming caller can hang up
+    instead of paying for the rest of a generation that will be thrown away.
+
+    Args:
+        action_types: Allowed action names
+    """
+
+    def __init__(self, action_types: List[str] = TUTOR_ACTION_TYPES):
+        self.action_types = set(action_types)
+        self.buffer = []
+        self.position = 0  # Characters consumed so far
+        self.depth = 0
+        self.started = False
+        self.done = False
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.expect_key = False
+        self.key = None
+        self.actions_start = None
+        self.actions_checked = False
+
+    def text(self) -> str:
+        return ''.join(self.buffer)
+
+    def fail(self, message: str):
+        raise ResponseParseError(message, self.text())
+
+    def feed(self, chunk: str):
+        """Consume the next piece of output"""
+        self.buffer.append(chunk)
+        for char in chunk:
+            self._step(char)
+            self.position += 1
+
+    def _step(self, char: str):
+        if self.done:
+            if not char.isspace():
+                self.fail("Unexpected text after the JSON object")
+            return
+
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif char == '\\':
+                self.escape = True
+            elif char == '"':
+                self.in_string = False
+                self._string_closed()
+            return
+
+        if not self.started:
+            if char.isspace():
+                return
+            if char != '{':
+                self.fail(f"Expected a JSON object, got {char!r}")
+            self.started = True
+
+        if char == '"':
+            self.in_string = True
+            self.string_start = self.position
+        elif char in '{[':
+            self.depth += 1
+            if self.depth == 1:
+                self.expect_key = True
+            elif self.depth == 2 and char == '[' and self.key == 'actions':
+                self.actions_start = self.position
+        elif char in '}]':
+            self.depth -= 1
+            if self.depth == 1 and char == ']' and self.actions_start is not None and not self.actions_checked:
+                self._check_actions(self._slice(self.actions_start, self.position + 1))
+            elif self.depth == 0:
+                self.done = True
+        elif self.depth == 1 and char == ',':
+            self.expect_key = True
+        elif self.depth == 1 and char == ':':
+            self.expect_key = False
+
+    def _slice(self, start: int, end: int) -> str:
+        # Only called at the few points a value closes, so joining the buffer here is cheap enough
+        return self.text()[start:end]
+
+    def _loads(self, text: str):
+        """json.loads raising ResponseParseError, so callers only ever see one exception type"""
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError as e:
+            self.fail(f"Invalid JSON {text!r}: {e}")
+
+    def _string_closed(self):
+        if self.depth == 1 and self.expect_key:
+            self.key = self._loads(self._slice(self.string_start, self.position + 1))
+        elif self.depth == 2 and self.actions_start is not None and not self.actions_checked:
+            action = self._loads(self._slice(self.string_start, self.position + 1))
+            if action not in self.action_types:
+                self.fail(f"Unknown action {action!r}")
+
+    def _check_actions(self, text: str):
+        actions = self._loads(text)
+        if not actions or not all(isinstance(a, str) for a in actions):
+            self.fail(f"Expected a non-empty list of action names, got {text}")
+        self.actions_checked = True
+
+    def close(self) -> Dict:
+        """Finish parsing once the output is complete and return the parsed object"""
+        content = self.text()
+        if not self.done:
+            self.fail("Output ended before the JSON object was complete")
+        try:
+            parsed = json.loads(content)
+        except json.JSONDecodeError as e:
+            raise ResponseParseError(f"Invalid JSON: {e}", content) from e
+        if not isinstance(parsed.get('response'), str):
+            self.fail("Missing 'response' text")
+        if not self.actions_checked:
+            self.fail("Missing 'actions' list")
+        return parsed
+
+def parse_tutor_response(content: str, action_types: List[str] = TUTOR_ACTION_TYPES) -> Dict:
+    """Validate a complete output in one go, raising ResponseParseError like the streaming path"""
+    parser = TutorResponseParser(action_types)
+    parser.feed(content or '')
+    return parser.close()
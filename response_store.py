@@ -0,0 +1,305 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Hashable, Iterator, List, Tuple
+
+import numpy as np
+
+from data_processing import TUTOR_ACTION_TYPES, encode_actions
+from dataset_cache import file_hash
+from journal import atomic_write_json, read_responses, responses_file_for
+
+DEFAULT_STORE_PATH = 'data/responses.sqlite'
+
+class _Database:
+    """
+    One connection per database file, shared by every ResponseStore on it in this process.
+
+    Appends are committed in batches, so a store holds SQLite's write lock between
+    commits. Two connections in the same process would wait on each other's
+    uncommitted batches, so stores share the connection (and its batching) instead.
+    Other processes use their own connection and wait for the lock via the busy timeout.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.users = 0
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')  # Still consistent after a crash, a power cut may only lose the last commits
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                model TEXT NOT NULL,
+                samples INTEGER NOT NULL,
+                conversation_id INTEGER NOT NULL,
+                sample_idx INTEGER NOT NULL,
+                response TEXT NOT NULL,
+                actions TEXT NOT NULL,
+                action_mask INTEGER NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (model, samples, conversation_id, sample_idx)
+            ) WITHOUT ROWID''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_actions ON responses (model, samples, action_mask)')
+        # Hash and time of each JSON file as the store last wrote or imported it, to notice edits made
+        # outside the store and rows the file doesn't have yet
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS exports (
+                model TEXT NOT NULL,
+                samples INTEGER NOT NULL,
+                output_file TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                exported REAL NOT NULL,
+                PRIMARY KEY (model, samples, output_file)
+            ) WITHOUT ROWID''')
+        self.conn.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+            self.last_sync = time.monotonic()
+
+_databases: Dict[str, _Database] = {}
+_databases_lock = threading.Lock()
+
+def _open_database(path: str) -> _Database:
+    with _databases_lock:
+        key = os.path.abspath(path)
+        if key not in _databases:
+            _databases[key] = _Database(path)
+        _databases[key].users += 1
+        return _databases[key]
+
+def _release_database(db: _Database):
+    with _databases_lock:
+        db.users -= 1
+        if db.users == 0:
+            db.commit()
+            db.conn.close()
+            del _databases[os.path.abspath(db.path)]
+
+class ResponseStore:
+    """
+    Generated responses for one model, kept in a shared SQLite database.
+
+    Every response is one row keyed by (model, samples, conversation_id, sample_idx),
+    where `samples` is the ensemble size of the run (1 for the single-response
+    layout), so ensembles and single runs of the same model don't mix. Actions are
+    stored as a bitmask over TUTOR_ACTION_TYPES, indexed for filtering by action,
+    next to the list as the model gave it so exports reproduce the JSON exactly.
+
+    The database runs in WAL mode with a busy timeout, so several stores (one per
+    model, sharing a connection within a process, or in several processes) can write
+    to it while others read. Appends are committed in batches like ResponseJournal's fsyncs.
+
+    It can stand in for ResponseJournal: `conv_id in store`, append(), sync(),
+    compact() and close() behave the same. compact() exports the model's rows to
+    `output_file` in the usual {conversation_id: {...}} JSON layout, so
+    visualization.py and the other readers of data/*_responses.json keep working.
+    close() only exports if responses were appended since the last export.
+
+    The store remembers the hash of the JSON it last exported or imported. If
+    `output_file` has changed since (edited by hand, updated by git pull) or the
+    store has nothing for this model yet, the file is imported on open, its
+    conversations replacing the store's, so the next export doesn't revert it.
+
+    Args:
+        model_name: Model whose responses this store holds
+        samples: Ensemble size of the run (see journal.responses_file_for)
+        path: SQLite database shared by all models
+        output_file: JSON export, defaults to data/<model>_responses.json
+        sync_every: Commit after this many appended conversations
+        sync_interval: ... or after this many seconds, whichever comes first
+    """
+
+    def __init__(self, model_name: str, samples: int = 1, path: str = DEFAULT_STORE_PATH,
+                 output_file: str = None, sync_every: int = 32, sync_interval: float = 2.0):
+        self.model_name = model_name
+        self.samples = samples
+        self.path = path
+        self.output_file = output_file or responses_file_for(model_name, samples=samples)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.db = _open_database(path)
+        self.conn = self.db.conn
+        self.lock = self.db.lock
+
+        if len(self) == 0 and os.path.exists(f"{self.output_file}.journal.jsonl"):
+            self.import_journal()
+        elif os.path.exists(self.output_file) and file_hash(self.output_file) != self.exported_hash():
+            self.import_journal()
+
+    def __contains__(self, conv_id: Hashable) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM responses WHERE model = ? AND samples = ? AND conversation_id = ? LIMIT 1',
+                (self.model_name, self.samples, int(conv_id))
+            ).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        """Number of conversations with responses"""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(DISTINCT conversation_id) FROM responses WHERE model = ? AND samples = ?',
+                (self.model_name, self.samples)
+            ).fetchone()[0]
+
+    def append(self, conv_id: Hashable, value):
+        """
+        Record the response(s) for a conversation
+
+        Args:
+            value: {'response', 'actions'} dict, or a list of them for an ensemble
+        """
+        records = value if isinstance(value, list) else [value]
+        now = time.time()
+        rows = [
+            (self.model_name, self.samples, int(conv_id), sample_idx, record['response'],
+             json.dumps(record['actions']), encode_actions(record['actions'], TUTOR_ACTION_TYPES), now)
+            for sample_idx, record in enumerate(records)
+        ]
+        with self.lock:
+            self.conn.execute('DELETE FROM responses WHERE model = ? AND samples = ? AND conversation_id = ?',
+                              (self.model_name, self.samples, int(conv_id)))
+            self.conn.executemany('INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.pending += 1
+            if self.db.pending >= self.sync_every or time.monotonic() - self.db.last_sync >= self.sync_interval:
+                self.db.commit()
+
+    def sync(self):
+        """Commit appended responses"""
+        self.db.commit()
+
+    def get(self, conv_id: Hashable):
+        """A conversation's value in the JSON layout, or None"""
+        rows = self._select('AND conversation_id = ?', (int(conv_id),))
+        return self._layout(rows).get(str(int(conv_id)))
+
+    def conversation_range(self, start: int, stop: int) -> Dict[str, object]:
+        """Responses for conversation ids start <= id < stop, in the JSON layout"""
+        return self._layout(self._select('AND conversation_id >= ? AND conversation_id < ?', (start, stop)))
+
+    def with_actions(self, all_of: List[str] = (), none_of: List[str] = ()) -> List[Tuple[int, int, str, List[str]]]:
+        """
+        Responses using every action in `all_of` and none in `none_of`
+
+        Returns:
+            (conversation_id, sample_idx, response, actions) tuples
+        """
+        required = encode_actions(list(all_of), TUTOR_ACTION_TYPES)
+        excluded = encode_actions(list(none_of), TUTOR_ACTION_TYPES)
+        rows = self._select('AND action_mask & ? = ? AND action_mask & ? = 0', (required, required, excluded))
+        return [(c, s, response, json.loads(actions)) for c, s, response, actions in rows]
+
+    def action_masks(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(conversation_ids, sample_idx, action_mask) arrays, e.g. for dataset_cache.unpack_masks"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT conversation_id, sample_idx, action_mask FROM responses WHERE model = ? AND samples = ? '
+                'ORDER BY conversation_id, sample_idx', (self.model_name, self.samples)
+            ).fetchall()
+        array = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        return array[:, 0], array[:, 1], array[:, 2].astype(np.uint8)
+
+    def _select(self, where: str = '', params: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self.conn.execute(
+                'SELECT conversation_id, sample_idx, response, actions FROM responses '
+                f'WHERE model = ? AND samples = ? {where} ORDER BY conversation_id, sample_idx',
+                (self.model_name, self.samples) + tuple(params)
+            ).fetchall()
+
+    def _layout(self, rows: List[tuple]) -> Dict[str, object]:
+        """Rows to {conversation_id: record}, or {conversation_id: [records]} for ensembles"""
+        data: Dict[str, object] = {}
+        for conv_id, _, response, actions in rows:
+            record = {'response': response, 'actions': json.loads(actions)}
+            if self.samples > 1:
+                data.setdefault(str(conv_id), []).append(record)
+            else:
+                data[str(conv_id)] = record
+        return data
+
+    def to_json(self) -> Dict[str, object]:
+        """All of the model's responses in the data/*_responses.json layout"""
+        return self._layout(self._select())
+
+    def import_json(self, path: str):
+        """Load an existing responses file into the store"""
+        with open(path, 'r', encoding='utf-8') as f:
+            self._import(json.load(f), path)
+
+    def import_journal(self):
+        """Load output_file plus anything a ResponseJournal recorded but never compacted, leaving both as they are"""
+        self._import(read_responses(self.output_file), self.output_file)
+
+    def _import(self, data: Dict[str, object], source: str):
+        for conv_id, value in data.items():
+            self.append(conv_id, value)
+        if source == self.output_file and os.path.exists(source):
+            self._record_export()  # The file already has everything imported
+        self.sync()
+        print(f"Imported {len(data)} conversations for {self.model_name} from {source}")
+
+    def _last_export(self) -> Tuple[str, float]:
+        """(hash, time) of output_file when the store last exported or imported it, (None, 0) if it never has"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT sha256, exported FROM exports WHERE model = ? AND samples = ? AND output_file = ?',
+                (self.model_name, self.samples, os.path.abspath(self.output_file))
+            ).fetchone()
+        return tuple(row) if row else (None, 0.0)
+
+    def exported_hash(self) -> str:
+        return self._last_export()[0]
+
+    def unexported(self) -> bool:
+        """Whether responses were appended since output_file was last exported or imported"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM responses WHERE model = ? AND samples = ? AND created > ? LIMIT 1',
+                (self.model_name, self.samples, self._last_export()[1])
+            ).fetchone()
+        return row is not None
+
+    def _record_export(self):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO exports VALUES (?, ?, ?, ?, ?)',
+                              (self.model_name, self.samples, os.path.abspath(self.output_file),
+                               file_hash(self.output_file), time.time()))
+
+    def compact(self):
+        """Commit and export the model's responses to output_file"""
+        atomic_write_json(self.output_file, self.to_json())
+        self._record_export()
+        self.sync()
+
+    def close(self, compact: bool = True):
+        if compact and self.unexported():
+            self.compact()
+        else:
+            self.sync()
+        _release_database(self.db)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Export even on errors/KeyboardInterrupt so the JSON file reflects all finished work
+        self.close()
+
+def iter_store_models(path: str = DEFAULT_STORE_PATH) -> Iterator[Tuple[str, int]]:
+    """(model, samples) pairs present in a store"""
+    conn = sqlite3.connect(path)
+    try:
+        yield from conn.execute('SELECT DISTINCT model, samples FROM responses ORDER BY model, samples').fetchall()
+    finally:
+        conn.close()
@@ -0,0 +1,169 @@
+from collections import deque
+from dataclasses import replace
+from itertools import chain, islice
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from action_matrix import (ActionMatrices, action_counts, actions_per_response_counts, conditional_counts,
+                           labelled, labelled_2d, student_action_counts)
+from data_processing import (STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES, ProcessedConversation, TutorResponse,
+                             iter_processed_conversations, iter_raw_conversations)
+from dataset_cache import DEFAULT_SOURCE
+from generation import GenerationEngine
+from journal import ResponseJournal
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    """Yield lists of up to `size` items"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+class StreamingActionCounts:
+    """
+    Running action counts over a stream of conversations.
+
+    Conversations are buffered and folded into the totals `batch_size` at a time
+    through ActionMatrices, so memory is bounded by one batch whatever the corpus size.
+    """
+
+    def __init__(self, batch_size: int = 512):
+        self.batch_size = batch_size
+        self.buffer: List[ProcessedConversation] = []
+        self.n_conversations = 0
+        self.tutor_counts = np.zeros(len(TUTOR_ACTION_TYPES), dtype=np.int64)
+        self.student_counts = np.zeros(len(STUDENT_ACTION_TYPES), dtype=np.int64)
+        self.conditional = np.zeros((len(STUDENT_ACTION_TYPES), len(TUTOR_ACTION_TYPES)), dtype=np.int64)
+        self.actions_per_response = np.zeros(len(TUTOR_ACTION_TYPES) + 1, dtype=np.int64)
+
+    def add(self, conversation: ProcessedConversation):
+        self.buffer.append(conversation)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        m = ActionMatrices.from_conversations(self.buffer)
+        self.n_conversations += len(self.buffer)
+        self.tutor_counts += action_counts(m)
+        self.student_counts += student_action_counts(m)
+        self.conditional += conditional_counts(m)
+        self.actions_per_response += actions_per_response_counts(m)
+        self.buffer = []
+
+    def summary(self) -> dict:
+        """Counts and distributions seen so far"""
+        self.flush()
+        conditional_totals = self.conditional.sum(axis=1, keepdims=True)
+        return {
+            'conversations': self.n_conversations,
+            'tutor_action_counts': labelled(self.tutor_counts, TUTOR_ACTION_TYPES),
+            'student_action_counts': labelled(self.student_counts, STUDENT_ACTION_TYPES),
+            'conditional_distribution': labelled_2d(
+                np.divide(self.conditional, conditional_totals, out=np.zeros(self.conditional.shape),
+                          where=conditional_totals > 0),
+                STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES
+            ),
+            'actions_per_response': labelled(self.actions_per_response, [str(i) for i in range(len(self.actions_per_response))]),
+        }
+
+def stream_conversations(source: str = DEFAULT_SOURCE) -> Iterator[Tuple[str, ProcessedConversation]]:
+    """Parse and process stages: (conversation id, conversation) pairs straight off the file"""
+    return iter_processed_conversations(iter_raw_conversations(source))
+
+def with_model_response(conversation: ProcessedConversation, record: dict) -> ProcessedConversation:
+    """The conversation with its tutor responses replaced by one {'response', 'actions'} record"""
+    return replace(conversation, tutor_responses=(TutorResponse.from_actions(record['response'], record['actions']),))
+
+def stream_generated(conversations: Iterable[Tuple[str, ProcessedConversation]],
+                     engine: GenerationEngine,
+                     model_name: str,
+                     journal: ResponseJournal = None) -> Iterator[Tuple[str, ProcessedConversation]]:
+    """
+    Generate stage: yield each conversation with its tutor responses replaced by the model's.
+
+    Conversations already in `journal` aren't sent again but are still yielded, with
+    the journaled response, so a resumed run analyses the whole corpus. New responses
+    are appended to the journal. Conversations whose generation fails are left out and
+    reported in engine.failed. Only the requests in flight are held in memory, plus
+    journaled conversations met while requests are in flight, until the next result.
+    """
+    conversations = iter(conversations)
+    in_flight = {}
+    resumed = deque()
+
+    # Journaled conversations before the first new one (usually all of them) go straight through
+    first_new = None
+    for conv_id, conversation in conversations:
+        if journal is None or conv_id not in journal:
+            first_new = (conv_id, conversation)
+            break
+        yield conv_id, with_model_response(conversation, journal.responses[str(conv_id)])
+    if first_new is None:
+        return
+
+    def jobs():
+        for conv_id, conversation in chain([first_new], conversations):
+            if journal is not None and conv_id in journal:
+                resumed.append((conv_id, conversation))
+                continue
+            in_flight[conv_id] = conversation
+            yield conv_id, conversation
+
+    def drain_resumed():
+        while resumed:
+            conv_id, conversation = resumed.popleft()
+            yield conv_id, with_model_response(conversation, journal.responses[str(conv_id)])
+
+    dropped = 0
+
+    def drop_failed():
+        # engine.stream doesn't yield failures, forget their conversations as they're reported
+        nonlocal dropped
+        for conv_id in islice(engine.failed, dropped, None):
+            in_flight.pop(conv_id, None)
+        dropped = len(engine.failed)
+
+    for conv_id, llm_response in engine.stream(jobs(), model_name):
+        drop_failed()
+        yield from drain_resumed()
+        conversation = in_flight.pop(conv_id)
+        record = {'response': llm_response.response, 'actions': llm_response.actions}
+        if journal is not None:
+            journal.append(conv_id, record)
+        yield conv_id, with_model_response(conversation, record)
+    drop_failed()
+    yield from drain_resumed()
+
+def analyse_stream(conversations: Iterable[Tuple[str, ProcessedConversation]], batch_size: int = 512) -> dict:
+    """Analyse stage: fold a stream of conversations into action counts and distributions"""
+    counts = StreamingActionCounts(batch_size)
+    for _, conversation in conversations:
+        counts.add(conversation)
+    return counts.summary()
+
+def run_streaming_pipeline(source: str = DEFAULT_SOURCE,
+                           engine: GenerationEngine = None,
+                           model_name: str = None,
+                           journal: ResponseJournal = None,
+                           batch_size: int = 512) -> dict:
+    """
+    Parse -> process -> (generate) -> analyse, as one chain of generators.
+
+    Each stage pulls from the previous one, so analysis of the first conversations
+    starts while later ones are still being read from disk. Without an engine the
+    human tutor responses in the source are analysed.
+
+    Returns:
+        analyse_stream's summary, plus 'failed_conversations': how many conversations
+        were left out because generation failed (their errors are in engine.failed)
+    """
+    conversations = stream_conversations(source)
+    if engine is not None:
+        conversations = stream_generated(conversations, engine, model_name, journal)
+    summary = analyse_stream(conversations, batch_size)
+    summary['failed_conversations'] = len(engine.failed) if engine is not None else 0
+    if summary['failed_conversations']:
+        print(f"{summary['failed_conversations']} conversations failed and aren't in the counts, see engine.failed")
+    return summary
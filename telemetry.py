@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+DEFAULT_METRICS_FILE = '.cache/metrics.jsonl'
+
+# Retry attempt of the request currently being made on this thread (0 = first try).
+# Set by GenerationEngine.call_with_retries, read when a call is recorded
+current_attempt: ContextVar[int] = ContextVar('current_attempt', default=0)
+
+FIRST_BYTE_KEY = 'first_byte_at'
+
+def mark_first_byte(response: httpx.Response):
+    """httpx response hook: runs once the headers arrived, before the body is read"""
+    response.request.extensions[FIRST_BYTE_KEY] = time.perf_counter()
+
+@dataclass
+class CallRecord:
+    """One chat completion call, or a response served from the cache"""
+    run_id: str
+    timestamp: float  # Unix time the call started
+    model: str
+    status: str  # HTTP status code, 'cached', or the exception name for connection errors
+    latency: float  # Seconds until the full response was read
+    ttfb: Optional[float] = None  # Seconds until the response headers arrived
+    attempt: int = 0  # Retries before this call
+    samples: int = 1  # Choices requested (n)
+    parse_failures: int = 0  # Choices whose JSON didn't parse
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cost: Optional[float] = None  # Reported by OpenRouter when usage accounting is on
+
+class Telemetry:
+    """
+    Collects per-call records from LLMTutor, appends them to a JSONL metrics file
+    and summarises latency, tokens and throughput per model.
+
+    Pass it to LLMTutor(telemetry=...). Time to first byte needs the response hook,
+    which LLMTutor installs on its HTTP client via install().
+
+    Args:
+        metrics_file: JSONL file records are appended to (None to keep them in memory only)
+    """
+
+    def __init__(self, metrics_file: Optional[str] = DEFAULT_METRICS_FILE):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.records: List[CallRecord] = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.file = None
+        if metrics_file:
+            os.makedirs(os.path.dirname(metrics_file) or '.', exist_ok=True)
+            self.file = open(metrics_file, 'a', encoding='utf-8')
+
+    def install(self, http_client: httpx.Client):
+        """Add the first-byte hook to a client (once, the client may be shared)"""
+        hooks = http_client.event_hooks['response']
+        if mark_first_byte not in hooks:
+            hooks.append(mark_first_byte)
+
+    def record_call(self, model: str, started: float, finished: float, status, http_response: httpx.Response = None,
+                    usage=None, samples: int = 1, parse_failures: int = 0):
+        """
+        Record a finished call
+
+        Args:
+            started: time.perf_counter() taken just before the request was sent
+            finished: time.perf_counter() once the response was read
+            status: HTTP status code, or a label for calls that got no response
+            http_response: The raw response, for the first-byte timestamp
+            usage: The completion's `usage` object
+        """
+        first_byte = http_response.request.extensions.get(FIRST_BYTE_KEY) if http_response is not None else None
+        self._add(CallRecord(
+            run_id=self.run_id,
+            timestamp=time.time() - (time.perf_counter() - started),
+            model=model,
+            status=str(status),
+            latency=finished - started,
+            ttfb=first_byte - started if first_byte else None,
+            attempt=current_attempt.get(),
+            samples=samples,
+            parse_failures=parse_failures,
+            prompt_tokens=getattr(usage, 'prompt_tokens', None),
+            completion_tokens=getattr(usage, 'completion_tokens', None),
+            cost=getattr(usage, 'cost', None),
+        ))
+
+    def record_cached(self, model: str, samples: int = 1, parse_failures: int = 0):
+        self._add(CallRecord(self.run_id, time.time(), model, 'cached', 0.0, samples=samples,
+                             parse_failures=parse_failures))
+
+    def _add(self, record: CallRecord):
+        with self.lock:
+            self.records.append(record)
+            if self.file:
+                self.file.write(json.dumps(asdict(record)) + '\n')
+
+    def summary(self) -> Dict[str, Dict]:
+        """Per-model statistics over this run's records"""
+        with self.lock:
+            records = list(self.records)
+        elapsed = max(time.time() - self.started, 1e-9)
+
+        result = {}
+        for model in sorted({r.model for r in records}):
+            calls = [r for r in records if r.model == model]
+            sent = [r for r in calls if r.status != 'cached']
+            ok = [r for r in sent if r.status == '200']
+            latencies = np.array([r.latency for r in ok])
+            ttfbs = np.array([r.ttfb for r in ok if r.ttfb is not None])
+
+            def percentiles(values):
+                if len(values) == 0:
+                    return {}
+                return {f"p{q}": float(v) for q, v in zip((50, 95, 99), np.percentile(values, [50, 95, 99]))}
+
+            result[model] = {
+                'calls': len(sent),
+                'cached': len(calls) - len(sent),
+                'errors': len(sent) - len(ok),
+                'retries': sum(1 for r in sent if r.attempt > 0),
+                'parse_failures': sum(r.parse_failures for r in calls),
+                'latency': percentiles(latencies),
+                'ttfb': percentiles(ttfbs),
+                'prompt_tokens': sum(r.prompt_tokens or 0 for r in ok),
+                'completion_tokens': sum(r.completion_tokens or 0 for r in ok),
+                'cost': sum(r.cost or 0.0 for r in ok),
+                'responses_per_second': sum(r.samples for r in ok) / elapsed,
+            }
+        return result
+
+    def print_summary(self):
+        for model, stats in self.summary().items():
+            latency = ' / '.join(f"{k} {v:.2f}s" for k, v in stats['latency'].items()) or 'n/a'
+            ttfb = ' / '.join(f"{k} {v:.2f}s" for k, v in stats['ttfb'].items()) or 'n/a'
+            print(f"\n{model}: {stats['calls']} calls ({stats['errors']} errors, {stats['retries']} retries, "
+                  f"{stats['cached']} cached, {stats['parse_failures']} parse failures)")
+            print(f"  latency {latency}")
+            print(f"  ttfb    {ttfb}")
+            cost = f", cost {stats['cost']:.4f}" if stats['cost'] else ""
+            print(f"  tokens  {stats['prompt_tokens']} prompt / {stats['completion_tokens']} completion{cost}")
+            print(f"  throughput {stats['responses_per_second']:.2f} responses/s")
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -1,4 +1,4 @@
-import json
+from data_processing import TUTOR_ACTION_TYPES
 
 def transform_cima_to_gemini_format(cima_data):
     responses = {}
@@ -32,6 +32,23 @@ def transform_cima_to_gemini_format(cima_data):
     
     return responses
 
+def transform_columns_to_gemini_format(columns):
+    """Same output as transform_cima_to_gemini_format, built from the cached dataset columns"""
+    responses = {}
+    for i, conv_id in enumerate(columns.conversation_ids):
+        start, stop = columns.response_offsets[i], columns.response_offsets[i + 1]
+        responses[conv_id] = [
+            {
+                "response": columns.text('tutor_text', j),
+                "actions": [
+                    action_type for action_type, is_present in zip(TUTOR_ACTION_TYPES, columns.tutor_actions[j])
+                    if is_present
+                ]
+            }
+            for j in range(start, stop)
+        ]
+    return responses
+
 def process_file(input_data):
     # Load and transform the data
     transformed_data = transform_cima_to_gemini_format(input_data)
@@ -41,13 +58,6 @@ def process_file(input_data):
 
 # Example usage:
 if __name__ == "__main__":
-    # Read input data
-    with open("cima_dataset.json", "r", encoding="utf-8") as f:
-        input_data = json.load(f)
-    
-    # Process the data
-    output_data = process_file(input_data)
-    
-    # Write the output
-    with open("cima_gemini_format.json", "w", encoding="utf-8") as f:
-        json.dump(output_data, f, indent=2, ensure_ascii=False)
\ No newline at end of file
+    # Same as `python cli.py transform`
+    from cli import main
+    main(['transform'])
@@ -0,0 +1,150 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+except ImportError:  # Optional, httpx only speaks HTTP/2 with the h2 package installed
+    h2 = None
+
+@dataclass
+class TransportConfig:
+    """Connection pool and timeout settings for the HTTP client used by LLMTutor"""
+    max_connections: int = 64  # Upper bound on open connections across all hosts
+    max_keepalive_connections: int = 32  # Idle connections kept around for reuse
+    keepalive_expiry: float = 60.0  # Seconds an idle connection stays in the pool
+    http2: bool = True  # Multiplex requests over one connection where the server allows it
+    connect_timeout: float = 10.0
+    read_timeout: float = 120.0  # Per read, i.e. the longest wait between bytes of a completion
+    write_timeout: float = 30.0
+    pool_timeout: float = 60.0  # Longest wait for a free connection before failing
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout,
+            write=self.write_timeout,
+            pool=self.pool_timeout
+        )
+
+class TransportMetrics:
+    """
+    Connection statistics gathered from httpx event hooks and httpcore trace events.
+
+    Every request gets a trace callback in its extensions. The first trace event
+    only fires once the pool has handed the request a connection, so the time
+    until then is the request's queue wait. A request that triggers no TCP
+    connect reused a pooled connection (and for https skipped a TLS handshake).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.client: Optional[httpx.Client] = None
+
+    def on_request(self, request: httpx.Request):
+        """httpx request event hook: start timing and attach the trace callback"""
+        started = time.perf_counter()
+        waited = False
+
+        def trace(event_name: str, info: dict):
+            nonlocal waited
+            if not waited:
+                waited = True
+                self._record_wait(time.perf_counter() - started)
+            if event_name == 'connection.connect_tcp.complete':
+                with self.lock:
+                    self.connections_opened += 1
+            elif event_name == 'connection.start_tls.complete':
+                with self.lock:
+                    self.tls_handshakes += 1
+
+        with self.lock:
+            self.requests += 1
+        request.extensions['trace'] = trace
+
+    def _record_wait(self, seconds: float):
+        with self.lock:
+            self.queue_wait_total += seconds
+            self.queue_wait_max = max(self.queue_wait_max, seconds)
+
+    def open_connections(self) -> int:
+        """Connections currently held by the client's pool"""
+        pool = getattr(getattr(self.client, '_transport', None), '_pool', None)
+        connections = getattr(pool, 'connections', [])
+        return sum(1 for connection in connections if not connection.is_closed())
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            requests = self.requests
+            return {
+                'requests': requests,
+                'open_connections': self.open_connections(),
+                'connections_opened': self.connections_opened,
+                'tls_handshakes': self.tls_handshakes,
+                'handshakes_avoided': max(0, requests - self.connections_opened),
+                'queue_wait_mean': self.queue_wait_total / requests if requests else 0.0,
+                'queue_wait_max': self.queue_wait_max,
+            }
+
+    def print_summary(self):
+        stats = self.snapshot()
+        print(f"HTTP: {stats['requests']} requests over {stats['connections_opened']} connections "
+              f"({stats['handshakes_avoided']} handshakes avoided, {stats['tls_handshakes']} TLS), "
+              f"{stats['open_connections']} open, queue wait mean {stats['queue_wait_mean'] * 1000:.1f} ms "
+              f"/ max {stats['queue_wait_max'] * 1000:.1f} ms")
+
+def create_http_client(config: TransportConfig = None, metrics: TransportMetrics = None) -> httpx.Client:
+    """
+    Build an httpx client to hand to LLMTutor(http_client=...)
+
+    OpenAI picks up the client's timeout, so the timeouts here apply to every request.
+    HTTP/2 is only enabled when the optional h2 package is installed.
+    """
+    config = config or TransportConfig()
+    http2 = config.http2 and h2 is not None
+    if config.http2 and not http2:
+        print("h2 not installed, falling back to HTTP/1.1 (pip install 'httpx[http2]')")
+
+    client = httpx.Client(
+        http2=http2,
+        limits=config.limits(),
+        timeout=config.timeout(),
+        event_hooks={'request': [metrics.on_request]} if metrics else None
+    )
+    if metrics:
+        metrics.client = client
+    return client
+
+_shared_client: Optional[httpx.Client] = None
+_shared_metrics = TransportMetrics()
+_shared_lock = threading.Lock()
+
+def shared_http_client(config: TransportConfig = None) -> httpx.Client:
+    """
+    The process-wide client, created on first use. Sharing it across models keeps
+    their connections to the same host in one pool. `config` only applies to that first call.
+    """
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None or _shared_client.is_closed:
+            _shared_client = create_http_client(config, _shared_metrics)
+        return _shared_client
+
+def shared_metrics() -> TransportMetrics:
+    """Metrics for the client returned by shared_http_client()"""
+    return _shared_metrics
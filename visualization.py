@@ -1,11 +1,18 @@
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-from typing import Dict, List
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
 import json
 import os
 
-from main import load_dataset, process_all_conversations
+from action_matrix import (ActionMatrices, action_counts, actions_per_response_counts, conditional_counts,
+                           student_action_counts)
+from data_processing import STUDENT_ACTION_TYPES, TUTOR_ACTION_TYPES
+from dataset_cache import load_columns
+from profiling import stage
+from render_scheduler import FigureJob, render_figures
 
 def load_json_data(file_path: str) -> Dict:
     """
@@ -14,6 +21,41 @@ def load_json_data(file_path: str) -> Dict:
     with open(file_path, 'r') as f:
         return json.load(f)
 
+@dataclass
+class SourceAggregates:
+    """Everything the plots need from one responses file. Only non-zero counts are kept"""
+    action_counts: Dict[str, int]  # Tutor action -> number of responses using it
+    actions_per_response: Dict[int, int]  # Number of actions -> number of responses
+    student_action_counts: Dict[str, int]  # Student action -> number of conversations
+    conditional_counts: Dict[Tuple[str, str], int]  # (student action, tutor action) -> co-occurrences
+
+def compute_aggregates(data: Dict, student_actions: np.ndarray = None) -> SourceAggregates:
+    """
+    Compute the aggregates for all three plots in one pass over a responses file
+
+    Args:
+        data: Dictionary containing conversation data (single response or ensemble lists)
+        student_actions: Student action matrix from load_columns(). Only needed for the
+                         interaction flow, which is left empty without it
+    """
+    m = ActionMatrices.from_responses(data, student_actions)
+    tutor_counts = action_counts(m).tolist()
+    per_response = actions_per_response_counts(m).tolist()
+    student_counts = student_action_counts(m).tolist()
+    pair_counts = conditional_counts(m).tolist()
+
+    return SourceAggregates(
+        action_counts={action: count for action, count in zip(TUTOR_ACTION_TYPES, tutor_counts) if count},
+        actions_per_response={n: count for n, count in enumerate(per_response) if count},
+        student_action_counts={action: count for action, count in zip(STUDENT_ACTION_TYPES, student_counts) if count},
+        conditional_counts={
+            (student_action, tutor_action): pair_counts[i][j]
+            for i, student_action in enumerate(STUDENT_ACTION_TYPES)
+            for j, tutor_action in enumerate(TUTOR_ACTION_TYPES)
+            if pair_counts[i][j]
+        },
+    )
+
 def plot_action_distribution(data: Dict, title: str = "Action Type Distribution", output_dir: str = None):
     """
     Create bar chart showing relative frequencies of each action type for a single data source
@@ -23,16 +65,11 @@ def plot_action_distribution(data: Dict, title: str = "Action Type Distribution"
         title: Title for the plot
         output_dir: Directory to save the plot in. If None, plot will only be displayed.
     """
-    # Process actions into a format suitable for plotting
-    action_counts = {}
-    
-    for conv_id, conv_data in data.items():
-        # Handle both single response and ensemble (list) formats
-        responses = conv_data if isinstance(conv_data, list) else [conv_data]
-        
-        for response in responses:
-            for action in response['actions']:
-                action_counts[action] = action_counts.get(action, 0) + 1
+    render_action_distribution(compute_aggregates(data), title, output_dir)
+
+def render_action_distribution(aggregates: SourceAggregates, title: str = "Action Type Distribution", output_dir: str = None):
+    """Draw the action distribution bar chart from precomputed aggregates"""
+    action_counts = aggregates.action_counts
     
     # Convert to DataFrame and normalize
     total_count = sum(action_counts.values())
@@ -70,20 +107,15 @@ def plot_actions_per_response(data: Dict, title: str = "Actions per Response Dis
         title: Title for the plot
         output_dir: Directory to save the plot in. If None, plot will only be displayed.
     """
-    # Count actions per response
-    actions_per_response = []
-    
-    for conv_id, conv_data in data.items():
-        # Handle both single response and ensemble (list) formats
-        responses = conv_data if isinstance(conv_data, list) else [conv_data]
-        
-        for response in responses:
-            actions_per_response.append(len(response['actions']))
-    
+    render_actions_per_response(compute_aggregates(data), title, output_dir)
+
+def render_actions_per_response(aggregates: SourceAggregates, title: str = "Actions per Response Distribution", output_dir: str = None):
+    """Draw the actions-per-response histogram from precomputed aggregates"""
     # Create plot with larger font sizes
     plt.figure(figsize=(12, 8))
-    # Normalize the histogram values
-    sns.histplot(actions_per_response, discrete=True, stat='probability')
+    # Normalize the histogram values, weighting each action count by how many responses had it
+    sns.histplot(x=list(aggregates.actions_per_response.keys()), weights=list(aggregates.actions_per_response.values()),
+                 discrete=True, stat='probability')
     plt.title(title, fontsize=24, pad=20)
     plt.xlabel('Number of Actions per Response', fontsize=22, labelpad=15)
     plt.ylabel('Relative Frequency', fontsize=22, labelpad=15)
@@ -101,33 +133,16 @@ def plot_actions_per_response(data: Dict, title: str = "Actions per Response Dis
     plt.close()
 
 def plot_conditional_distribution(tutor_data, title: str = "Student-Tutor Interaction Flow", output_dir: str = None):
-    data = load_dataset()
-    processed_conversations = process_all_conversations(data)
-    
-    student_actions_dict = {i: conversation.student_actions 
-                          for i, conversation in enumerate(processed_conversations)}
+    # Only the student actions are needed, so read them straight from the column cache
+    aggregates = compute_aggregates(tutor_data, load_columns().student_actions)
+    render_conditional_distribution(aggregates, title, output_dir)
+
+def render_conditional_distribution(aggregates: SourceAggregates, title: str = "Student-Tutor Interaction Flow", output_dir: str = None):
+    """Draw the student -> tutor Sankey diagram from precomputed aggregates"""
+    conditional_counts = aggregates.conditional_counts
+    student_action_counts = aggregates.student_action_counts
+    total_interactions = sum(student_action_counts.values())
 
-    # Calculate interaction counts
-    conditional_counts = {}
-    student_action_counts = {}
-    
-    # First pass: count total interactions
-    total_interactions = 0
-    for conv_id, tutor_response in tutor_data.items():
-        conv_id = int(conv_id)
-        student_actions = student_actions_dict.get(conv_id, [])
-        responses = tutor_response if isinstance(tutor_response, list) else [tutor_response]
-        
-        for student_action in student_actions:
-            student_action_counts[student_action] = student_action_counts.get(student_action, 0) + 1
-            total_interactions += 1
-            
-        for student_action in student_actions:
-            for response in responses:
-                for tutor_action in response['actions']:
-                    key = (student_action, tutor_action)
-                    conditional_counts[key] = conditional_counts.get(key, 0) + 1
-    
     # Calculate normalized percentages
     student_percentages = {action: (count / total_interactions) * 100 
                          for action, count in student_action_counts.items()}
@@ -263,25 +278,51 @@ def plot_conditional_distribution(tutor_data, title: str = "Student-Tutor Intera
         except Exception as e:
             print(f"Error saving HTML: {str(e)}")
     
+# (render function, plot title, plots subdirectory, file extension) for each figure drawn per source
+PLOT_TYPES = [
+    (render_action_distribution, "Action Distribution", 'action_dist', 'png'),
+    (render_actions_per_response, "Actions per Response", 'actions_per_response', 'png'),
+    (render_conditional_distribution, "Interaction Flow", 'conditional_flows', 'html'),
+]
+
+def figure_jobs(name: str, aggregates: SourceAggregates, plots_dir: str = 'plots') -> List[FigureJob]:
+    """The figures drawn for one source, aggregates may be None to just list the output paths"""
+    jobs = []
+    for render, plot_title, subdir, extension in PLOT_TYPES:
+        title = f"{plot_title} - {name}"
+        output_dir = os.path.join(plots_dir, subdir)
+        jobs.append(FigureJob(render, aggregates, title, output_dir,
+                              os.path.join(output_dir, f'{title.lower()}.{extension}')))
+    return jobs
+
+def plot_all_sources(files: List[Tuple[str, str]], plots_dir: str = 'plots', workers: int = None, force: bool = False):
+    """
+    Render every plot for every (responses file, source name) pair
+
+    The student actions are loaded once and each file is read and aggregated once;
+    all figures are then drawn from those aggregates on a process pool, skipping
+    figures whose aggregates and drawing code haven't changed (see render_scheduler).
+    """
+    student_actions = load_columns().student_actions
+    with stage('aggregate'):
+        aggregates = {name: compute_aggregates(load_json_data(file_path), student_actions) for file_path, name in files}
+
+    jobs = []
+    for name, source_aggregates in aggregates.items():
+        jobs.extend(figure_jobs(name, source_aggregates, plots_dir))
+
+    render_figures(jobs, workers=workers, force=force)
+    return aggregates
+
+# Responses files and the name each source is plotted under
+SOURCES = [
+    ("data/cima_formatted.json", "CIMA"),
+    ("data/gemini-pro-1.5_responses.json", "Gemini Pro"),
+    ("data/gpt-4o-2024-08-06_responses.json", "GPT-4o"),
+    ("data/llama-3.1-405b-instruct:nitro_responses.json", "LLaMA")
+]
+
 if __name__ == "__main__":
-    # Create base plots directory
-    os.makedirs('plots', exist_ok=True)
-    
-    # Plot distributions for each model
-    files = [
-        ("data/cima_formatted.json", "Action Distribution - CIMA"),
-        ("data/gemini-pro-1.5_responses.json", "Action Distribution - Gemini Pro"), 
-        ("data/gpt-4o-2024-08-06_responses.json", "Action Distribution - GPT-4o"),
-        ("data/llama-3.1-405b-instruct:nitro_responses.json", "Action Distribution - LLaMA")
-    ]
-    
-    # Plot action distributions
-    action_dist_output_dir = os.path.join('plots', 'action_dist')
-    actions_per_response_dir = os.path.join('plots', 'actions_per_response')
-    conditional_flow_output_dir = os.path.join('plots', 'conditional_flows')
-    
-    for file_path, base_title in files:
-        data = load_json_data(file_path)
-        plot_action_distribution(data, f"Action Distribution - {base_title.split(' - ')[1]}", action_dist_output_dir)
-        plot_actions_per_response(data, f"Actions per Response - {base_title.split(' - ')[1]}", actions_per_response_dir)
-        plot_conditional_distribution(data, f"Interaction Flow - {base_title.split(' - ')[1]}", conditional_flow_output_dir)
\ No newline at end of file
+    # Same as `python cli.py plot`
+    from cli import main
+    main(['plot'])